@@ -4,7 +4,6 @@
 
 import sys
 import os
-import pickle
 
 libdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'lib')
 sys.path.append(libdir)
@@ -14,6 +13,7 @@ import msp_fr5969_model as model
 from mspdebug_driver import MSPdebug
 from msp_emulator import Emulator
 from msp_cosim import Cosim
+import msp_timing as timing
 import cosim as cosim_repl
 
 def step_and_sync(cosim, maxter_idx, mulator):
@@ -77,8 +77,7 @@ if __name__ == '__main__':
         tname = sys.argv[3]
 
     if tname:
-        with open(tname, 'rb') as f:
-            tinfo = pickle.load(f)
+        tinfo = timing.load_model(tname)
     else:
         tinfo = None
 
@@ -202,7 +202,7 @@ def main(fname = None, emulate = False, tinfo = None, tty = None, verbosity = 1)
 if __name__ == '__main__':
     import subprocess
     import argparse
-    import pickle
+    import msp_timing as timing
     parser = argparse.ArgumentParser()
 
     parser.add_argument('fname', nargs='?', default=None,
@@ -210,7 +210,7 @@ if __name__ == '__main__':
     parser.add_argument('-e', '--emulator', action='store_true',
                         help='run with emulator only')
     parser.add_argument('-t', '--timing',
-                        help='use this pickled timing model to emulate Timer_A')
+                        help='use this timing model (tables or pickle) to emulate Timer_A')
     parser.add_argument('-v', '--verbose', type=int, default=1,
                         help='verbosity level')
     parser.add_argument('-tty', default=None,
@@ -241,8 +241,7 @@ if __name__ == '__main__':
         if args.timing == 'reference':
             tinfo = 'reference'
         else:
-            with open(args.timing, 'rb') as f:
-                tinfo = pickle.load(f)
+            tinfo = timing.load_model(args.timing)
     else:
         tinfo = None
 
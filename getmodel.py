@@ -9,6 +9,7 @@ sys.path.append(libdir)
 
 from msp_isa import isa
 import smt
+import msp_timing as timing
 import historical_models
 
 def is_valid_mode(ins, rsname, rdname):
@@ -291,9 +292,14 @@ def create_model_table_10(record, fname):
     print('DONE: ttab has {:d} entries, stab has {:d} entries'
           .format(len(ttab), len(stab)))
 
-    with open(fname, 'wb') as f:
-        print('writing to {:s}'.format(fname))
-        pickle.dump({'state_default':state_default, 'ttab':ttab, 'stab':stab}, f)
+    tinfo = {'state_default':state_default, 'ttab':ttab, 'stab':stab}
+    if fname.endswith(timing.tables_suffix):
+        print('writing tables to {:s}'.format(fname))
+        timing.save_tables(tinfo, fname)
+    else:
+        with open(fname, 'wb') as f:
+            print('writing to {:s}'.format(fname))
+            pickle.dump(tinfo, f)
 
 
 if __name__ == '__main__':
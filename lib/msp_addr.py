@@ -18,7 +18,7 @@ def mask_bw(a, bw):
 # address must be even
 def read_bw(state, a, bw):
     if bw == 0:
-        return model.mk_read16(state.read8)(a)
+        return state.read16(a)
     else:
         return state.read8(a)
 
@@ -26,7 +26,7 @@ def read_bw(state, a, bw):
 # address must be even
 def write_bw(state, a, x, bw):
     if bw == 0:
-        model.mk_write16(state.write8)(a, x)
+        state.write16(a, x)
     else:
         state.write8(a, x)
 
@@ -87,8 +87,8 @@ def set_fmt1_dst(ins, dmode, n, keepreading, mk_writefields, a_bitval,
     # otherwise there could be loopy issues
     readfields_src = ins.readfields
 
-    def readfields_wrapper(state):
-        fields = readfields_src(state)
+    def readfields_wrapper(state, decoded = None):
+        fields = readfields_src(state, decoded)
         keepreading(ins, state, fields)
         return fields
 
@@ -115,10 +115,10 @@ def set_fmt2_src(ins, smode, n, mk_readfields, mk_writefields, a_bitval,
 # more convenience things for addressing modes
 
 def mk_readfields_cg(ins, keepreading):
-    def readfields(state):
-        fields = instr.decode_cg(ins, state)
-        if 'cgsrc' in fields:
-            fields['src'] = fields['cgsrc']
+    def readfields(state, decoded = None):
+        fields = instr.decode_cg(ins, state, decoded)
+        if fields.cgsrc is not None:
+            fields.src = fields.cgsrc
             return fields
         else:
             keepreading(state, fields)
@@ -126,19 +126,22 @@ def mk_readfields_cg(ins, keepreading):
     return readfields
 
 def compute_and_read_addr(suffix, state, fields, offset = 0, offset_key = None):
-    iname = 'i' + suffix
-    aname = 'a' + suffix
-    name = suffix
-    instr.read_another_word(state, fields)
-    fields[iname] = fields['words'][-1]
+    iaddr = instr.read_another_word(state, fields)
     # the idea is that we only read the fields AFTER we've invoked read_another_word
     if offset_key is None:
         k_offset = 0
     else:
-        k_offset = fields[offset_key]
+        k_offset = getattr(fields, offset_key)
     # getting the rounding behavior right here is actually tricky
-    addr = (fields[iname] + offset + k_offset) & 0xffff
+    addr = (iaddr + offset + k_offset) & 0xffff
     # for now, assume we're in the lower 64k and we clear bits 19:16
-    fields[aname] = mask_bw(addr, fields['bw'])
-    fields[name] = read_bw(state, fields[aname], fields['bw'])
+    addr = mask_bw(addr, fields.bw)
+    if suffix == 'src':
+        fields.isrc = iaddr
+        fields.asrc = addr
+        fields.src = read_bw(state, addr, fields.bw)
+    else:
+        fields.idst = iaddr
+        fields.adst = addr
+        fields.dst = read_bw(state, addr, fields.bw)
     return
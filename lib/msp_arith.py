@@ -1,7 +1,7 @@
 # msp430 shared arithmetic logic
 
 def howmanybits(fields):
-    bw = fields['bw']
+    bw = fields.bw
     if bw == 0:
         return 16
     elif bw == 1:
@@ -43,6 +43,18 @@ def pack_sr(sr_fields):
     sr_v |= sr_fields['reserved'] << i
     return sr_v
 
+# The flags live at fixed bits of the packed SR, so instructions set them
+# there directly instead of splitting SR up with unpack_sr and putting it back
+# together with pack_sr.
+sr_c = 1 << 0
+sr_z = 1 << 1
+sr_n = 1 << 2
+sr_v = 1 << 8
+sr_flags = sr_c | sr_z | sr_n | sr_v
+
+def set_flags(sr, c, z, n, v):
+    return (sr & ~sr_flags) | c | (z << 1) | (n << 2) | (v << 8)
+
 # needs a truncated result
 def nbit(result_t, bits):
     if twocomp(result_t, bits) < 0:
@@ -94,30 +106,28 @@ def vbit_xor(src, dst, result_t, bits):
     else:
         return 0
 
-# arith_fn(src, dst, sr_fields)
+# arith_fn(src, dst, c), where c is the carry flag going in
 # vbit_fn(src, dst, result_t, bits)
 def execute_arith(fields, arith_fn, vbit_fn, 
                   write_dst = True, alt_cbit = False, clr_vbit = False):
     bits = howmanybits(fields)
-    src = trunc_bits(fields['src'], bits)
-    dst = trunc_bits(fields['dst'], bits)
-    sr_fields = unpack_sr(fields['sr'])
-    assert(fields['sr'] == pack_sr(sr_fields)) #TODO
-    result = arith_fn(src, dst, sr_fields)
+    src = trunc_bits(fields.src, bits)
+    dst = trunc_bits(fields.dst, bits)
+    sr = fields.sr
+    result = arith_fn(src, dst, sr & sr_c)
     result_t = trunc_bits(result, bits)
-    sr_fields['n'] = nbit(result_t, bits)
-    sr_fields['z'] = zbit(result_t)
+    z = zbit(result_t)
     if alt_cbit:
-        sr_fields['c'] = (1 if sr_fields['z'] == 0 else 0)
+        c = z ^ 1
     else:
-        sr_fields['c'] = cbit(result, bits)
+        c = cbit(result, bits)
     if clr_vbit:
-        sr_fields['v'] = 0
+        v = 0
     else:
-        sr_fields['v'] = vbit_fn(src, dst, result_t, bits)
+        v = vbit_fn(src, dst, result_t, bits)
     if write_dst:
-        fields['dst'] = result_t
-    fields['sr'] = pack_sr(sr_fields)
+        fields.dst = result_t
+    fields.sr = set_flags(sr, c, z, nbit(result_t, bits), v)
     return
 
 # BCD math
@@ -143,16 +153,12 @@ def mk_bcd_add(bits):
         return from_bcd(to_bcd(x, bits) + to_bcd(y, bits), bits)
     return bcd_add
 
-# arith_fn(src, sr_fields)
+# arith_fn(src, c)
 def execute_shift(fields, arith_fn):
     bits = howmanybits(fields)
-    src = trunc_bits(fields['src'], bits)
-    sr_fields = unpack_sr(fields['sr'])
-    result_t = arith_fn(src, sr_fields)
-    sr_fields['n'] = nbit(result_t, bits)
-    sr_fields['z'] = zbit(result_t)
-    sr_fields['c'] = src & 1
-    sr_fields['v'] = 0
-    fields['src'] = result_t
-    fields['sr'] = pack_sr(sr_fields)
+    src = trunc_bits(fields.src, bits)
+    sr = fields.sr
+    result_t = arith_fn(src, sr & sr_c)
+    fields.src = result_t
+    fields.sr = set_flags(sr, src & 1, zbit(result_t), nbit(result_t, bits), 0)
     return
@@ -48,12 +48,22 @@ class Ministate(object):
                 mem[addr] = byte
             return
 
+        def read16(addr):
+            return read8(addr) | (read8(addr + 1) << 8)
+
+        def write16(addr, word):
+            write8(addr, word & 0xff)
+            write8(addr + 1, (word >> 8) & 0xff)
+            return
+
         self.regs = regs
         self.mem = mem
         self.readreg = readreg
         self.writereg = writereg
         self.read8 = read8
         self.write8 = write8
+        self.read16 = read16
+        self.write16 = write16
 
         for i in range(len(memvals)):
             if iswords:
@@ -6,6 +6,7 @@ import msp_fr5969_model as model
 import msp_elftools as elftools
 from msp_isa import isa
 import msp_instr as instr
+import msp_timing as timing
 
 class BasicBlock(object):
     def __init__(self, addr, verbosity = 0):
@@ -72,18 +73,13 @@ class CFG(object):
     def __init__(self, fname, verbosity = 0):
         self.verbosity = verbosity
         self.state = model.Model()
-        self.read16 = model.mk_read16(self.state.read8)
+        self.read16 = self.state.read16
 
         # TODO: alternative to readfields that doesn't always crash?
-        for addr in range(0, model.ram_start, 2):
-            self.state.mmio_handle_default(addr, initial_value = 0xff)
-            self.state.mmio_handle_default(addr+1, initial_value = 0x3f)
-        for addr in range(model.ram_start+model.ram_size, model.fram_start, 2):
-            self.state.mmio_handle_default(addr, initial_value = 0xff)
-            self.state.mmio_handle_default(addr+1, initial_value = 0x3f)
-        for addr in range(model.fram_start+model.fram_size, model.fram_start+model.fram_size+16, 2):
-            self.state.mmio_handle_default(addr, initial_value = 0xff)
-            self.state.mmio_handle_default(addr+1, initial_value = 0x3f)
+        self.state.mmio_handle_pattern(0, model.ram_start, [0xff, 0x3f])
+        self.state.mmio_handle_pattern(model.ram_start+model.ram_size,
+                                       model.fram_start - (model.ram_start+model.ram_size), [0xff, 0x3f])
+        self.state.mmio_handle_pattern(model.fram_start+model.fram_size, 16, [0xff, 0x3f])
 
         if self.verbosity >= 1:
             print('loading {:s}'.format(fname))
@@ -444,6 +440,13 @@ class CFG(object):
         # TODO: support multiple vectors
         self.entrypoint = entrypoint
 
+    # The timing summary of every basic block under the timing model tinfo,
+    # by block address (see msp_timing.summarize). Each one covers the whole
+    # block, including the jump or call that ends it. Needs build_graph.
+    def timing_summaries(self, tinfo):
+        return {addr : timing.summarize(tinfo, block.instrs)
+                for addr, block in self.block_table.items()}
+
     def check_instrs(self):
         pc = self.read16(model.resetvec)
         word = self.read16(pc)
@@ -2,6 +2,9 @@
 
 import utils
 
+# memory is diffed in chunks of this many bytes
+mem_align = 8
+
 class Cosim(object):
     def __init__(self, drivers, is_physical, mmap):
         if len(drivers) != len(is_physical):
@@ -9,6 +12,15 @@ class Cosim(object):
         self.is_physical = {drivers[i] : is_physical[i] for i in range(len(drivers))}
         self.drivers = drivers
         self.mmap = mmap
+        # If every driver is an emulator, they track the pages they write (see
+        # Model.mark), so once the drivers are known to agree on memory, a diff
+        # only has to look at what any of them has written since. marks holds
+        # each driver's mark from the last time they agreed, or None if they
+        # haven't yet (which is always the case with physical drivers).
+        self.tracking = not any(is_physical)
+        self.marks = None
+        # the last diff, and the marks taken right after it
+        self.last_diff = None
 
     def diff(self):
         diff = {}
@@ -16,14 +28,53 @@ class Cosim(object):
         if len(regdiff) > 0:
             diff['regs'] = regdiff
         for addr, size in self.mmap:
-            mems = [driver.md(addr, size) for driver in self.drivers]
-            chunks = utils.diff_memory(mems, addr)
-            utils.is_diff_real(addr, mems, chunks)
-            # assumes no overlap
-            for k in chunks:
-                diff[k] = chunks[k]
+            for diff_addr, diff_size in self._diff_ranges(addr, size):
+                mems = [driver.md(diff_addr, diff_size) for driver in self.drivers]
+                chunks = utils.diff_memory(mems, diff_addr, align=mem_align)
+                utils.is_diff_real(diff_addr, mems, chunks)
+                # assumes no overlap
+                for k in chunks:
+                    diff[k] = chunks[k]
+        if self.tracking:
+            marks = [driver.mark() for driver in self.drivers]
+            if not any(k != 'regs' for k in diff):
+                self.marks = marks
+            self.last_diff = (diff, marks)
         return diff
-        
+
+    # The parts of [addr, addr+size) where the drivers' memory could differ:
+    # all of it, unless they agreed at self.marks, in which case just what any
+    # of them has changed since. Parts are widened to whole chunks, counted
+    # from addr, and merged when they touch, so diffing them finds the same
+    # chunks as diffing the whole range.
+    def _diff_ranges(self, addr, size):
+        if self.marks is None:
+            return [(addr, size)]
+        end = addr + size
+        spans = []
+        for driver, mark in zip(self.drivers, self.marks):
+            for lo, n in driver.changed(mark, addr, size):
+                spans.append((addr + ((lo - addr) // mem_align) * mem_align,
+                              min(end, addr + ((lo + n - addr + mem_align - 1) // mem_align) * mem_align)))
+        spans.sort()
+        ranges = []
+        for lo, hi in spans:
+            if ranges and lo <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], hi)
+            else:
+                ranges.append([lo, hi])
+        return [(lo, hi - lo) for lo, hi in ranges]
+
+    # Is diff the last one taken, with nothing written to memory since?
+    def _is_current(self, diff):
+        if self.last_diff is None or diff is not self.last_diff[0]:
+            return False
+        for driver, mark in zip(self.drivers, self.last_diff[1]):
+            for addr, size in self.mmap:
+                if driver.changed(mark, addr, size):
+                    return False
+        return True
+
     # regs and memory
     def sync(self, master_idx, diff = None):
         # print('\n\n')
@@ -31,6 +82,8 @@ class Cosim(object):
         if diff is None:
             # print('no diff provided, getting')
             diff = self.diff()
+        # syncing a current diff leaves the drivers agreeing
+        current = self.tracking and self._is_current(diff)
         # utils.print_dict(diff)
         # utils.explain_diff(diff)
         # print('\n\n')
@@ -51,6 +104,9 @@ class Cosim(object):
                         regions = diff[addr]
                         driver.mw(addr, regions[master_idx])
 
+        if current:
+            self.marks = [driver.mark() for driver in self.drivers]
+
         # afterdiff = self.diff()
         # if len(afterdiff) > 0:
         #     print('why is there still a diff?')
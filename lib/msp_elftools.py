@@ -263,10 +263,9 @@ def load(state, fname, restore_regs = True, verbosity = 0):
                     print('Writing {:5d} bytes at {:05x} [section: {:s}]{:s}...'.format(
                         size, addr, section['name'], vdesc))
 
-                for i in range(min(size, len(data))):
-                    state.write8(addr + i, data[i])
-                for i in range(max(0, size - len(data))):
-                    state.write8(addr + i, 0)
+                state.write_bytes(addr, data[:size])
+                if size > len(data):
+                    state.write_bytes(addr, bytes(size - len(data)))
 
     if verbosity >= 3:
         print('loaded state:')
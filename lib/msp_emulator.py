@@ -3,18 +3,231 @@
 import utils
 import msp_base as base
 import msp_fr5969_model as model
+import msp_events as events
 import msp_peripheral_timer as peripheral_timer
+import msp_peripheral_watchdog as peripheral_watchdog
 import msp_reference_timing as reference_timing
+import msp_timing as timing
 import msp_elftools as elftools
-import smt
+import msp_translate as translator
+import msp_itable
 from msp_isa import isa
 
+# Execution profiles. Each one builds a step function for one combination of
+# tracing and timing, with everything it needs bound up front, so the step
+# itself doesn't check which features are on. Tracing is fixed when the model is
+# created, so a profile has to match it; timing can be left off for a run even
+# if the emulator has a timer.
+
+# The decode cache skips the opcode read, so it is only used when that read
+# doesn't need to show up in the iotrace; the model drops entries when their
+# first word is written. Entries hold the handlers msp_itable specialized for
+# the instruction word (see Emulator._decode), and the timing memo for the
+# instruction (see Emulator._timer_cached), which goes with them.
+def mk_step_bare(mulator):
+    regs = mulator.state.regs
+    icache = mulator.state.icache
+    decode = mulator._decode
+    def step():
+        pc = regs[0]
+        entry = icache.get(pc)
+        if entry is None:
+            entry = decode(pc)
+        ins, readfields, execute, writefields, word, costs = entry
+        fields = readfields()
+        execute(fields)
+        writefields(fields)
+        # halt
+        return word != 0x3fff
+    return step
+
+def mk_step_timed(mulator):
+    regs = mulator.state.regs
+    icache = mulator.state.icache
+    decode = mulator._decode
+    timer_cached = mulator._timer_cached
+    elapse = mulator.events.elapse
+    def step():
+        pc = regs[0]
+        entry = icache.get(pc)
+        if entry is None:
+            entry = decode(pc)
+        ins, readfields, execute, writefields, word, costs = entry
+        fields = readfields()
+        execute(fields)
+        writefields(fields)
+        elapse(timer_cached(costs, ins, fields))
+        return word != 0x3fff
+    return step
+
+# TODO: iotrace should probably work in a reasonable way
+# right now we have two lists of io traces, one which includes all io, even not
+# from instruction execution, and a second one in iotrace2 which is only
+# io events from actually executing instructions
+def mk_step_traced(mulator):
+    state = mulator.state
+    fetch = mulator._fetch
+    iotrace = mulator.iotrace
+    iotrace2 = mulator.iotrace2
+    trace_fields = mulator.trace_fields
+    iotrace_next = model.iotrace_next
+    # tracing is slow anyway; this is the only thing left to check
+    verbose = mulator.verbosity >= 2
+    def step():
+        pc = state.readreg(0)
+        ins, word = fetch(pc)
+        iotrace_next(iotrace)
+        fields = ins.readfields(state)
+        trace_fields.append(fields)
+        if verbose:
+            print(utils.describe_regs(mulator.regs()))
+            ins.describe()
+            utils.print_dict(fields.to_dict())
+        ins.execute(fields)
+        ins.writefields(state, fields)
+        # remember the thing we just added to our iotrace, and make a dummy to intercept
+        # non-execution IO before the next instruction
+        iotrace2.append(iotrace[-1])
+        iotrace_next(iotrace)
+        if verbose:
+            print('----')
+        return word != 0x3fff
+    return step
+
+def mk_step_traced_timed(mulator):
+    state = mulator.state
+    fetch = mulator._fetch
+    iotrace = mulator.iotrace
+    iotrace2 = mulator.iotrace2
+    trace_fields = mulator.trace_fields
+    iotrace_next = model.iotrace_next
+    timer_update = mulator._timer_update
+    elapse = mulator.events.elapse
+    verbose = mulator.verbosity >= 2
+    def step():
+        pc = state.readreg(0)
+        ins, word = fetch(pc)
+        iotrace_next(iotrace)
+        fields = ins.readfields(state)
+        trace_fields.append(fields)
+        if verbose:
+            print(utils.describe_regs(mulator.regs()))
+            ins.describe()
+            utils.print_dict(fields.to_dict())
+        ins.execute(fields)
+        ins.writefields(state, fields)
+        iotrace2.append(iotrace[-1])
+        iotrace_next(iotrace)
+        elapse(timer_update(ins, fields))
+        if verbose:
+            print('----')
+        return word != 0x3fff
+    return step
+
+# Each profile also has a loop(max_steps, steps, stop) that runs until a halt
+# (returning True), or until max_steps (if positive) instructions have been
+# counted in steps[0] or the pc is in the set stop (returning False). For the
+# untraced profiles the step is written out inside the loop, so there's no call
+# per instruction; the traced ones just call their step.
+def mk_loop_bare(mulator):
+    regs = mulator.state.regs
+    icache = mulator.state.icache
+    decode = mulator._decode
+    def loop(max_steps, steps, stop):
+        n = steps[0]
+        try:
+            while True:
+                pc = regs[0]
+                entry = icache.get(pc)
+                if entry is None:
+                    entry = decode(pc)
+                ins, readfields, execute, writefields, word, costs = entry
+                fields = readfields()
+                execute(fields)
+                writefields(fields)
+                if word == 0x3fff:
+                    return True
+                n += 1
+                if n == max_steps or regs[0] in stop:
+                    return False
+        finally:
+            steps[0] = n
+    return loop
+
+def mk_loop_timed(mulator):
+    regs = mulator.state.regs
+    icache = mulator.state.icache
+    decode = mulator._decode
+    timer_cached = mulator._timer_cached
+    elapse = mulator.events.elapse
+    def loop(max_steps, steps, stop):
+        n = steps[0]
+        try:
+            while True:
+                pc = regs[0]
+                entry = icache.get(pc)
+                if entry is None:
+                    entry = decode(pc)
+                ins, readfields, execute, writefields, word, costs = entry
+                fields = readfields()
+                execute(fields)
+                writefields(fields)
+                elapse(timer_cached(costs, ins, fields))
+                if word == 0x3fff:
+                    return True
+                n += 1
+                if n == max_steps or regs[0] in stop:
+                    return False
+        finally:
+            steps[0] = n
+    return loop
+
+def mk_loop_stepped(mulator):
+    regs = mulator.state.regs
+    step = mulator.step
+    def loop(max_steps, steps, stop):
+        while step():
+            steps[0] += 1
+            if steps[0] == max_steps or regs[0] in stop:
+                return False
+        return True
+    return loop
+
+# name : (traced, timed, step builder, loop builder)
+profiles = {
+    'bare'         : (False, False, mk_step_bare,         mk_loop_bare),
+    'timed'        : (False, True,  mk_step_timed,        mk_loop_timed),
+    'traced'       : (True,  False, mk_step_traced,       mk_loop_stepped),
+    'traced_timed' : (True,  True,  mk_step_traced_timed, mk_loop_stepped),
+}
+
+def default_profile(tracing, timing):
+    for name, (traced, timed, _, _) in profiles.items():
+        if traced == tracing and timed == timing:
+            return name
+
+# Status codes for step_n and run_until, which report how a run ended instead
+# of raising.
+status_steps = 0        # ran the requested number of steps
+status_pc = 1           # reached a pc in the stop set
+status_halt = 2         # executed a halt (0x3fff)
+status_touchdown = 3    # halted on the touchdown pad that ends a test program
+status_error = 4        # ExecuteError
+status_unknown = 5      # UnknownBehavior
+status_breakpoint = 6   # Breakpoint
+status_names = ['steps', 'pc', 'halt', 'touchdown', 'error', 'unknown', 'breakpoint']
+
+# seven halts and then a jump back over them
+touchdown_pad = [0xff, 0x3f] * 7 + [0xf8, 0x3f]
+no_stop = frozenset()
+
 class Emulator(object):
-    def __init__(self, tracing = False, tinfo = None, verbosity = 0):
+    def __init__(self, tracing = False, tinfo = None, translate = True, verbosity = 0):
         self.tracing = tracing
-        self.trace = []
+        self.trace_fields = []
         self.iotrace = model.iotrace_init()
         self.iotrace2 = []
+        self.last_snapshot = None
         self.verbosity = verbosity
 
         if tracing:
@@ -29,41 +242,68 @@ class Emulator(object):
             self.timing = True
             self._timer_default()
             self.timer_state_default = None
-            self.timer_ttab = []
-            self.timer_stab = []
+            self.timer_tables = None
             self._timer_reset()
         else:
             self.timing = True
             self._timer_default()
-            self.timer_state_default = tinfo['state_default']
-            self.timer_ttab = tinfo['ttab']
-            self.timer_stab = tinfo['stab']
+            # compiled into flat tables up front, unless the model was loaded
+            # as tables already (see msp_timing)
+            self.timer_tables = timing.compile_tables(tinfo)
+            self.timer_state_default = self.timer_tables.state_default
             self._timer_reset()
 
+        # straight-line code is compiled into blocks by run(), unless we're tracing
+        if translate and not tracing:
+            self.translator = translator.Translator(self, verbosity=verbosity)
+        else:
+            self.translator = None
+
+        self.profile = None
+        self.step = None
+        self.loop = None
+        self.last_exception = None
+        self.use_profile(default_profile(self.tracing, self.timing))
+
         if self.verbosity >= 3:
             print('created {:s}'.format(str(self)))
             self.state.dump()
 
     def _mmio_default(self):
-        # watchdog (unimplemented)
-        for addr in [0x15c, 0x15d]:
-            self.state.mmio_handle_default(addr)
+        # watchdog (without timing, nothing counts)
+        self.state.mmio_handle_default(0x15c, size=2)
         # timerA (unimplemented)
-        for addr in [0x0340, 0x0341, 0x0342, 0x0343, 0x0350, 0x0351, 0x0352, 0x0353]:
-            self.state.mmio_handle_default(addr)
+        self.state.mmio_handle_default(0x0340, size=4)
+        self.state.mmio_handle_default(0x0350, size=4)
 
     def _timer_default(self):
-        # watchdog (unimplemented)
-        for addr in [0x15c, 0x15d]:
-            self.state.mmio_handle_default(addr)
+        # peripherals schedule what they do in the event queue, and raise
+        # interrupts through the controller
+        self.events = events.Event_Queue()
+        self.interrupts = events.Interrupt_Controller(self.state, self.events, self._timer_interrupt)
+        # call out to watchdog module
+        self.watchdog = peripheral_watchdog.Peripheral_Watchdog(self.events, puc=self._puc)
+        self.watchdog.attach_watchdog(self.state)
         # call out to timer module
-        self.timer_A = peripheral_timer.Peripheral_Timer()
+        self.timer_A = peripheral_timer.Peripheral_Timer(self.events)
         self.timer_A.attach_timer(self.state, peripheral_timer.timer_A_base)
 
+    # A power up clear, from the watchdog: the cpu starts again at the reset
+    # vector with SR cleared, and the timer is reset. The watchdog resets
+    # itself.
+    def _puc(self):
+        self.timer_A.reset()
+        self.state.writereg(2, 0)
+        self.reset()
+
     def _timer_reset(self):
         self.timer_cycles = 0
         self.timer_state = self.timer_state_default
 
+    # interrupt entry takes cycles without running an instruction
+    def _timer_interrupt(self, cycles):
+        self.timer_cycles = self.timer_cycles + cycles
+
     def _timer_update(self, ins, fields):
         # cycles = None
         # iname = smt.smt_iname(ins)
@@ -88,35 +328,13 @@ class Emulator(object):
         # assert cycles is not None and cycles >= 0
         # self.timer_state = self.timer_stab[self.timer_state, iname]
         
-        if self.timer_ttab or self.timer_stab:
-            iname = smt.smt_iname(ins)
-            rsname = smt.ext_smt_rsrc(fields)
-            rdname = smt.ext_smt_rdst(fields)
-
-            cycles = self.timer_ttab[self.timer_state, iname, rsname, rdname]
-
-            if cycles is None and (ins.name in {'BIC', 'BIS'} and
-                                   ins.smode in {'@Rn', '@Rn+'} and
-                                   ins.dmode in {'Rn'} and
-                                   rsname in {smt.smt_rnames[2], smt.smt_rnames[3]} and
-                                   rdname in {smt.smt_rnames[2]}):
-                cycles = 1
-
-            if cycles is None:
-                raise base.UnknownBehavior('missing timer entry for {:d} {:s} {:s} {:s}'
-                                           .format(self.timer_state, iname, rsname, rdname))
-            new_state = self.timer_stab[self.timer_state, iname, rsname, rdname]
-
-            if new_state is None and (ins.name in {'BIC', 'BIS'} and
-                                   ins.smode in {'@Rn', '@Rn+'} and
-                                   ins.dmode in {'Rn'} and
-                                   rsname in {smt.smt_rnames[2], smt.smt_rnames[3]} and
-                                   rdname in {smt.smt_rnames[2]}):
-                new_state = 0
-
-            if new_state is None:
-                raise base.UnknownBehavior('missing timer state transition for {:d} {:s} {:s} {:s}'
-                                           .format(self.timer_state, iname, rsname, rdname))
+        tables = self.timer_tables
+        if tables is not None:
+            i = tables.index(self.timer_state, ins, fields)
+            cycles = tables.cycles[i]
+            new_state = tables.next_states[i]
+            if cycles < 0 or new_state < 0:
+                tables.missing(self.timer_state, ins, fields)
         else:
             # use reference
             cycles = reference_timing.reference_time(ins, fields)
@@ -126,8 +344,54 @@ class Emulator(object):
         self.timer_cycles = self.timer_cycles + cycles
         return cycles
 
+    # The cycles an instruction takes, and the state it leaves the timing
+    # model in, only depend on the instruction and the state it starts in, so
+    # they're memoized per instruction, in costs, by starting state. Whoever
+    # owns costs throws it away along with the instruction when the code is
+    # written (the decode cache entry, or the translated block).
+    def _timer_cached(self, costs, ins, fields):
+        cost = costs.get(self.timer_state)
+        if cost is None:
+            state = self.timer_state
+            cycles = self._timer_update(ins, fields)
+            costs[state] = (cycles, self.timer_state)
+            return cycles
+        cycles, self.timer_state = cost
+        self.timer_cycles = self.timer_cycles + cycles
+        return cycles
+
+    # The records are kept as they are and only turned into dicts when asked for,
+    # since execute and writefields keep filling them in after they're appended.
+    # This builds a new list of dicts every time; for just the number of steps
+    # traced, use len(trace_fields).
+    def trace_dicts(self):
+        return [fields.to_dict() for fields in self.trace_fields]
+
+    # Snapshots capture registers, memory, peripherals and timer state (but not
+    # the traces). Memory pages that haven't changed since the last snapshot are
+    # shared with it. A snapshot can be restored any number of times, into the
+    # emulator that took it.
+    def snapshot(self):
+        if self.last_snapshot is None:
+            state_snap = self.state.snapshot()
+        else:
+            state_snap = self.state.snapshot(prev=self.last_snapshot[0])
+        if self.timing:
+            timer_snap = (self.timer_state, self.timer_cycles)
+        else:
+            timer_snap = None
+        snap = (state_snap, timer_snap)
+        self.last_snapshot = snap
+        return snap
+
+    def restore(self, snap):
+        state_snap, timer_snap = snap
+        self.state.restore(state_snap)
+        if timer_snap is not None:
+            self.timer_state, self.timer_cycles = timer_snap
+
     def reset(self):
-        reset_pc = model.mk_read16(self.state.read8)(model.resetvec)
+        reset_pc = self.state.read16(model.resetvec)
         self.state.writereg(0, reset_pc)
 
     def load(self, fname, restore_regs = True):
@@ -147,112 +411,146 @@ class Emulator(object):
 
     def mw(self, addr, pattern):
         # print('emulator invoking mw {:05x} '.format(addr), utils.makehex(pattern))
-        for i in range(len(pattern)):
-            self.state.write8(addr + i, pattern[i])
+        self.state.write_bytes(addr, pattern)
         # utils.printhex([self.state.read8(i) for i in range(addr, addr+len(pattern))])
 
     def fill(self, addr, size, pattern):
-        for i in range(size):
-            self.state.write8(addr + i, pattern[i%len(pattern)])
+        self.state.write_bytes(addr, (pattern * (size // len(pattern) + 1))[:size])
 
     def setreg(self, register, value):
         self.state.writereg(register, value)
 
     def md(self, addr, size):
         # print('emulator invoking md {:05x} {:d}'.format(addr, size))
-        memreads = [self.state.read8(i) for i in range(addr, addr+size)]
+        memreads = self.state.read_bytes(addr, size)
         # utils.printhex(memreads[:16])
         return memreads
 
     def regs(self):
         return [self.state.readreg(i) for i in range(len(self.state.regs))]
 
-    def step(self):
-        pc = self.state.readreg(0)
-        word = model.mk_read16(self.state.read8)(pc)
+    # dirty page tracking, so a Cosim of emulators only diffs what changed
+    # (see Model.mark)
+    def mark(self):
+        return self.state.mark()
+
+    def changed(self, mark, addr, size):
+        return self.state.changed_ranges(mark, addr, size)
+
+    def _fetch(self, pc):
+        word = self.state.read16(pc)
         ins = isa.decode(word)
-        
         if ins is None:
             raise base.ExecuteError('failed to decode {:#04x} ( PC: {:05x})'.format(word, pc))
-
-        # TODO: iotrace should probably work in a reasonable way
-        # right now we have two lists of io traces, one which includes all io, even not
-        # from instruction execution, and a second one in self.iotrace2 which is only
-        # io events from actually executing instructions
-        if self.tracing:
-            model.iotrace_next(self.iotrace)
-
-        fields = ins.readfields(self.state)
-
-        if self.tracing:
-            self.trace.append(fields)
-            if self.verbosity >= 2:
-                print(utils.describe_regs(self.regs()))
-                ins.describe()
-                utils.print_dict(fields)
-
-        ins.execute(fields)
-        ins.writefields(self.state, fields)
-
-        # remember the thing we just added to our iotrace, and make a dummy to intercept
-        # non-execution IO before the next instruction
-        if self.tracing:
-            self.iotrace2.append(self.iotrace[-1])
-            model.iotrace_next(self.iotrace)
-
-
-            # # manual breakpoints / watchpoints
-
-            # step_io = self.iotrace2[-1]
-            # for addr, value in step_io['w']['mem']:
-            #     if addr >= 0xfffe:
-            #         print(hex(pc))
-            #         utils.print_dict(step_io)
-            #         raise base.Breakpoint('manual')
-
-            # if pc == 0xfe84:
-            #     print(hex(pc))
-            #     raise base.Breakpoint('manual')
-
-            # # end
-
-        # update the timer if we're doing that
-        if self.timing:
-            cycles = self._timer_update(ins, fields)
-            self.timer_A.elapse(cycles)
-
-        if self.tracing and self.verbosity >= 2:
-            print('----')
-
-        if word == 0x3fff:
-            # halt
-            return False
-        else:
-            return True
-            
-    def run(self, max_steps = 0):
-        steps = 0
+        return ins, word
+
+    # decode the instruction at pc into a decode cache entry, for the untraced profiles
+    def _decode(self, pc):
+        ins, word = self._fetch(pc)
+        handlers = self.state.handlers.get(word)
+        if handlers is None:
+            handlers = msp_itable.specialize(ins, word, self.state)
+            self.state.handlers[word] = handlers
+        entry = (ins,) + handlers + (word, {})
+        self.state.icache[pc] = entry
+        return entry
+
+    # Bind self.step to the named profile, which stays selected until another
+    # one is picked.
+    def use_profile(self, name):
+        if name not in profiles:
+            raise ValueError('unknown execution profile {:s}'.format(repr(name)))
+        traced, timed, mk_step, mk_loop = profiles[name]
+        if traced != self.tracing or (timed and not self.timing):
+            raise ValueError('execution profile {:s} does not fit this emulator (tracing {}, timing {})'
+                             .format(name, self.tracing, self.timing))
+        if name != self.profile:
+            self.profile = name
+            self.step = mk_step(self)
+            self.loop = mk_loop(self)
+            if self.translator is not None:
+                self.translator.set_timing(timed)
+
+    # Run under the given profile, or whichever one is selected (by default,
+    # the one that matches how the emulator was created).
+    def run(self, max_steps = 0, profile = None):
+        if profile is not None:
+            self.use_profile(profile)
+        # counted in place, so the steps taken before an exception are not lost
+        steps = [0]
         try:
-            while self.step():
-                steps += 1
-                if max_steps > 0 and steps >= max_steps:
-                    break
+            if self.translator is None:
+                self.loop(max_steps, steps, no_stop)
+            else:
+                self.translator.run(max_steps, steps)
+            success = True
+        except (base.ExecuteError, base.UnknownBehavior, base.Breakpoint) as e:
+            success = self.report(e)
+        else:
             success = True
+        return success, steps[0]
+
+    # Run n instructions, or until something stops execution first. Returns
+    # (status, steps); see the status codes above.
+    def step_n(self, n):
+        return self.run_until(None, max_steps=n)
+
+    # Run until the pc reaches an address in pc_set (not counting the one we
+    # start at), a halt, an error, or max_steps (if positive) instructions.
+    # Returns (status, steps) without raising; the exception behind an
+    # error or breakpoint status is kept in last_exception.
+    def run_until(self, pc_set, max_steps = 0, profile = None):
+        if profile is not None:
+            self.use_profile(profile)
+        if pc_set:
+            stop = frozenset(pc_set)
+        else:
+            stop = no_stop
+        steps = [0]
+        try:
+            if self.translator is None:
+                halted = self.loop(max_steps, steps, stop)
+            else:
+                halted = self.translator.run(max_steps, steps, stop)
         except base.ExecuteError as e:
+            self.last_exception = e
+            return status_error, steps[0]
+        except base.UnknownBehavior as e:
+            self.last_exception = e
+            return status_unknown, steps[0]
+        except base.Breakpoint as e:
+            self.last_exception = e
+            return status_breakpoint, steps[0]
+
+        if halted:
+            return self.halt_status(), steps[0]
+        elif self.state.regs[0] in stop:
+            return status_pc, steps[0]
+        else:
+            return status_steps, steps[0]
+
+    # whether the halt we're sitting on is the start of the touchdown pad
+    def halt_status(self):
+        pc = self.state.regs[0]
+        if self.state.read_bytes(pc, len(touchdown_pad)) == touchdown_pad:
+            return status_touchdown
+        else:
+            return status_halt
+
+    # print an exception that stopped execution, and say whether that counts as success
+    def report(self, e):
+        if isinstance(e, base.ExecuteError):
             if self.verbosity >= 0:
                 print('Execution Error: {:s}'.format(str(e)))
-            success = False
-        except base.UnknownBehavior as e:
+            return False
+        elif isinstance(e, base.UnknownBehavior):
             if self.verbosity >= 0:
                 print('Unknown Behavior: {:s}'.format(str(e)))
-            success = False
-        except base.Breakpoint as e:
+            return False
+        else:
             if self.verbosity >= 0:
                 print('Breakpoint: {:s}'.format(str(e)))
-            success = True
-        else:
-            success = True
-        return success, steps
+            return True
 
 if __name__ == '__main__':
     import sys
@@ -273,7 +571,7 @@ if __name__ == '__main__':
     success, steps = mulator.run(max_steps = 100000)
     print('Success: {}, steps: {:d}'.format(success, steps))
 
-    print(len(mulator.trace))
+    print(len(mulator.trace_fields))
     print(len(mulator.iotrace2))
 
     if not outname is None:
@@ -0,0 +1,162 @@
+# msp430 scheduled events and interrupts
+
+# Peripherals don't do anything on every cycle. Each one that has something
+# coming up (a timer reaching its limit, say) works out the cycle it will happen
+# at and schedules itself for that cycle in the event queue. The emulator only
+# tells the queue how many cycles each instruction took, and all that costs per
+# instruction is one comparison against the earliest scheduled cycle; only when
+# that cycle has come do the peripherals get called, in cycle order, and
+# afterwards the interrupt controller looks for a request to take.
+
+import heapq
+
+import msp_base as base
+import msp_fr5969_model as model
+import msp_instr as instr
+
+never = float('inf')
+
+# SR bits
+GIE = 0x8
+SCG0 = 0x40
+
+# cycles from the end of the interrupted instruction to the first instruction
+# of the handler
+interrupt_latency = 6
+
+class Event_Queue(object):
+    def __init__(self):
+        self.now = 0
+        self.next_event = never
+        # (cycle, seq, source), ordered by cycle and then by when it was
+        # scheduled; only the entry in due for a source is current, the rest
+        # are left in the heap and dropped when they get to the top
+        self.heap = []
+        self.due = {}
+        self.seq = 0
+        self.interrupts = None
+
+    # Call source.event(now) once now >= cycle, where now is the cycle the
+    # elapse that got there will end at. Replaces anything the source already
+    # had scheduled; a cycle of None (or never) just cancels it.
+    def schedule(self, source, cycle):
+        if cycle is None or cycle == never:
+            if self.due.pop(source, None) is None:
+                return
+        else:
+            self.seq += 1
+            entry = (cycle, self.seq, source)
+            self.due[source] = entry
+            heapq.heappush(self.heap, entry)
+        self._refresh()
+
+    def _refresh(self):
+        heap = self.heap
+        due = self.due
+        while heap and due.get(heap[0][2]) is not heap[0]:
+            heapq.heappop(heap)
+        if heap:
+            self.next_event = heap[0][0]
+        else:
+            self.next_event = never
+
+    # have the interrupt controller look for requests at the next elapse
+    def poll(self):
+        if self.interrupts is not None:
+            self.schedule(self.interrupts, self.now)
+
+    # How many cycles can elapse before anything happens, or None if nothing
+    # will. Negative if even elapsing 0 cycles would set something off.
+    def headroom(self):
+        if self.next_event == never:
+            return None
+        return self.next_event - self.now - 1
+
+    # Returns True if an interrupt or reset happened, so the pc isn't where
+    # the instruction that just finished left it.
+    def elapse(self, cycles):
+        now = self.now + cycles
+        if now >= self.next_event:
+            return self._fire(now)
+        self.now = now
+        return False
+
+    # A source that raises stays scheduled, and now doesn't move. Any source
+    # that hasn't scheduled itself again by the time its event returns is
+    # taken off the queue. An event returns True if it moved the pc (a reset).
+    def _fire(self, now):
+        moved = False
+        while self.next_event <= now:
+            entry = self.heap[0]
+            if entry[2].event(now):
+                moved = True
+            if self.due.get(entry[2]) is entry:
+                self.schedule(entry[2], None)
+        self.now = now
+        if self.interrupts is not None and self.interrupts.check():
+            return True
+        return moved
+
+# Interrupt sources have requests(), the vector numbers (counting up from
+# model.ivec_start, so a higher number is a higher priority) of the interrupts
+# they want taken, and acknowledge(n), which is called as the CPU takes one.
+# A source whose requests change outside its own events calls queue.poll().
+class Interrupt_Controller(object):
+    def __init__(self, state, queue, account = None):
+        self.state = state
+        self.queue = queue
+        # called with the cycles taken up by each interrupt entry, so the
+        # emulator can count them too
+        self.account = account
+        self.sources = []
+        queue.interrupts = self
+
+    def attach(self, source):
+        self.sources.append(source)
+
+    # nothing to do as an event; check runs after every round of events
+    def event(self, now):
+        return
+
+    # the highest priority request, as (vector number, source), or None
+    def pending(self):
+        best = None
+        for source in self.sources:
+            for n in source.requests():
+                if best is None or n > best[0]:
+                    best = (n, source)
+        return best
+
+    # Take the highest priority request, if there is one and GIE is set.
+    # Otherwise it stays pending, and we look again after every instruction
+    # until it's taken or withdrawn. Returns True if one was taken.
+    def check(self):
+        best = self.pending()
+        if best is None:
+            return False
+        state = self.state
+        sr = state.readreg(2)
+        if not sr & GIE:
+            self.queue.poll()
+            return False
+        n, source = best
+        if not (0 <= n < model.ivec_count):
+            raise base.ExecuteError('interrupt vector {:d} out of range'.format(n))
+        source.acknowledge(n)
+        # anything else waits at least until the handler sets GIE again
+        if self.pending() is not None:
+            self.queue.poll()
+        pc = state.readreg(0)
+        sp = state.readreg(1)
+        # the high bits of a 20-bit pc go in the top of the SR word (see RETI)
+        sp = instr.regadd(sp, -2)
+        state.write16(sp, pc & 0xffff)
+        sp = instr.regadd(sp, -2)
+        state.write16(sp, ((pc >> 4) & 0xf000) | (sr & 0x0fff))
+        state.writereg(1, sp)
+        state.writereg(2, sr & SCG0)
+        state.writereg(0, state.read16(model.ivec_start + 2 * n))
+        self.queue.now += interrupt_latency
+        if self.account is not None:
+            self.account(interrupt_latency)
+        return True
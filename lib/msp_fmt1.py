@@ -5,6 +5,7 @@ import msp_base as base
 import msp_instr as instr
 import msp_addr as addr
 import msp_arith as arith
+import msp_fr5969_model as model
 
 # source modes
 
@@ -12,23 +13,23 @@ def mk_readfields_src_Rn(ins):
     def keepreading(state, fields):
         # Reading the PC is weird.
         # It might actually be cleaner to dynamically write the pc inside readfields? I don't know.
-        rn = fields['rsrc']
+        rn = fields.rsrc
         if rn == 0:
-            fields['src'] = instr.readpc(ins, fields)
+            fields.src = instr.readpc(ins, fields)
         else:
-            fields['src'] = state.readreg(rn)
+            fields.src = state.readreg(rn)
         return
     return addr.mk_readfields_cg(ins, keepreading)
 
 def mk_readfields_src_idx(ins):
     def keepreading(state, fields):
-        addr.compute_and_read_addr('src', state, fields, offset=state.readreg(fields['rsrc']))
+        addr.compute_and_read_addr('src', state, fields, offset=state.readreg(fields.rsrc))
         return
     return addr.mk_readfields_cg(ins, keepreading)
 
 def mk_readfields_src_sym(ins):
-    def readfields(state):
-        fields = instr.decode_fields(ins, state)
+    def readfields(state, decoded = None):
+        fields = instr.decode_fields(ins, state, decoded)
         # I think the value of the pc will be "correct" here, as determined
         # by consistent use of read_another_word
         # JK!!! There was an off by 1 (well, one word, so use offset of -2)
@@ -37,8 +38,8 @@ def mk_readfields_src_sym(ins):
     return readfields
 
 def mk_readfields_src_abs(ins):
-    def readfields(state):
-        fields = instr.decode_fields(ins, state)
+    def readfields(state, decoded = None):
+        fields = instr.decode_fields(ins, state, decoded)
         addr.compute_and_read_addr('src', state, fields)
         return fields
     return readfields
@@ -50,34 +51,33 @@ def mk_readfields_src_cg1(ins):
 
 def mk_readfields_src_ind(ins):
     def keepreading(state, fields):
-        fields['asrc'] = addr.mask_bw(state.readreg(fields['rsrc']), fields['bw'])
-        fields['src'] = addr.read_bw(state, fields['asrc'], fields['bw'])
+        fields.asrc = addr.mask_bw(state.readreg(fields.rsrc), fields.bw)
+        fields.src = addr.read_bw(state, fields.asrc, fields.bw)
         return
     return addr.mk_readfields_cg(ins, keepreading)
 
 def mk_readfields_src_ai(ins):
     def keepreading(state, fields):
-        fields['asrc'] = state.readreg(fields['rsrc'])
+        fields.asrc = state.readreg(fields.rsrc)
         # you have to be careful to read from the masked address, but update the true one
-        effective_addr = addr.mask_bw(fields['asrc'], fields['bw'])
-        fields['src'] = addr.read_bw(state, effective_addr, fields['bw'])
+        effective_addr = addr.mask_bw(fields.asrc, fields.bw)
+        fields.src = addr.read_bw(state, effective_addr, fields.bw)
         # mutate the incremented register in place
         # for some reason, the SP is incremented by two even in byte mode...
         # also wrapping?
-        if fields['bw'] == 0 or fields['rsrc'] == 1:
+        if fields.bw == 0 or fields.rsrc == 1:
             offset = 2
         else:
             offset = 1
-        state.writereg(fields['rsrc'], instr.regadd(fields['asrc'], offset))
+        state.writereg(fields.rsrc, instr.regadd(fields.asrc, offset))
         return
     return addr.mk_readfields_cg(ins, keepreading)
 
 def mk_readfields_src_N(ins):
-    def readfields(state):
-        fields = instr.decode_fields(ins, state)
-        instr.read_another_word(state, fields)
-        fields['isrc'] = fields['words'][-1]
-        fields['src'] = fields['isrc']
+    def readfields(state, decoded = None):
+        fields = instr.decode_fields(ins, state, decoded)
+        fields.isrc = instr.read_another_word(state, fields)
+        fields.src = fields.isrc
         return fields
     return readfields
 
@@ -85,46 +85,46 @@ def mk_readfields_src_N(ins):
 
 def keepreading_dst_Rn(ins, state, fields):
     # Reading the PC is still weird.
-    rn = fields['rdst']
+    rn = fields.rdst
     if rn == 0:
-        fields['dst'] = instr.readpc(ins, fields)
+        fields.dst = instr.readpc(ins, fields)
     else:
-        fields['dst'] = state.readreg(rn)
+        fields.dst = state.readreg(rn)
     return
 
 def mk_writefields_dst_Rn(ins):
     def writefields_dst_Rn(state, fields):
         # special check for some PC-related behavior
-        if fields['rdst'] == 0:
-            if fields['bw'] == 1 and ins.name not in {'CMP', 'BIT'}:
+        if fields.rdst == 0:
+            if fields.bw == 1 and ins.name not in {'CMP', 'BIT'}:
                 raise base.UnknownBehavior('fmt1 .B to PC')
             elif ins.name not in {'CMP', 'BIT', 'MOV'}:
                 raise base.UnknownBehavior('fmt1 arithmetic not supported on PC (PUSH bug)')
             # we do permit BR
-            # elif fields['dst'] != fields['pc']:
+            # elif fields.dst != fields.pc:
             #     raise base.UnknownBehavior('fmt1 indirect control flow: pc {:05x}, indirect to {:05x}'
-            #                                .format(fields['pc'], fields['dst']))
+            #                                .format(fields.pc, fields.dst))
         # and for writes to unmodeled SR bits
-        elif fields['rdst'] == 2:
-            if fields['dst'] & ((~271) & 0xfffff) != 0:
-                raise base.UnknownBehavior('fmt1 invalid SR write: {:05x}'.format(fields['dst']))
-        state.writereg(0, fields['pc'])
-        state.writereg(fields['rdst'], fields['dst'])
+        elif fields.rdst == 2:
+            if fields.dst & ((~271) & 0xfffff) != 0:
+                raise base.UnknownBehavior('fmt1 invalid SR write: {:05x}'.format(fields.dst))
+        state.writereg(0, fields.pc)
+        state.writereg(fields.rdst, fields.dst)
         if not instr.is_sr_safe(ins):
-            state.writereg(2, fields['sr'])
+            state.writereg(2, fields.sr)
         return
     return writefields_dst_Rn
 
 def keepreading_dst_idx(ins, state, fields):
-    addr.compute_and_read_addr('dst', state, fields, offset=state.readreg(fields['rdst']))
+    addr.compute_and_read_addr('dst', state, fields, offset=state.readreg(fields.rdst))
     return
 
 def mk_writefields_dst_idx(ins):
     def writefields_dst_idx(state, fields):
-        if fields['rdst'] == 3:
+        if fields.rdst == 3:
             raise base.UnknownBehavior('fmt1 dst X(R3)')
         instr.write_pc_sr(state, fields)
-        addr.write_bw(state, fields['adst'], fields['dst'], fields['bw'])
+        addr.write_bw(state, fields.adst, fields.dst, fields.bw)
         return
     return writefields_dst_idx
 
@@ -136,7 +136,7 @@ def keepreading_dst_sym(ins, state, fields):
 def mk_writefields_dst_sym(ins):
     def writefields_dst_sym(state, fields):
         instr.write_pc_sr(state, fields)
-        addr.write_bw(state, fields['adst'], fields['dst'], fields['bw'])
+        addr.write_bw(state, fields.adst, fields.dst, fields.bw)
         return
     return writefields_dst_sym
 
@@ -151,19 +151,19 @@ mk_writefields_dst_abs = mk_writefields_dst_sym
 
 def execute_mov(fields):
     bits = arith.howmanybits(fields)
-    result = fields['src']
-    fields['dst'] = arith.trunc_bits(result, bits)
+    result = fields.src
+    fields.dst = arith.trunc_bits(result, bits)
     return
 
 def execute_add(fields):
     arith.execute_arith(fields,
-                        lambda src, dst, sr_fields: dst + src,
+                        lambda src, dst, c: dst + src,
                         arith.vbit_add)
     return
 
 def execute_addc(fields):
     arith.execute_arith(fields,
-                        lambda src, dst, sr_fields: dst + src + sr_fields['c'],
+                        lambda src, dst, c: dst + src + c,
                         arith.vbit_add)
     return
 
@@ -171,21 +171,21 @@ def execute_addc(fields):
 def execute_sub(fields):
     bits = arith.howmanybits(fields)
     arith.execute_arith(fields,
-                        lambda src, dst, sr_fields: arith.trunc_bits(~src, bits) + 1 + dst,
+                        lambda src, dst, c: arith.trunc_bits(~src, bits) + 1 + dst,
                         arith.vbit_sub)
     return
 
 def execute_subc(fields):
     bits = arith.howmanybits(fields)
     arith.execute_arith(fields,
-                        lambda src, dst, sr_fields: arith.trunc_bits(~src, bits) + sr_fields['c'] + dst,
+                        lambda src, dst, c: arith.trunc_bits(~src, bits) + c + dst,
                         arith.vbit_sub)
     return
 
 def execute_cmp(fields):
     bits = arith.howmanybits(fields)
     arith.execute_arith(fields,
-                        lambda src, dst, sr_fields: arith.trunc_bits(~src, bits) + 1 + dst,
+                        lambda src, dst, c: arith.trunc_bits(~src, bits) + 1 + dst,
                         arith.vbit_sub,
                         write_dst=False)
     return
@@ -193,44 +193,286 @@ def execute_cmp(fields):
 def execute_dadd(fields):
     # requires BCD math
     raise base.UnknownBehavior('execute dadd')
-    if fields['bw'] == 1:
+    if fields.bw == 1:
         local_bcd_add = arith.mk_bcd_add(8)
     else:
         local_bcd_add = arith.mk_bcd_add(16)
     arith.execute_arith(fields,
-                        lambda src, dst, sr_fields: local_bcd_add(src, dst),
+                        lambda src, dst, c: local_bcd_add(src, dst),
                         arith.vbit_add) # accodring to the manual, vbit is undefined, this is almost certainly wrong
     return
 
 def execute_bit(fields):
     arith.execute_arith(fields,
-                        lambda src, dst, sr_fields: dst & src,
+                        lambda src, dst, c: dst & src,
                         None,
                         write_dst=False, alt_cbit=True, clr_vbit=True)
     return
 
 def execute_bic(fields):
     bits = arith.howmanybits(fields)
-    result = (~fields['src']) & fields['dst']
-    fields['dst'] = arith.trunc_bits(result, bits)
+    result = (~fields.src) & fields.dst
+    fields.dst = arith.trunc_bits(result, bits)
     return
 
 def execute_bis(fields):
     bits = arith.howmanybits(fields)
-    result = fields['src'] | fields['dst']
-    fields['dst'] = arith.trunc_bits(result, bits)
+    result = fields.src | fields.dst
+    fields.dst = arith.trunc_bits(result, bits)
     return
 
 def execute_xor(fields):
     arith.execute_arith(fields,
-                        lambda src, dst, sr_fields: dst ^ src,
+                        lambda src, dst, c: dst ^ src,
                         arith.vbit_xor,
                         alt_cbit=True)
     return
 
 def execute_and(fields):
     arith.execute_arith(fields,
-                        lambda src, dst, sr_fields: dst & src,
+                        lambda src, dst, c: dst & src,
                         None,
                         alt_cbit=True, clr_vbit=True)
     return
+
+# Specialized handlers. msp_itable.specialize builds these for one instruction
+# word (so the registers, as / ad and bw are known) and one untraced model,
+# with every check the functions above make on those bits resolved up front.
+# Source and destination readers take the fields after decoding and fill them
+# in; writers replace writefields. They make the same accesses, in the same
+# order, and raise the same errors as the general versions.
+
+def spec_read_bw(state, bw):
+    if bw == 0:
+        return state.read16
+    else:
+        return state.read8
+
+def spec_write_bw(state, bw):
+    if bw == 0:
+        return state.write16
+    else:
+        return state.write8
+
+def spec_mask_bw(bw):
+    if bw == 0:
+        return instr.pc_bitmask
+    else:
+        return model.reg_bitmask
+
+def mk_spec_src_Rn(ins, f, state):
+    regs = state.regs
+    rsrc = f['rsrc']
+    if rsrc == 0:
+        length = ins.length
+        def read_src(fields):
+            fields.src = (fields.old_pc + length) & instr.pc_bitmask
+    else:
+        def read_src(fields):
+            fields.src = regs[rsrc]
+    return read_src
+
+def mk_spec_src_idx(ins, f, state, sp_offset = 0):
+    regs = state.regs
+    read16 = state.read16
+    read = spec_read_bw(state, f['bw'])
+    mask = spec_mask_bw(f['bw'])
+    rsrc = f['rsrc']
+    def read_src(fields):
+        offset = (regs[rsrc] + sp_offset) & model.reg_bitmask
+        pc = fields.pc
+        iaddr = read16(pc)
+        fields.pc = (pc + 2) & instr.pc_bitmask
+        a = ((iaddr + offset) & 0xffff) & mask
+        fields.isrc = iaddr
+        fields.asrc = a
+        fields.src = read(a)
+    return read_src
+
+def mk_spec_src_sym(ins, f, state):
+    read16 = state.read16
+    read = spec_read_bw(state, f['bw'])
+    mask = spec_mask_bw(f['bw'])
+    def read_src(fields):
+        pc = fields.pc
+        iaddr = read16(pc)
+        pc = (pc + 2) & instr.pc_bitmask
+        fields.pc = pc
+        a = ((iaddr - 2 + pc) & 0xffff) & mask
+        fields.isrc = iaddr
+        fields.asrc = a
+        fields.src = read(a)
+    return read_src
+
+def mk_spec_src_abs(ins, f, state):
+    read16 = state.read16
+    read = spec_read_bw(state, f['bw'])
+    mask = spec_mask_bw(f['bw'])
+    def read_src(fields):
+        pc = fields.pc
+        iaddr = read16(pc)
+        fields.pc = (pc + 2) & instr.pc_bitmask
+        a = (iaddr & 0xffff) & mask
+        fields.isrc = iaddr
+        fields.asrc = a
+        fields.src = read(a)
+    return read_src
+
+def mk_spec_src_ind(ins, f, state):
+    regs = state.regs
+    read = spec_read_bw(state, f['bw'])
+    mask = spec_mask_bw(f['bw'])
+    rsrc = f['rsrc']
+    def read_src(fields):
+        a = regs[rsrc] & mask
+        fields.asrc = a
+        fields.src = read(a)
+    return read_src
+
+def mk_spec_src_ai(ins, f, state, offset = None):
+    regs = state.regs
+    writereg = state.writereg
+    read = spec_read_bw(state, f['bw'])
+    mask = spec_mask_bw(f['bw'])
+    rsrc = f['rsrc']
+    if offset is None:
+        if f['bw'] == 0 or rsrc == 1:
+            offset = 2
+        else:
+            offset = 1
+    if offset == 0:
+        def read_src(fields):
+            a = regs[rsrc]
+            fields.asrc = a
+            fields.src = read(a & mask)
+    else:
+        def read_src(fields):
+            a = regs[rsrc]
+            fields.asrc = a
+            fields.src = read(a & mask)
+            writereg(rsrc, (a + offset) & model.reg_bitmask)
+    return read_src
+
+def mk_spec_src_N(ins, f, state):
+    read16 = state.read16
+    def read_src(fields):
+        pc = fields.pc
+        isrc = read16(pc)
+        fields.pc = (pc + 2) & instr.pc_bitmask
+        fields.isrc = isrc
+        fields.src = isrc
+    return read_src
+
+# only ever used with the constant generator
+def mk_spec_src_cg1(ins, f, state):
+    def read_src(fields):
+        raise base.UnknownBehavior('tried to keep reading after decoding cg for cg1 mode')
+    return read_src
+
+def mk_spec_dst_Rn(ins, f, state):
+    regs = state.regs
+    rdst = f['rdst']
+    if rdst == 0:
+        length = ins.length
+        def read_dst(fields):
+            fields.dst = (fields.old_pc + length) & instr.pc_bitmask
+    else:
+        def read_dst(fields):
+            fields.dst = regs[rdst]
+    return read_dst
+
+def mk_spec_dst_idx(ins, f, state):
+    regs = state.regs
+    read16 = state.read16
+    read = spec_read_bw(state, f['bw'])
+    mask = spec_mask_bw(f['bw'])
+    rdst = f['rdst']
+    def read_dst(fields):
+        offset = regs[rdst]
+        pc = fields.pc
+        iaddr = read16(pc)
+        fields.pc = (pc + 2) & instr.pc_bitmask
+        a = ((iaddr + offset) & 0xffff) & mask
+        fields.idst = iaddr
+        fields.adst = a
+        fields.dst = read(a)
+    return read_dst
+
+def mk_spec_dst_sym(ins, f, state):
+    read16 = state.read16
+    read = spec_read_bw(state, f['bw'])
+    mask = spec_mask_bw(f['bw'])
+    def read_dst(fields):
+        pc = fields.pc
+        iaddr = read16(pc)
+        pc = (pc + 2) & instr.pc_bitmask
+        fields.pc = pc
+        a = ((iaddr - 2 + pc) & 0xffff) & mask
+        fields.idst = iaddr
+        fields.adst = a
+        fields.dst = read(a)
+    return read_dst
+
+def mk_spec_dst_abs(ins, f, state):
+    read16 = state.read16
+    read = spec_read_bw(state, f['bw'])
+    mask = spec_mask_bw(f['bw'])
+    def read_dst(fields):
+        pc = fields.pc
+        iaddr = read16(pc)
+        fields.pc = (pc + 2) & instr.pc_bitmask
+        a = (iaddr & 0xffff) & mask
+        fields.idst = iaddr
+        fields.adst = a
+        fields.dst = read(a)
+    return read_dst
+
+# for bits that always make writefields raise
+def mk_spec_raise(msg):
+    def write(fields):
+        raise base.UnknownBehavior(msg)
+    return write
+
+def mk_spec_write_dst_Rn(ins, f, state):
+    writereg = state.writereg
+    rdst = f['rdst']
+    sr_safe = instr.is_sr_safe(ins)
+    if rdst == 0:
+        if f['bw'] == 1 and ins.name not in {'CMP', 'BIT'}:
+            return mk_spec_raise('fmt1 .B to PC')
+        elif ins.name not in {'CMP', 'BIT', 'MOV'}:
+            return mk_spec_raise('fmt1 arithmetic not supported on PC (PUSH bug)')
+    if rdst == 2:
+        def write(fields):
+            if fields.dst & ((~271) & 0xfffff) != 0:
+                raise base.UnknownBehavior('fmt1 invalid SR write: {:05x}'.format(fields.dst))
+            writereg(0, fields.pc)
+            writereg(2, fields.dst)
+            if not sr_safe:
+                writereg(2, fields.sr)
+    elif sr_safe:
+        def write(fields):
+            writereg(0, fields.pc)
+            writereg(rdst, fields.dst)
+    else:
+        def write(fields):
+            writereg(0, fields.pc)
+            writereg(rdst, fields.dst)
+            writereg(2, fields.sr)
+    return write
+
+def mk_spec_write_dst_sym(ins, f, state):
+    writereg = state.writereg
+    write_bw = spec_write_bw(state, f['bw'])
+    def write(fields):
+        writereg(0, fields.pc)
+        writereg(2, fields.sr)
+        write_bw(fields.adst, fields.dst)
+    return write
+
+mk_spec_write_dst_abs = mk_spec_write_dst_sym
+
+def mk_spec_write_dst_idx(ins, f, state):
+    if f['rdst'] == 3:
+        return mk_spec_raise('fmt1 dst X(R3)')
+    return mk_spec_write_dst_sym(ins, f, state)
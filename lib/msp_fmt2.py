@@ -25,7 +25,7 @@ mk_readfields_src_cg1 = fmt1.mk_readfields_src_cg1
 
 def mk_readfields_src_idx_push_call(ins):
     def keepreading(state, fields):
-        rsrc = fields['rsrc']
+        rsrc = fields.rsrc
         offset = state.readreg(rsrc)
         if rsrc == 1:
             offset = instr.regadd(offset, -2)
@@ -38,19 +38,19 @@ def mk_readfields_src_idx_push_call(ins):
 
 def mk_readfields_src_ai_push_call(ins):
     def keepreading(state, fields):
-        fields['asrc'] = state.readreg(fields['rsrc'])
+        fields.asrc = state.readreg(fields.rsrc)
         # you have to be careful to read from the masked address, but update the true one
-        effective_addr = addr.mask_bw(fields['asrc'], fields['bw'])
-        fields['src'] = addr.read_bw(state, effective_addr, fields['bw'])
+        effective_addr = addr.mask_bw(fields.asrc, fields.bw)
+        fields.src = addr.read_bw(state, effective_addr, fields.bw)
         # mutate the incremented register in place.
         # PUSH and CALL just drop the sp write you'd expect from ai mode, and do their
         # normal stack pointer manipulation as if @SP mode had been used instead of @SP+.
-        if fields['rsrc'] != 1:
-            if fields['bw'] == 0:
+        if fields.rsrc != 1:
+            if fields.bw == 0:
                 offset = 2
             else:
                 offset = 1
-            state.writereg(fields['rsrc'], instr.regadd(fields['asrc'], offset))
+            state.writereg(fields.rsrc, instr.regadd(fields.asrc, offset))
         return
     return addr.mk_readfields_cg(ins, keepreading)
 
@@ -58,24 +58,24 @@ def mk_readfields_src_ai_push_call(ins):
 
 def mk_writefields_src_Rn(ins):
     def writefields_src_Rn(state, fields):
-        if fields['rsrc'] in {0,2}:
+        if fields.rsrc in {0,2}:
             raise base.UnknownBehavior('fmt2 write to R{:d} unsupported'
-                                       .format(fields['rsrc']))
-        state.writereg(0, fields['pc'])
-        state.writereg(fields['rsrc'], fields['src'])
+                                       .format(fields.rsrc))
+        state.writereg(0, fields.pc)
+        state.writereg(fields.rsrc, fields.src)
         if not instr.is_sr_safe(ins):
-            state.writereg(2, fields['sr'])
+            state.writereg(2, fields.sr)
         return
     return writefields_src_Rn
 
 def mk_writefields_src_idx(ins):
     def writefields_src_idx(state, fields):
-        if 'cgsrc' in fields:
+        if fields.cgsrc is not None:
             raise base.UnknownBehavior('cg unsupported for fmt2')
         instr.write_pc_sr(state, fields)
         # I don't think the funny business with X(R3) can occur here because this isn't
         # really a destination mode
-        addr.write_bw(state, fields['asrc'], fields['src'], fields['bw'])
+        addr.write_bw(state, fields.asrc, fields.src, fields.bw)
         return
     return writefields_src_idx
 
@@ -100,37 +100,33 @@ def mk_writefields_src_cg1(ins):
 def execute_rrc(fields):
     bits = arith.howmanybits(fields)
     arith.execute_shift(fields,
-                        lambda src, sr_fields: ((src >> 1) & (~(1 << (bits-1)))) | (sr_fields['c'] << (bits-1)))
+                        lambda src, c: ((src >> 1) & (~(1 << (bits-1)))) | (c << (bits-1)))
     return
 
 def execute_swpb(fields):
-    if fields['bw'] != 0:
-        raise base.UnknownBehavior('swpb bw={:d}'.format(fields['bw']))
+    if fields.bw != 0:
+        raise base.UnknownBehavior('swpb bw={:d}'.format(fields.bw))
     bits = 16
-    src = arith.trunc_bits(fields['src'], bits)
+    src = arith.trunc_bits(fields.src, bits)
     result_t = ((src & 0xff) << 8) | ((src >> 8) & 0xff)
-    fields['src'] = result_t
+    fields.src = result_t
     return
 
 def execute_rra(fields):
     bits = arith.howmanybits(fields)
     arith.execute_shift(fields,
-                        lambda src, sr_fields: ((src >> 1) & (~(1 << (bits-1)))) | (src & (1 << (bits-1))))
+                        lambda src, c: ((src >> 1) & (~(1 << (bits-1)))) | (src & (1 << (bits-1))))
     return
 
 def execute_sxt(fields):
-    if fields['bw'] != 0:
-        raise base.UnknownBehavior('sxt bw={:d}'.format(fields['bw']))
+    if fields.bw != 0:
+        raise base.UnknownBehavior('sxt bw={:d}'.format(fields.bw))
     bits = 8
     extbits = 16
-    sr_fields = arith.unpack_sr(fields['sr'])
-    result_t = arith.sxt_bits(fields['src'], bits, extbits)
-    sr_fields['n'] = arith.nbit(result_t, extbits)
-    sr_fields['z'] = arith.zbit(result_t)
-    sr_fields['c'] = 1 ^ sr_fields['z']
-    sr_fields['v'] = 0
-    fields['src'] = result_t
-    fields['sr'] = arith.pack_sr(sr_fields)
+    result_t = arith.sxt_bits(fields.src, bits, extbits)
+    z = arith.zbit(result_t)
+    fields.src = result_t
+    fields.sr = arith.set_flags(fields.sr, 1 ^ z, z, arith.nbit(result_t, extbits), 0)
     return
 
 # special execution logic, which goes in writefields
@@ -139,7 +135,7 @@ def execute_push(fields):
     return
 def mk_writefields_push(ins):
     def writefields_push(state, fields):
-        if ins.smode not in {'Rn'} and fields['rsrc'] in {1}:
+        if ins.smode not in {'Rn'} and fields.rsrc in {1}:
             raise base.UnknownBehavior('PUSH indirect through SP unsupported')
         instr.write_pc_sr(state, fields)
         # I think this sp manipulation does the right thing
@@ -148,8 +144,8 @@ def mk_writefields_push(ins):
         # We have to truncate the source to 8 bits somewhere... might be better to
         # eventually change this to happen in readfields.
         bits = arith.howmanybits(fields)
-        src = arith.trunc_bits(fields['src'], bits)
-        addr.write_bw(state, sp, src, fields['bw'])
+        src = arith.trunc_bits(fields.src, bits)
+        addr.write_bw(state, sp, src, fields.bw)
         return
     return writefields_push
 
@@ -158,40 +154,140 @@ def execute_call(fields):
 
 def mk_writefields_call(ins):
     def writefields_call(state, fields):
-        if ins.smode in {'Rn'} and fields['rsrc'] in {0,1,2,3}:
-            raise base.UnknownBehavior('unsupported: CALL R{:d}'.format(fields['rsrc']))
-        elif 'cgsrc' in fields:
+        if ins.smode in {'Rn'} and fields.rsrc in {0,1,2,3}:
+            raise base.UnknownBehavior('unsupported: CALL R{:d}'.format(fields.rsrc))
+        elif fields.cgsrc is not None:
             raise base.UnknownBehavior('CALL to CG value unsupported')
-        elif fields['rsrc'] in {1}:
+        elif fields.rsrc in {1}:
             raise base.UnknownBehavior('CALL indirect through SP unsupported')
         # I don't know what happens if, for example, the sp isn't word aligned...
         sp = instr.regadd(state.readreg(1), -2)
         state.writereg(1, sp)
         # What about the high bits of the pc ????
-        model.mk_write16(state.write8)(sp, fields['pc'])
-        state.writereg(0, fields['src'])
+        state.write16(sp, fields.pc)
+        state.writereg(0, fields.src)
         return
     return writefields_call
 
 def execute_reti(fields):
-    if fields['bw'] == 1:
+    if fields.bw == 1:
         raise base.UnknownBehavior('RETI.B == CALLA')
     return
 
 def mk_writefields_reti(ins):
     def writefields_reti(state, fields):
-        if not (ins.smode in {'Rn'} and fields['rsrc'] == 0):
+        if not (ins.smode in {'Rn'} and fields.rsrc == 0):
             raise base.UnknownBehavior('RETI only supported with Rn R0 mode')
-        read16 = model.mk_read16(state.read8)
         sp = state.readreg(1)
-        sr = read16(sp)
+        sr = state.read16(sp)
         sp = instr.regadd(sp, 2)
-        pc = read16(sp)
+        pc = state.read16(sp)
         sp = instr.regadd(sp, 2)
-        # some of pc is recovered from SR, but it's not really clear where
-        pc = pc | ((sr & 0xf000) << 16)
+        # bits 19:16 of the pc were saved in the top of the SR word
+        # (see msp_events.Interrupt_Controller)
+        pc = pc | ((sr & 0xf000) << 4)
         state.writereg(0, pc)
         state.writereg(1, sp)
-        state.writereg(2, sr)
+        state.writereg(2, sr & 0x0fff)
         return
     return writefields_reti
+
+# Specialized handlers (see the comment in msp_fmt1). Source readers are
+# shared with fmt1, apart from the PUSH / CALL special cases.
+
+mk_spec_src_Rn  = fmt1.mk_spec_src_Rn
+mk_spec_src_idx = fmt1.mk_spec_src_idx
+mk_spec_src_sym = fmt1.mk_spec_src_sym
+mk_spec_src_abs = fmt1.mk_spec_src_abs
+mk_spec_src_ind = fmt1.mk_spec_src_ind
+mk_spec_src_ai  = fmt1.mk_spec_src_ai
+mk_spec_src_N   = fmt1.mk_spec_src_N
+mk_spec_src_cg1 = fmt1.mk_spec_src_cg1
+
+def mk_spec_src_idx_push_call(ins, f, state):
+    if f['rsrc'] == 1:
+        return fmt1.mk_spec_src_idx(ins, f, state, sp_offset=-2)
+    else:
+        return fmt1.mk_spec_src_idx(ins, f, state)
+
+def mk_spec_src_ai_push_call(ins, f, state):
+    if f['rsrc'] == 1:
+        offset = 0
+    elif f['bw'] == 0:
+        offset = 2
+    else:
+        offset = 1
+    return fmt1.mk_spec_src_ai(ins, f, state, offset=offset)
+
+def mk_spec_write_src_Rn(ins, f, state):
+    writereg = state.writereg
+    rsrc = f['rsrc']
+    if rsrc in {0,2}:
+        return fmt1.mk_spec_raise('fmt2 write to R{:d} unsupported'.format(rsrc))
+    if instr.is_sr_safe(ins):
+        def write(fields):
+            writereg(0, fields.pc)
+            writereg(rsrc, fields.src)
+    else:
+        def write(fields):
+            writereg(0, fields.pc)
+            writereg(rsrc, fields.src)
+            writereg(2, fields.sr)
+    return write
+
+def mk_spec_write_src_idx(ins, f, state):
+    if f['cgsrc'] is not None:
+        return fmt1.mk_spec_raise('cg unsupported for fmt2')
+    writereg = state.writereg
+    write_bw = fmt1.spec_write_bw(state, f['bw'])
+    def write(fields):
+        writereg(0, fields.pc)
+        writereg(2, fields.sr)
+        write_bw(fields.asrc, fields.src)
+    return write
+
+mk_spec_write_src_sym = mk_spec_write_src_idx
+mk_spec_write_src_abs = mk_spec_write_src_idx
+mk_spec_write_src_ind = mk_spec_write_src_idx
+mk_spec_write_src_ai  = mk_spec_write_src_idx
+
+def mk_spec_write_src_N(ins, f, state):
+    return fmt1.mk_spec_raise('fmt2 dst #N')
+
+def mk_spec_write_src_cg1(ins, f, state):
+    return fmt1.mk_spec_raise('fmt2 dst cg1')
+
+def mk_spec_write_push(ins, f, state):
+    if ins.smode not in {'Rn'} and f['rsrc'] in {1}:
+        return fmt1.mk_spec_raise('PUSH indirect through SP unsupported')
+    regs = state.regs
+    writereg = state.writereg
+    write_bw = fmt1.spec_write_bw(state, f['bw'])
+    if f['bw'] == 0:
+        mask = 0xffff
+    else:
+        mask = 0xff
+    def write(fields):
+        writereg(0, fields.pc)
+        writereg(2, fields.sr)
+        sp = (regs[1] - 2) & model.reg_bitmask
+        writereg(1, sp)
+        write_bw(sp, fields.src & mask)
+    return write
+
+def mk_spec_write_call(ins, f, state):
+    if ins.smode in {'Rn'} and f['rsrc'] in {0,1,2,3}:
+        return fmt1.mk_spec_raise('unsupported: CALL R{:d}'.format(f['rsrc']))
+    elif f['cgsrc'] is not None:
+        return fmt1.mk_spec_raise('CALL to CG value unsupported')
+    elif f['rsrc'] in {1}:
+        return fmt1.mk_spec_raise('CALL indirect through SP unsupported')
+    regs = state.regs
+    writereg = state.writereg
+    write16 = state.write16
+    def write(fields):
+        sp = (regs[1] - 2) & model.reg_bitmask
+        writereg(1, sp)
+        write16(sp, fields.pc)
+        writereg(0, fields.src)
+    return write
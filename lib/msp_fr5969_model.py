@@ -35,12 +35,100 @@ def iotrace_next(trace):
 def iotrace_append(trace, rw, regmem, addr, value):
     trace[-1][rw][regmem].append((addr, value))
 
-def invoke_mmio(addr, v, handlers):
-    if addr in handlers:
-        return handlers[addr](v)
-    else:
+# MMIO is dispatched through a page table. Each page of the address space maps
+# to a device object with read8(addr) and write8(addr, byte) methods; a page
+# shared by several devices maps to a Split_Page, which dispatches again on the
+# offset within the page. Devices register whole ranges with Model.map_mmio.
+page_bits = 8
+page_size = 2 ** page_bits
+page_mask = page_size - 1
+
+# Devices also have snapshot() and restore(snap) methods, which save and
+# restore whatever state they keep (see Model.snapshot), and stable(addr),
+# which says whether reading addr keeps returning the same value until the
+# device is written (see msp_idle).
+class Unmapped(object):
+    def read8(self, addr):
         raise base.ExecuteError('Unmapped address: {:05x}'.format(addr))
 
+    def write8(self, addr, byte):
+        raise base.ExecuteError('Unmapped address: {:05x}'.format(addr))
+
+    def stable(self, addr):
+        return True
+
+    def snapshot(self):
+        return None
+
+    def restore(self, snap):
+        return
+
+unmapped = Unmapped()
+
+# plain storage with no side effects, initialized with a repeating pattern
+class Default_MMIO(object):
+    def __init__(self, start, size, pattern = [0]):
+        self.start = start
+        self.buf = [pattern[i % len(pattern)] for i in range(size)]
+
+    def read8(self, addr):
+        return self.buf[addr - self.start]
+
+    def write8(self, addr, byte):
+        self.buf[addr - self.start] = byte
+
+    def stable(self, addr):
+        return True
+
+    def snapshot(self):
+        return tuple(self.buf)
+
+    def restore(self, snap):
+        self.buf[:] = snap
+
+# a single byte served by handler functions; until both are set, accesses fall
+# through to whatever was mapped there before. Any state the handlers keep is
+# their own business, and isn't captured by snapshots.
+class Handler_MMIO(object):
+    def __init__(self, under):
+        self.under = under
+        self.read_handler = None
+        self.write_handler = None
+
+    def read8(self, addr):
+        if self.read_handler is None:
+            return self.under.read8(addr)
+        return self.read_handler(None)
+
+    def write8(self, addr, byte):
+        if self.write_handler is None:
+            return self.under.write8(addr, byte)
+        return self.write_handler(byte)
+
+    def stable(self, addr):
+        if self.read_handler is None:
+            return self.under.stable(addr)
+        return False
+
+    def snapshot(self):
+        return None
+
+    def restore(self, snap):
+        return
+
+class Split_Page(object):
+    def __init__(self, device):
+        self.devices = [device] * page_size
+
+    def read8(self, addr):
+        return self.devices[addr & page_mask].read8(addr)
+
+    def write8(self, addr, byte):
+        return self.devices[addr & page_mask].write8(addr, byte)
+
+    def stable(self, addr):
+        return self.devices[addr & page_mask].stable(addr)
+
 def mk_readreg(regs, trace = None):
     if trace is None:
         def readreg(r):
@@ -68,54 +156,106 @@ def mk_writereg(regs, trace = None):
             return
     return writereg
 
-def mk_read8(ram, fram, handlers, trace = None):
+# Memory is one flat bytearray indexed by address, and a parallel bytearray
+# classifies every address in the 20-bit space, so picking the region for an
+# access is a single index. Only addresses classified as region_mmio go through
+# the handler tables; the backing bytes for them are never used, so the
+# bytearray stops at the end of the highest RAM / FRAM address.
+mem_size = 2 ** reg_bits
+mem_top = max(ram_start + ram_size, fram_start + fram_size)
+
+region_mmio = 0
+region_ram = 1
+region_fram = 2
+
+def mk_regions():
+    regions = bytearray(mem_size)
+    regions[ram_start:ram_start+ram_size] = bytes([region_ram]) * ram_size
+    regions[fram_start:fram_start+fram_size] = bytes([region_fram]) * fram_size
+    return regions
+
+# the classification never changes, so every model shares one table
+region_table = mk_regions()
+# the pages backed by RAM / FRAM, which both start and end on page boundaries
+mem_pages = [page for page in range(mem_size >> page_bits) if region_table[page << page_bits]]
+
+# Memory as it is when a model is created: RAM full of halts, FRAM erased.
+# Every model starts as a copy of an image like this one, which is a single
+# memcpy of the backing store.
+def mk_blank_image():
+    image = bytearray(mem_top)
+    image[ram_start:ram_start+ram_size] = bytes([0xff, 0x3f]) * (ram_size // 2)
+    image[fram_start:fram_start+fram_size] = bytes([0xff]) * fram_size
+    return bytes(image)
+
+blank_image = mk_blank_image()
+
+def mk_read8(mem, regions, pages, trace = None):
     if trace is None:
         def read8(addr):
-            if ram_start <= addr and addr < ram_start + ram_size:
-                v = ram[addr - ram_start]
-            elif fram_start <= addr and addr < fram_start + fram_size:
-                v = fram[addr - fram_start]
+            if regions[addr]:
+                v = mem[addr]
             else:
-                v = invoke_mmio(addr, None, handlers)
+                v = pages[addr >> page_bits].read8(addr)
             #print('read {:05x} == {:02x}, notrace'.format(addr, v))
             return v
     else:
         def read8(addr):
-            if ram_start <= addr and addr < ram_start + ram_size:
-                v = ram[addr - ram_start]
-            elif fram_start <= addr and addr < fram_start + fram_size:
-                v = fram[addr - fram_start]
+            if regions[addr]:
+                v = mem[addr]
             else:
-                v = invoke_mmio(addr, None, handlers)
+                v = pages[addr >> page_bits].read8(addr)
             iotrace_append(trace, 'r', 'mem', addr, v)
             #print('read {:05x} == {:02x}, trace'.format(addr, v))
             return v
     return read8
 
-def mk_write8(ram, fram, handlers, trace = None):
+# icache, if given, is a dict of decoded instructions keyed by the address of
+# their first word; a write to either byte of that word drops the entry, so
+# self-modifying code is decoded again the next time it runs. Similarly,
+# code_watch maps byte addresses to the set of translated blocks (see
+# msp_translate) built from them, which are invalidated by any write that
+# changes the byte. Blocks are only built from RAM and FRAM.
+def invalidate_code(addr, byte, mem, code_watch):
+    if mem[addr] != byte:
+        for block in list(code_watch[addr]):
+            block.invalidate()
+
+# Stores to RAM and FRAM don't check the byte: the bytearray rejects anything
+# that isn't an int in range(256). They flag the page they land on in dirty
+# (see Model.mark).
+def mk_write8(mem, regions, pages, dirty, trace = None, icache = None, code_watch = None):
     if trace is None:
         def write8(addr, byte):
             #print('write {:05x} <- {:02x}, notrace'.format(addr, byte))
-            assert isinstance(byte, int) and 0 <= byte and byte < 2**mem_bits
-            if ram_start <= addr and addr < ram_start + ram_size:
-                ram[addr - ram_start] = byte
-            elif fram_start <= addr and addr < fram_start + fram_size:
-                fram[addr - fram_start] = byte
+            if icache:
+                icache.pop(addr, None)
+                icache.pop(addr - 1, None)
+            if regions[addr]:
+                if code_watch and addr in code_watch:
+                    invalidate_code(addr, byte, mem, code_watch)
+                mem[addr] = byte
+                dirty[addr >> page_bits] = 1
             else:
-                invoke_mmio(addr, byte, handlers)
-                return
+                assert isinstance(byte, int) and 0 <= byte and byte < 2**mem_bits
+                pages[addr >> page_bits].write8(addr, byte)
+            return
     else:
         def write8(addr, byte):
             #print('write {:05x} <- {:02x}, trace'.format(addr, byte))
             assert isinstance(byte, int) and 0 <= byte and byte < 2**mem_bits
             iotrace_append(trace, 'w', 'mem', addr, byte)
-            if ram_start <= addr and addr < ram_start + ram_size:
-                ram[addr - ram_start] = byte
-            elif fram_start <= addr and addr < fram_start + fram_size:
-                fram[addr - fram_start] = byte
+            if icache:
+                icache.pop(addr, None)
+                icache.pop(addr - 1, None)
+            if regions[addr]:
+                if code_watch and addr in code_watch:
+                    invalidate_code(addr, byte, mem, code_watch)
+                mem[addr] = byte
+                dirty[addr >> page_bits] = 1
             else:
-                invoke_mmio(addr, byte, handlers)
-                return
+                pages[addr >> page_bits].write8(addr, byte)
+            return
     return write8
 
 def mk_read16(read8):
@@ -134,39 +274,269 @@ def mk_write16(write8):
         return
     return write16
 
+# Native word access for the model. An aligned word in RAM / FRAM is read or
+# written directly (RAM and FRAM start on even addresses, so both bytes are in
+# the same region); anything else, including every access while tracing, is
+# split into two byte accesses, low byte first, so MMIO handlers and the
+# iotrace see exactly the same events as with mk_read16 / mk_write16.
+def mk_model_read16(mem, regions, read8, trace = None):
+    if trace is None:
+        def read16(addr):
+            if addr & 1 == 0 and regions[addr]:
+                return mem[addr] | (mem[addr+1] << 8)
+            else:
+                return read8(addr) | (read8(addr+1) << 8)
+    else:
+        read16 = mk_read16(read8)
+    return read16
+
+def mk_model_write16(mem, regions, dirty, write8, trace = None, icache = None, code_watch = None):
+    if trace is None:
+        def write16(addr, word):
+            if addr & 1 == 0 and regions[addr] and not (code_watch and (addr in code_watch or
+                                                                        addr+1 in code_watch)):
+                if icache:
+                    icache.pop(addr - 1, None)
+                    icache.pop(addr, None)
+                    icache.pop(addr + 1, None)
+                mem[addr] = word & 0xff
+                mem[addr+1] = (word >> 8) & 0xff
+                dirty[addr >> page_bits] = 1
+            else:
+                write8(addr, word & 0xff)
+                write8(addr+1, (word >> 8) & 0xff)
+            return
+    else:
+        write16 = mk_write16(write8)
+    return write16
+
 class Model(object):
-    def __init__(self, trace = None):
+    def __init__(self, trace = None, image = blank_image):
+        assert len(image) == mem_top
         self.regs = [0 for _ in range(reg_size)]
-        self.ram = [(0xff if i % 2 == 0 else 0x3f) for i in range(ram_size)]
-        self.fram = [0xff for _ in range(fram_size)]
+        self.mem = bytearray(image)
+        self.regions = region_table
+        # zero-copy windows onto the flat memory
+        self.ram = memoryview(self.mem)[ram_start:ram_start+ram_size]
+        self.fram = memoryview(self.mem)[fram_start:fram_start+fram_size]
+        self.trace = trace
+
+        self.pages = [unmapped] * (mem_size >> page_bits)
+        # everything that has been mapped, for snapshots
+        self.devices = []
+        # pc -> decoded instruction, filled in by the emulator
+        self.icache = {}
+        # instruction word -> handlers specialized for this model (see
+        # msp_itable.specialize), also filled in by the emulator
+        self.handlers = {}
+        # address -> translated blocks that depend on it
+        self.code_watch = {}
 
-        self.mmio_read = {}
-        self.mmio_write = {}
+        # Dirty page tracking: dirty flags the pages of RAM / FRAM written in
+        # the current epoch, and stamps holds the last earlier epoch each page
+        # was written in (or -1). A model starts in epoch 0, with whatever
+        # differs from the blank image already written.
+        self.dirty = bytearray(mem_top >> page_bits)
+        self.stamps = [-1] * (mem_top >> page_bits)
+        self.epoch = 0
+        if image is not blank_image:
+            for page in mem_pages:
+                lo = page << page_bits
+                if image[lo:lo+page_size] != blank_image[lo:lo+page_size]:
+                    self.dirty[page] = 1
 
         self.readreg = mk_readreg(self.regs, trace=trace) 
         self.writereg = mk_writereg(self.regs, trace=trace)
-        self.read8 = mk_read8(self.ram, self.fram, self.mmio_read, trace=trace)
-        self.write8 = mk_write8(self.ram, self.fram, self.mmio_write, trace=trace)
+        self.read8 = mk_read8(self.mem, self.regions, self.pages, trace=trace)
+        self.write8 = mk_write8(self.mem, self.regions, self.pages, self.dirty, trace=trace,
+                                icache=self.icache, code_watch=self.code_watch)
+        self.read16 = mk_model_read16(self.mem, self.regions, self.read8, trace=trace)
+        self.write16 = mk_model_write16(self.mem, self.regions, self.dirty, self.write8, trace=trace,
+                                        icache=self.icache, code_watch=self.code_watch)
+
+    # A new model with the same registers and RAM / FRAM contents, for using
+    # this one as a template: setting up an image once and cloning it costs
+    # one copy of the backing store per clone, instead of building a model and
+    # writing the image into it again. MMIO devices belong to whoever mapped
+    # them, and aren't carried over, and neither are the caches.
+    def clone(self, trace = None):
+        state = Model(trace=trace)
+        state.mem[:] = self.mem
+        state.regs[:] = self.regs
+        state.dirty[:] = self.dirty
+        state.stamps[:] = self.stamps
+        state.epoch = self.epoch
+        return state
+
+    # End the current epoch and return the new one, as a mark that
+    # changed_pages and changed_ranges can be asked about later. Only the
+    # pages flagged in this epoch are looked at, so this is cheap.
+    def mark(self):
+        dirty = self.dirty
+        stamps = self.stamps
+        epoch = self.epoch
+        page = dirty.find(1)
+        while page >= 0:
+            stamps[page] = epoch
+            dirty[page] = 0
+            page = dirty.find(1, page + 1)
+        self.epoch = epoch + 1
+        return self.epoch
+
+    # The pages of RAM / FRAM written since mark was returned; mark 0 covers
+    # everything written since the model was created, which is everything
+    # that can differ from the blank image.
+    def changed_pages(self, mark):
+        dirty = self.dirty
+        stamps = self.stamps
+        return [page for page in mem_pages if dirty[page] or stamps[page] >= mark]
+
+    # The parts of [addr, addr+size) that could have changed since mark, as a
+    # list of (addr, size): the pages of RAM / FRAM written since then, and
+    # anything that isn't RAM / FRAM, since MMIO isn't tracked.
+    def changed_ranges(self, mark, addr, size):
+        dirty = self.dirty
+        stamps = self.stamps
+        end = addr + size
+        ranges = []
+        lo = addr
+        while lo < end:
+            page = lo >> page_bits
+            hi = min(end, (page + 1) << page_bits)
+            if not self.regions[lo] or dirty[page] or stamps[page] >= mark:
+                if ranges and ranges[-1][0] + ranges[-1][1] == lo:
+                    ranges[-1] = (ranges[-1][0], hi - ranges[-1][0])
+                else:
+                    ranges.append((lo, hi - lo))
+            lo = hi
+        return ranges
+
+    # Map a device over [start, start+size), which must not overlap RAM or FRAM.
+    # Whole pages are pointed straight at the device; partial pages are split.
+    def map_mmio(self, start, size, device):
+        assert (isinstance(start, int) and 0 <= start and start + size <= mem_size and
+                not any(self.regions[start:start+size]))
+        if device not in self.devices:
+            self.devices.append(device)
+        end = start + size
+        addr = start
+        while addr < end:
+            page = addr >> page_bits
+            page_start = page << page_bits
+            page_end = page_start + page_size
+            if addr == page_start and page_end <= end:
+                self.pages[page] = device
+            else:
+                split = self.pages[page]
+                if not isinstance(split, Split_Page):
+                    split = Split_Page(split)
+                    self.pages[page] = split
+                lo = addr - page_start
+                hi = min(end, page_end) - page_start
+                split.devices[lo:hi] = [device] * (hi - lo)
+            addr = page_end
+
+    def mmio_device(self, addr):
+        device = self.pages[addr >> page_bits]
+        if isinstance(device, Split_Page):
+            return device.devices[addr & page_mask]
+        else:
+            return device
+
+    # RAM and FRAM only change when written
+    def stable(self, addr):
+        return bool(self.regions[addr]) or self.mmio_device(addr).stable(addr)
+
+    def _handler_device(self, addr):
+        device = self.mmio_device(addr)
+        if not isinstance(device, Handler_MMIO):
+            device = Handler_MMIO(device)
+            self.map_mmio(addr, 1, device)
+        return device
 
     def set_mmio_read_handler(self, addr, handler):
-        assert (isinstance(addr, int) and not ((ram_start <= addr and addr < ram_start+ram_size)
-                                               or (fram_start <= addr and addr < fram_start+fram_size)))
-        self.mmio_read[addr] = handler
+        self._handler_device(addr).read_handler = handler
 
     def set_mmio_write_handler(self, addr, handler):
-        assert (isinstance(addr, int) and not ((ram_start <= addr and addr < ram_start+ram_size)
-                                               or (fram_start <= addr and addr < fram_start+fram_size)))
-        self.mmio_write[addr] = handler
-
-    def mmio_handle_default(self, addr, initial_value = 0):
-        buf = [initial_value]
-        def read_handler(v):
-            return buf[0]
-        def write_handler(v):
-            buf[0] = v
-            return
-        self.set_mmio_read_handler(addr, read_handler)
-        self.set_mmio_write_handler(addr, write_handler)
+        self._handler_device(addr).write_handler = handler
+
+    def mmio_handle_default(self, addr, initial_value = 0, size = 1):
+        self.mmio_handle_pattern(addr, size, [initial_value])
+
+    def mmio_handle_pattern(self, addr, size, pattern):
+        self.map_mmio(addr, size, Default_MMIO(addr, size, pattern))
+
+    # Bulk access. A range that lies entirely in RAM / FRAM is copied straight
+    # to or from the flat memory, unless we're tracing, in which case every
+    # byte still goes through read8 / write8 so it shows up in the iotrace.
+    def is_mem_range(self, addr, size):
+        return (0 <= addr and addr + size <= mem_size and
+                self.regions.find(region_mmio, addr, addr + size) < 0)
+
+    def read_bytes(self, addr, size):
+        if self.trace is None and self.is_mem_range(addr, size):
+            return list(self.mem[addr:addr+size])
+        else:
+            return [self.read8(a) for a in range(addr, addr+size)]
+
+    def write_bytes(self, addr, data):
+        size = len(data)
+        if self.trace is None and self.is_mem_range(addr, size):
+            if self.icache:
+                self.icache.clear()
+            for a in [a for a in self.code_watch if addr <= a and a < addr + size]:
+                if a in self.code_watch:
+                    invalidate_code(a, data[a - addr], self.mem, self.code_watch)
+            self.mem[addr:addr+size] = bytes(data)
+            if size > 0:
+                first = addr >> page_bits
+                last = (addr + size - 1) >> page_bits
+                self.dirty[first:last+1] = bytes([1]) * (last + 1 - first)
+        else:
+            for i in range(size):
+                self.write8(addr + i, data[i])
+
+    # A snapshot holds the registers, the contents of RAM / FRAM as a tuple of
+    # immutable pages, and the state of every MMIO device. Pages that are the
+    # same as in prev (an earlier snapshot of this model) are shared with it,
+    # so keeping a series of snapshots only costs the pages that changed.
+    def snapshot(self, prev = None):
+        mem = self.mem
+        pages = []
+        for i, page in enumerate(mem_pages):
+            lo = page << page_bits
+            data = mem[lo:lo+page_size]
+            if prev is not None and prev[1][i] == data:
+                pages.append(prev[1][i])
+            else:
+                pages.append(bytes(data))
+        devices = tuple((device, device.snapshot()) for device in self.devices)
+        return (tuple(self.regs), tuple(pages), devices)
+
+    # Only pages that differ are written back. Nothing is traced; decoded
+    # instructions and translated blocks built from bytes that change are
+    # dropped, as for any other write.
+    def restore(self, snap):
+        regs, pages, devices = snap
+        self.regs[:] = regs
+        mem = self.mem
+        icache = self.icache
+        code_watch = self.code_watch
+        for page, data in zip(mem_pages, pages):
+            lo = page << page_bits
+            hi = lo + page_size
+            if mem[lo:hi] != data:
+                if icache:
+                    for addr in range(lo - 1, hi):
+                        icache.pop(addr, None)
+                if code_watch:
+                    for addr in range(lo, hi):
+                        if addr in code_watch:
+                            invalidate_code(addr, data[addr - lo], mem, code_watch)
+                mem[lo:hi] = data
+                self.dirty[page] = 1
+        for device, device_snap in devices:
+            device.restore(device_snap)
 
     def dump(self, check=True):
         print(repr(self))
@@ -178,27 +548,35 @@ class Model(object):
         print(regdump)
 
         print('-- ram --')
-        ramidump = utils.describe_interesting_memory(self.ram, ram_start, fill=[0xff, 0x3f])
+        ram = self.ram.tolist()
+        ramidump = utils.describe_interesting_memory(ram, ram_start, fill=[0xff, 0x3f])
         if check:
-            ramdump = utils.describe_memory(self.ram, ram_start)
+            ramdump = utils.describe_memory(ram, ram_start)
             assert(ramidump == utils.summarize_interesting(ramdump, fill=[0xff, 0x3f]))
-            assert(self.ram == utils.parse_memory(ramdump))
+            assert(ram == utils.parse_memory(ramdump))
         print(ramidump)
 
         print('-- fram --')
-        framidump = utils.describe_interesting_memory(self.fram, fram_start, fill=[0xff])
+        fram = self.fram.tolist()
+        framidump = utils.describe_interesting_memory(fram, fram_start, fill=[0xff])
         if check:
-            framdump = utils.describe_memory(self.fram, fram_start)
+            framdump = utils.describe_memory(fram, fram_start)
             assert(framidump == utils.summarize_interesting(framdump, fill=[0xff]))
-            assert(self.fram == utils.parse_memory(framdump))
+            assert(fram == utils.parse_memory(framdump))
         print(framidump)
 
+    # Pages that were never written still hold the blank image, which is all
+    # fill, so only runs of written pages have to be scanned. They start on
+    # page boundaries, which keeps the chunks lined up with a full scan.
     def segments(self):
-        return (utils.interesting_regions(self.ram, ram_start, fill=[0xff, 0x3f], align=8) +
-                utils.interesting_regions(self.fram, fram_start, fill=[0xff], align=8))
+        regions = []
+        for start, size, fill in [(ram_start, ram_size, [0xff, 0x3f]), (fram_start, fram_size, [0xff])]:
+            for addr, n in self.changed_ranges(0, start, size):
+                regions += utils.interesting_regions(list(self.mem[addr:addr+n]), addr, fill=fill, align=8)
+        return regions
 
     def entry(self):
-        return mk_read16(self.read8)(resetvec)
+        return self.read16(resetvec)
 
     def registers(self):
         return [self.readreg(i) for i in range(len(self.regs))]
@@ -0,0 +1,269 @@
+# msp430 superinstructions
+
+# Micro images are all built out of the same few sequences (see msp_micros):
+# the timer is read into one register before the code under test and into
+# another one after it, the difference is stored to memory with MOV.B, and then
+# every register the micro clobbered is cleared. Each image is straight-line
+# code that runs once, so none of it ever gets hot enough to translate, and
+# building anything per pc (a Block, its closures, its code_watch entries)
+# costs more than it saves. Instead, whenever the translator would step cold
+# code, it first checks whether the code matches a run of the patterns below,
+# and if so executes the whole run with one handler per pattern, written out by
+# hand, without keeping anything. A handler makes the same register, memory and
+# timer accesses, in the same order, as the instructions it stands for.
+
+import msp_arith as arith
+import msp_assem as assem
+import msp_fr5969_model as model
+import msp_instr as instr
+import msp_micros as micros
+from msp_isa import isa
+
+# The patterns come straight from the micro emitters, given strings instead of
+# registers and addresses. A string is a variable: it matches whatever value
+# the instruction has there, but has to match the same value everywhere it
+# appears, and only values in its domain (if it has one).
+timer_store = micros.emit_timer_read_rn('r2') + micros.emit_timer_compute_store('r1', 'r2', 'addr')
+clear_rn = micros.emit_clear_rn('rn')
+clear_addr = micros.emit_clear_addr('addr')
+
+# the handlers don't deal with the PC, SR or constant generator as operands
+general_regs = frozenset(range(4, model.reg_size))
+# clearing R2 is fine (0 is a valid SR), clearing R0 is a jump
+clear_regs = frozenset(range(1, model.reg_size))
+
+region_table = model.region_table
+
+# What a handler needs to know about each instruction it stands for is kept
+# in a tuple (pc, next_pc, ins, static, isrc, idst): the same things the
+# translator's Slot has, without the decoding work that a Slot does up front.
+
+# the bytes an instruction writes, as (start, end), if it writes memory (the
+# patterns only ever write to &ADDR destinations)
+def slot_writes(slot):
+    pc, next_pc, ins, static, isrc, idst = slot
+    if ins.dmode != '&ADDR':
+        return None
+    a = idst & 0xffff
+    if static['bw'] == 0:
+        a = a & instr.pc_bitmask
+        return (a, a + 2)
+    else:
+        return (a, a + 1)
+
+# Handlers. Each one takes the translator, the matched slots and steps, runs
+# the instructions, and adds the number of them that completed to steps[0],
+# even if one of them raises. They stop early, returning True, if an interrupt
+# is taken.
+
+# MOV &TA0R, R2 ; SUB R1, R2 ; MOV.B R2, &ADDR
+def fused_timer_store(translator, slots, steps):
+    state = translator.state
+    regs = state.regs
+    timing = translator.timing
+    if timing:
+        timer_update = translator.emulator._timer_update
+        elapse = translator.emulator.events.elapse
+    (_, pc_1, ins_1, static_1, asrc, _), (_, pc_2, ins_2, static_2, _, _), (_, pc_3, ins_3, static_3, _, adst) = slots
+    r1 = static_2['rsrc']
+    r2 = static_2['rdst']
+    n = 0
+    try:
+        src = state.read16((asrc & 0xffff) & instr.pc_bitmask) & 0xffff
+        regs[0] = pc_1
+        regs[r2] = src
+        taken = timing and elapse(timer_update(ins_1, static_1))
+        n = 1
+        if taken:
+            return True
+
+        s = regs[r1] & 0xffff
+        d = regs[r2] & 0xffff
+        r = (~s & 0xffff) + 1 + d
+        rt = r & 0xffff
+        sr = arith.set_flags(regs[2], (r >> 16) & 1, int(rt == 0), rt >> 15,
+                             int(((s ^ d) & (d ^ rt) & 0x8000) != 0))
+        regs[0] = pc_2
+        regs[r2] = rt
+        regs[2] = sr
+        taken = timing and elapse(timer_update(ins_2, static_2))
+        n = 2
+        if taken:
+            return True
+
+        adst = adst & 0xffff
+        src = regs[r2]
+        state.read8(adst)
+        regs[0] = pc_3
+        state.write8(adst, src & 0xff)
+        taken = timing and elapse(timer_update(ins_3, static_3))
+        n = 3
+        if taken:
+            return True
+    finally:
+        steps[0] += n
+
+# any number of MOV R3, Rn / MOV R3, &ADDR in a row
+def fused_clear(translator, slots, steps):
+    state = translator.state
+    regs = state.regs
+    timing = translator.timing
+    if timing:
+        timer_update = translator.emulator._timer_update
+        elapse = translator.emulator.events.elapse
+    n = 0
+    try:
+        for pc, next_pc, ins, static, isrc, idst in slots:
+            if idst is None:
+                rn = static['rdst']
+                regs[0] = next_pc
+                if rn != 3:
+                    regs[rn] = 0
+            else:
+                adst = (idst & 0xffff) & instr.pc_bitmask
+                state.read16(adst)
+                regs[0] = next_pc
+                state.write16(adst, 0)
+            taken = timing and elapse(timer_update(ins, static))
+            n += 1
+            if taken:
+                return True
+    finally:
+        steps[0] += n
+
+# (pattern, variable domains, handler, whether consecutive matches share one handler)
+patterns = [
+    (timer_store, {'r1':general_regs, 'r2':general_regs}, fused_timer_store, False),
+    (clear_rn, {'rn':clear_regs}, fused_clear, True),
+    (clear_addr, {}, fused_clear, True),
+]
+
+# Matching has to be cheap, since it's tried on all the cold code, so each
+# entry of a pattern is turned into a table of every first word it could have
+# (with the instruction, its fields, and the variables that word binds),
+# followed by its extension words in order, as (field, value or variable).
+# Variables in the first word need a domain.
+def compile_entry(entry, domains):
+    name, smode, dmode, fields = entry
+    variables = [(k, v) for k, v in fields.items() if isinstance(v, str) and k not in {'isrc', 'idst'}]
+    assignments = [()]
+    for k, v in variables:
+        assignments = [a + ((k, v, x),) for a in assignments for x in sorted(domains[v])]
+    words = {}
+    for a in assignments:
+        concrete = dict(fields)
+        for k, v, x in a:
+            concrete[k] = x
+        for k in ['isrc', 'idst']:
+            if k in concrete:
+                concrete[k] = 0
+        word = assem.assemble(name, smode, dmode, concrete)[0]
+        ins = isa.decode(word)
+        words[word] = (ins, instr.static_fields(ins, word), tuple((v, x) for k, v, x in a))
+    ext = [(k, fields[k]) for k in ['isrc', 'idst'] if k in fields]
+    return words, ext
+
+def compile_pattern(pattern, domains):
+    return [compile_entry(entry, domains) for entry in pattern]
+
+# first word -> the (compiled pattern, handler, merge) that can start with it,
+# in the order they're tried
+def mk_starts(patterns):
+    starts = {}
+    for pattern, domains, handler, merge in patterns:
+        entries = compile_pattern(pattern, domains)
+        for word in entries[0][0]:
+            starts.setdefault(word, []).append((entries, handler, merge))
+    return starts
+
+starts = mk_starts(patterns)
+
+# The word at an even address, or None if it isn't in RAM / FRAM (which is
+# the only place the translator takes code from). Code is read straight out of
+# memory, since this is tried so often.
+def word_at(mem, addr):
+    if region_table[addr]:
+        return mem[addr] | (mem[addr+1] << 8)
+    else:
+        return None
+
+# The slots for the instructions at pc, if they match the pattern, or None.
+def match_pattern(entries, mem, pc):
+    bindings = {}
+    slots = []
+    for words, ext in entries:
+        found = words.get(word_at(mem, pc))
+        if found is None:
+            return None
+        ins, static, word_bindings = found
+        for v, x in word_bindings:
+            if bindings.setdefault(v, x) != x:
+                return None
+        next_pc = (pc + 2) & instr.pc_bitmask
+        isrc = None
+        idst = None
+        for k, v in ext:
+            x = word_at(mem, next_pc)
+            if x is None:
+                return None
+            if isinstance(v, str):
+                if bindings.setdefault(v, x) != x:
+                    return None
+            elif x != v:
+                return None
+            if k == 'isrc':
+                isrc = x
+            else:
+                idst = x
+            next_pc = (next_pc + 2) & instr.pc_bitmask
+        slots.append((pc, next_pc, ins, static, isrc, idst))
+        pc = next_pc
+    return slots
+
+# Match as many patterns as possible, one after another, starting at pc, for at
+# most max_length instructions, without running into a pc in stop. Returns a
+# list of (handler, slots), or None if there's nothing worth fusing.
+def match(mem, pc, max_length, stop):
+    matches = []
+    length = 0
+    while True:
+        candidates = starts.get(word_at(mem, pc))
+        if candidates is None or (length > 0 and pc in stop):
+            break
+        found = None
+        for entries, handler, merge in candidates:
+            if length + len(entries) <= max_length:
+                slots = match_pattern(entries, mem, pc)
+                if slots is not None and not (stop and any(slot[0] in stop for slot in slots[1:])):
+                    found = (handler, merge, slots)
+                    break
+        if found is None:
+            break
+        matches.append(found)
+        length += len(found[2])
+        pc = found[2][-1][1]
+
+    # a lone instruction is no faster fused
+    if length < 2:
+        return None
+
+    # Everything is matched before any of it runs, so stop right after a
+    # write to any of the code that comes after it. The write is always the
+    # last instruction of its pattern.
+    end = pc
+    groups = []
+    length = 0
+    for handler, merge, slots in matches:
+        if merge and groups and groups[-1][0] is handler:
+            groups[-1][1].extend(slots)
+        else:
+            groups.append((handler, list(slots)))
+        length += len(slots)
+        writes = slot_writes(slots[-1])
+        if writes is not None:
+            a, b = writes
+            if a < end and slots[-1][1] < b:
+                break
+    if length < 2:
+        return None
+    return groups
@@ -0,0 +1,94 @@
+# msp430 idle loops
+
+# Firmware that is waiting for something spins in a short loop: a conditional
+# jump back to itself, or a few instructions that poll a flag or a peripheral
+# register and jump back if nothing has changed. If such a loop doesn't write
+# memory, and one run through it comes back to where it started with every
+# register (and the timing model's state) as it was, then every later run
+# through it does exactly the same thing, as long as nothing it reads can
+# change on its own; only the timer moves. So once a translated block turns out
+# to be such a loop, the translator runs it once, checks all that, and then
+# counts as many further runs as fit before the step limit or the next scheduled
+# event at once, instead of executing them (see Translator.spin).
+#
+# The halt pads don't need any of this: their first word is a halt, which
+# stops the run before anything loops.
+
+import msp_translate as translator
+
+# The memory an instruction reads, as (rn, offset, mask, size): size bytes
+# at (regs[rn] + offset) & mask, or just at offset if rn is None. The offsets
+# and masks are the ones Slot.emit_src / Slot.emit_dst use.
+def slot_reads(slot):
+    ins = slot.ins
+    f = slot.static
+    bw = slot.bw
+    size = 2 - bw
+    reads = []
+    if slot.cgsrc is None:
+        smode = ins.smode
+        if smode == 'X(Rn)':
+            reads.append((f['rsrc'], slot.isrc, 0xffff & translator.mask_bw(bw), size))
+        elif smode == 'ADDR':
+            reads.append((None, ((slot.isrc - 2 + slot.src_pc) & 0xffff) & translator.mask_bw(bw), None, size))
+        elif smode == '&ADDR':
+            reads.append((None, (slot.isrc & 0xffff) & translator.mask_bw(bw), None, size))
+        elif smode in {'@Rn', '@Rn+'}:
+            reads.append((f['rsrc'], 0, translator.mask_bw(bw), size))
+    if ins.fmt == 'fmt1':
+        dmode = ins.dmode
+        if dmode == 'X(Rn)':
+            reads.append((f['rdst'], slot.idst, 0xffff & translator.mask_bw(bw), size))
+        elif dmode == 'ADDR':
+            reads.append((None, ((slot.idst - 2 + slot.dst_pc) & 0xffff) & translator.mask_bw(bw), None, size))
+        elif dmode == '&ADDR':
+            reads.append((None, (slot.idst & 0xffff) & translator.mask_bw(bw), None, size))
+    return reads
+
+# If the block of slots starting at pc could be an idle loop, the reads it
+# makes, otherwise None. It has to end with a jump back to pc, and nothing
+# before that may write memory. Every read has to be from the same address
+# each time round, so registers used as addresses can't be written.
+def loop_reads(pc, slots):
+    if not slots:
+        return None
+    last = slots[-1]
+    if last.ins.fmt != 'jump' or last.jump_target() != pc:
+        return None
+    reads = []
+    written = set()
+    for slot in slots[:-1]:
+        ins = slot.ins
+        f = slot.static
+        if ins.fmt == 'fmt1':
+            if ins.smode == '@Rn+' and slot.cgsrc is None:
+                return None
+            if ins.name not in {'CMP', 'BIT'}:
+                if ins.dmode != 'Rn':
+                    return None
+                written.add(f['rdst'])
+        elif ins.fmt == 'fmt2':
+            if ins.smode != 'Rn' or ins.name in {'PUSH', 'CALL', 'RETI'}:
+                return None
+            written.add(f['rsrc'])
+        else:
+            return None
+        reads += slot_reads(slot)
+    for rn, offset, mask, size in reads:
+        if rn is not None and (rn == 0 or rn in written):
+            return None
+    return tuple(reads)
+
+# Do the reads of an idle loop, with the registers as they are now, only see
+# memory that keeps its value until something writes it?
+def stable(state, reads):
+    regs = state.regs
+    for rn, offset, mask, size in reads:
+        if rn is None:
+            a = offset
+        else:
+            a = (regs[rn] + offset) & mask
+        for addr in range(a, a + size):
+            if not state.stable(addr):
+                return False
+    return True
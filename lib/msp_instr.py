@@ -44,62 +44,156 @@ def regadd(r, x):
 # Execution proceeds in three parts. First, readfields is called on a model
 # to extract the necessary values based on the instruction's encoding. It
 # presumably uses the model's readreg and read8 methods and produces a
-# dictionary of field values keyed by name strings. In the case of autoincrementing
+# Fields record of named values (see below). In the case of autoincrementing
 # register modes, readfields will generally perform the
 # necessary state updates all by itself. In the case of the PC, readfields
 # will store the fetched pc as old_pc, and then keep track of the expected PC
 # as it autoincrements to read fields, anticipating a final PC write in writefields. 
-# Execute takes the dict produced by readfields
+# Execute takes the record produced by readfields
 # and does any computation specified by the instruction by mutating the values.
 # Then, writefields writes the new values back to memory, taking the model
-# and dict and presumably using the model's writereg and write8 methods.
+# and record and presumably using the model's writereg and write8 methods.
+
+# Every field any instruction might decode or compute gets a slot. A slot that
+# was never set reads as None, which is treated as absent. 'as' is a keyword,
+# so that field lives in as_.
+field_slots = ['old_pc', 'pc', 'sr', 'word',
+               'opc', 'rsrc', 'as_', 'bw', 'ad', 'rdst',
+               's', 'offset', 'cond',
+               'data', 'n', 'aw', 'group',
+               'isrc', 'idst', 'cgsrc', 'asrc', 'adst', 'src', 'dst',
+               'jump_offset', 'jump_taken']
+field_slot_set = set(field_slots)
+
+def field_attr(name):
+    if name == 'as':
+        return 'as_'
+    else:
+        return name
+
+def field_name(attr):
+    if attr == 'as_':
+        return 'as'
+    else:
+        return attr
+
+class Fields(object):
+    __slots__ = field_slots
+
+    def __init__(self, old_pc, pc, sr, word):
+        self.old_pc = old_pc
+        self.pc = pc
+        self.sr = sr
+        self.word = word
+
+    def __getattr__(self, attr):
+        # only called for slots that haven't been set
+        if attr in field_slot_set:
+            return None
+        raise AttributeError(attr)
+
+    # The instruction words aren't kept as a list; they're just the opcode
+    # followed by whichever extension words were read.
+    def words(self):
+        words = [self.word]
+        if self.isrc is not None:
+            words.append(self.isrc)
+        if self.idst is not None:
+            words.append(self.idst)
+        return words
+
+    # dict-style access by the original field names, for code outside the
+    # execution path (cfg analysis, micro generation, timing). Names that
+    # aren't fields at all behave like missing keys.
+    def __contains__(self, name):
+        if name == 'words':
+            return True
+        attr = field_attr(name)
+        return attr in field_slot_set and getattr(self, attr) is not None
+
+    def __getitem__(self, name):
+        if name == 'words':
+            return self.words()
+        if name not in self:
+            raise KeyError(name)
+        return getattr(self, field_attr(name))
+
+    def __setitem__(self, name, v):
+        setattr(self, field_attr(name), v)
+
+    def get(self, name, default = None):
+        if name in self:
+            return self[name]
+        else:
+            return default
+
+    # a plain dict with the same contents, for the trace
+    def to_dict(self):
+        d = {'old_pc':self.old_pc, 'pc':self.pc, 'sr':self.sr, 'words':self.words()}
+        for attr in field_slots[4:]:
+            v = getattr(self, attr)
+            if v is not None:
+                d[field_name(attr)] = v
+        return d
 
 # read the next word after the pc, and increment the pc stored in fields
 def read_another_word(state, fields):
-    pc = fields['pc']
-    word = model.mk_read16(state.read8)(pc)
-    fields['pc'] = pcadd(pc, 2)
-    fields['words'].append(word)
-    return
+    pc = fields.pc
+    word = state.read16(pc)
+    fields.pc = pcadd(pc, 2)
+    return word
+# The fields pulled out of word_0 depend only on the word itself, so a caller
+# that caches decoded instructions by pc can compute them once with predecode,
+# and hand the result back to readfields as decoded = (word, extracted)
+# to skip re-reading and re-extracting word_0.
+def predecode(ins, word):
+    extracted = tuple((attr, (word >> shift) & mask) for attr, shift, mask in ins.field_extract)
+    return word, extracted
+# the same fields, by name, as a plain dict
+def static_fields(ins, word):
+    return {field_name(attr) : v for attr, v in predecode(ins, word)[1]}
 # get pc, sr, word_0, and autoincrement over this pc 
-def decode_base(state):
+def decode_base(state, decoded = None):
     pc = state.readreg(0)
     sr = state.readreg(2)
-    fields = {'old_pc':pc, 'pc':pc, 'sr':sr, 'words':[]}
-    read_another_word(state, fields)
-    return fields
+    if decoded is None:
+        return Fields(pc, pcadd(pc, 2), sr, state.read16(pc))
+    else:
+        return Fields(pc, pcadd(pc, 2), sr, decoded[0])
 # decode fields of a given instruction
-def decode_fields(ins, state):
-    fields = decode_base(state)
-    word = fields['words'][0]
-    for f in ins.fields:
-        (firstbit, lastbit) = ins.fields[f]
-        fields[f] = (word >> firstbit) & (2 ** (lastbit - firstbit + 1) - 1)
+def decode_fields(ins, state, decoded = None):
+    fields = decode_base(state, decoded)
+    if decoded is None:
+        decoded = predecode(ins, fields.word)
+    for attr, v in decoded[1]:
+        setattr(fields, attr, v)
     return fields
-# decode and then try to set up constant generator
-def decode_cg(ins, state):
-    fields = decode_fields(ins, state)
-    f_as = fields['as']
-    f_rsrc = fields['rsrc']
+# the value the constant generator supplies for a given as / rsrc pair, or None
+def cg_value(f_as, f_rsrc, bw):
     if f_rsrc == 2:
         if f_as == 1:
-            fields['cgsrc'] = 0
+            return 0
         elif f_as == 2:
-            fields['cgsrc'] = 4
+            return 4
         elif f_as == 3:
-            fields['cgsrc'] = 8
+            return 8
     elif f_rsrc == 3:
         if f_as == 0:
-            fields['cgsrc'] = 0
+            return 0
         elif f_as == 1:
-            fields['cgsrc'] = 1
+            return 1
         elif f_as == 2:
-            fields['cgsrc'] = 2
+            return 2
         elif f_as == 3:
-            if fields['bw'] == 1:
-                fields['cgsrc'] = 0xff
+            if bw == 1:
+                return 0xff
             else:
-                fields['cgsrc'] = 0xffff
+                return 0xffff
+    return None
+# decode and then try to set up constant generator
+def decode_cg(ins, state, decoded = None):
+    fields = decode_fields(ins, state, decoded)
+    fields.cgsrc = cg_value(fields.as_, fields.rsrc, fields.bw)
     return fields
 
 # How to get the pc that an instruction will see when trying to use it as data.
@@ -107,16 +201,16 @@ def decode_cg(ins, state):
 # is over. We compute this from old_pc and the size of the instruction.
 def readpc(ins, fields):
     # refer to instruction length symbolically, it might be updated and things
-    return pcadd(fields['old_pc'], ins.length)
+    return pcadd(fields.old_pc, ins.length)
 
 # basic actions performed after executing an instruction
 def write_pc_sr(state, fields):
-    state.writereg(0, fields['pc'])
-    state.writereg(2, fields['sr'])
+    state.writereg(0, fields.pc)
+    state.writereg(2, fields.sr)
 
 # default values used when instructions are first initialized: should be overwritten later
-def readfields_default(state):
-    return decode_base(state)
+def readfields_default(state, decoded = None):
+    return decode_base(state, decoded)
 
 def execute_default(fields):
     # we don't want to do the pc update here, necessarily, as this would mean
@@ -162,6 +256,10 @@ class Instr(object):
                 assert(self.bits[i] is None)
                 self.bits[i] = f
 
+        # precomputed (attribute, shift, mask) for pulling each field out of a word
+        self.field_extract = [(field_attr(f), self.fields[f][0], 2 ** (self.fields[f][1] - self.fields[f][0] + 1) - 1)
+                              for f in self.fields]
+
         (opc_firstbit, opc_lastbit) = fields['opc']
         if verbosity >= 3:
             print('assigning opc bits')
@@ -80,12 +80,44 @@ def mk_decode(instrs):
     
     return decode
 
+# The tree above walks one bit at a time, which is far too slow to do for every
+# emulated instruction. Instead we flatten it into a dense table with one entry
+# for every possible instruction word, so that decoding is a single index.
+
+def specified_bits(ins):
+    return sum(1 for bit in ins.bits if bit == 1 or bit == 0)
+
+def mk_decode_table(instrs):
+    table = [None for _ in range(2 ** instr.instr_bits)]
+
+    # The tree resolves overlapping encodings by picking the most specified
+    # instruction, so fill in order of increasing specificity and let the more
+    # specific instructions overwrite the entries they share.
+    for ins in sorted(instrs, key=specified_bits):
+        fixed_val = 0
+        free_mask = 0
+        for i, bit in enumerate(ins.bits):
+            if bit == 1:
+                fixed_val |= 1 << i
+            elif bit != 0:
+                free_mask |= 1 << i
+        # enumerate every assignment of the free (field) bits
+        sub = free_mask
+        while True:
+            table[fixed_val | sub] = ins
+            if sub == 0:
+                break
+            sub = (sub - 1) & free_mask
+
+    return table
+
 # isa class
 
 class ISA(object):
     def __init__(self, instrs, fmap):
         self.instrs = instrs
-        self.decode = mk_decode(instrs)
+        self.decode_table = mk_decode_table(instrs)
+        self.decode = self.decode_table.__getitem__
         self.name_to_fmt = fmap
         def add_to_map(m, k):
             if not k in m:
@@ -273,7 +305,14 @@ if __name__ == '__main__':
         i += 1
     print('  {:d}\tidx -> ins -> idx'.format(i))
 
+    print('test decode table against decode tree')
+
+    decode_tree = mk_decode(isa.instrs)
     decode_table = [isa.decode(x) for x in range(2**instr.instr_bits)]
+    for x in range(2**instr.instr_bits):
+        assert(decode_table[x] is decode_tree(x))
+    print('  {:d}\ttable == tree'.format(len(decode_table)))
+
     counts = {}
 
     for ins in decode_table:
@@ -242,6 +242,139 @@ def create_fmap():
 
     return fmap
 
+# Specialized handlers. For an untraced model, each instruction word can get
+# its own readfields / writefields, built from the mk_spec_* functions in the
+# format modules, with every decision those make based on the registers, the
+# addressing mode bits and bw taken ahead of time (for fmt1 and fmt2 the word
+# is exactly the instruction plus rsrc, rdst and bw). specialize returns
+# (readfields, execute, writefields), called as readfields(), execute(fields)
+# and writefields(fields); anything without a specialized version falls back
+# on the instruction's own functions.
+
+# source modes whose readfields go through msp_addr.mk_readfields_cg
+cg_smodes = {'Rn', 'X(Rn)', '#1', '@Rn', '@Rn+'}
+
+def mk_spec_general_write(ins, f, state):
+    def writefields(fields):
+        return ins.writefields(state, fields)
+    return writefields
+
+fmt1_spec = {
+    'smodes' : {
+        'Rn'    : msp_fmt1.mk_spec_src_Rn,
+        'X(Rn)' : msp_fmt1.mk_spec_src_idx,
+        'ADDR'  : msp_fmt1.mk_spec_src_sym,
+        '&ADDR' : msp_fmt1.mk_spec_src_abs,
+        '#1'    : msp_fmt1.mk_spec_src_cg1,
+        '@Rn'   : msp_fmt1.mk_spec_src_ind,
+        '@Rn+'  : msp_fmt1.mk_spec_src_ai,
+        '#@N'   : msp_fmt1.mk_spec_src_N,
+        '#N'    : msp_fmt1.mk_spec_src_N,
+    },
+    'dmodes' : {
+    #    dmode     reader                        writer
+        'Rn'    : (msp_fmt1.mk_spec_dst_Rn,  msp_fmt1.mk_spec_write_dst_Rn, ),
+        'X(Rn)' : (msp_fmt1.mk_spec_dst_idx, msp_fmt1.mk_spec_write_dst_idx,),
+        'ADDR'  : (msp_fmt1.mk_spec_dst_sym, msp_fmt1.mk_spec_write_dst_sym,),
+        '&ADDR' : (msp_fmt1.mk_spec_dst_abs, msp_fmt1.mk_spec_write_dst_abs,),
+    },
+}
+
+fmt2_spec = {
+    'instructions' : {
+        'PUSH' : msp_fmt2.mk_spec_write_push,
+        'CALL' : msp_fmt2.mk_spec_write_call,
+        'RETI' : mk_spec_general_write,
+    },
+    'smodes' : {
+    #    smode     reader                        writer
+        'Rn'    : (msp_fmt2.mk_spec_src_Rn,  msp_fmt2.mk_spec_write_src_Rn, ),
+        'X(Rn)' : (msp_fmt2.mk_spec_src_idx, msp_fmt2.mk_spec_write_src_idx,),
+        'ADDR'  : (msp_fmt2.mk_spec_src_sym, msp_fmt2.mk_spec_write_src_sym,),
+        '&ADDR' : (msp_fmt2.mk_spec_src_abs, msp_fmt2.mk_spec_write_src_abs,),
+        '#1'    : (msp_fmt2.mk_spec_src_cg1, msp_fmt2.mk_spec_write_src_cg1,),
+        '@Rn'   : (msp_fmt2.mk_spec_src_ind, msp_fmt2.mk_spec_write_src_ind,),
+        '@Rn+'  : (msp_fmt2.mk_spec_src_ai,  msp_fmt2.mk_spec_write_src_ai, ),
+        '#@N'   : (msp_fmt2.mk_spec_src_N,   msp_fmt2.mk_spec_write_src_N,  ),
+        '#N'    : (msp_fmt2.mk_spec_src_N,   msp_fmt2.mk_spec_write_src_N,  ),
+    },
+}
+
+def mk_spec_src_cg(cg):
+    def read_src(fields):
+        fields.cgsrc = cg
+        fields.src = cg
+    return read_src
+
+def specialize(ins, word, state):
+    static = instr.predecode(ins, word)[1]
+    f = {instr.field_name(attr) : v for attr, v in static}
+    regs = state.regs
+
+    if ins.fmt in {fmt1_name, fmt2_name}:
+        if ins.smode in cg_smodes:
+            f['cgsrc'] = instr.cg_value(f['as'], f['rsrc'], f['bw'])
+        else:
+            f['cgsrc'] = None
+
+    if ins.fmt == fmt1_name:
+        if f['cgsrc'] is not None:
+            read_src = mk_spec_src_cg(f['cgsrc'])
+        else:
+            read_src = fmt1_spec['smodes'][ins.smode](ins, f, state)
+        mk_read_dst, mk_write = fmt1_spec['dmodes'][ins.dmode]
+        read_dst = mk_read_dst(ins, f, state)
+        def readfields():
+            pc = regs[0]
+            fields = instr.Fields(pc, instr.pcadd(pc, 2), regs[2], word)
+            for attr, v in static:
+                setattr(fields, attr, v)
+            read_src(fields)
+            read_dst(fields)
+            return fields
+        writefields = mk_write(ins, f, state)
+
+    elif ins.fmt == fmt2_name:
+        mk_read_src, mk_write = fmt2_spec['smodes'][ins.smode]
+        if ins.name in {'PUSH', 'CALL'}:
+            if ins.smode in {'X(Rn)'}:
+                mk_read_src = msp_fmt2.mk_spec_src_idx_push_call
+            elif ins.smode in {'@Rn+'}:
+                mk_read_src = msp_fmt2.mk_spec_src_ai_push_call
+        if f['cgsrc'] is not None:
+            read_src = mk_spec_src_cg(f['cgsrc'])
+        else:
+            read_src = mk_read_src(ins, f, state)
+        def readfields():
+            pc = regs[0]
+            fields = instr.Fields(pc, instr.pcadd(pc, 2), regs[2], word)
+            for attr, v in static:
+                setattr(fields, attr, v)
+            read_src(fields)
+            return fields
+        if ins.name in fmt2_spec['instructions']:
+            mk_write = fmt2_spec['instructions'][ins.name]
+        writefields = mk_write(ins, f, state)
+
+    elif ins.fmt == jump_name:
+        jump_offset = (f['offset'] << 1) | (-f['s'] << 10)
+        def readfields():
+            pc = regs[0]
+            fields = instr.Fields(pc, instr.pcadd(pc, 2), regs[2], word)
+            for attr, v in static:
+                setattr(fields, attr, v)
+            fields.jump_offset = jump_offset
+            return fields
+        writefields = msp_jump.mk_spec_write(ins, f, state)
+
+    else:
+        decoded = (word, static)
+        def readfields():
+            return ins.readfields(state, decoded)
+        writefields = mk_spec_general_write(ins, f, state)
+
+    return readfields, ins.execute, writefields
+
 # sanity test
 if __name__ == '__main__':
     itab = create_itable(verbosity = 10)
@@ -7,16 +7,16 @@ import msp_arith as arith
 # through the 'jump_offset' and 'jump_taken' fields
 
 def mk_readfields(ins):
-    def readfields(state):
-        fields = instr.decode_fields(ins, state)
-        fields['jump_offset'] = (fields['offset'] << 1) | (-fields['s'] << 10)
+    def readfields(state, decoded = None):
+        fields = instr.decode_fields(ins, state, decoded)
+        fields.jump_offset = (fields.offset << 1) | (-fields.s << 10)
         return fields
     return readfields
 
 def writefields(state, fields):
-    pc = fields['pc']
-    if fields['jump_taken']:
-        pc = instr.pcadd(pc, fields['jump_offset'])
+    pc = fields.pc
+    if fields.jump_taken:
+        pc = instr.pcadd(pc, fields.jump_offset)
     state.writereg(0, pc)
     return
 
@@ -24,40 +24,46 @@ def writefields(state, fields):
 # to the pc in writefields, is set by the execute logic
 
 def execute_jnz(fields):
-    sr_fields = arith.unpack_sr(fields['sr'])
-    fields['jump_taken'] = (sr_fields['z'] == 0)
+    fields.jump_taken = ((fields.sr & arith.sr_z) == 0)
     return
 
 def execute_jz(fields):
-    sr_fields = arith.unpack_sr(fields['sr'])
-    fields['jump_taken'] = (sr_fields['z'] == 1)
+    fields.jump_taken = ((fields.sr & arith.sr_z) != 0)
     return
 
 def execute_jnc(fields):
-    sr_fields = arith.unpack_sr(fields['sr'])
-    fields['jump_taken'] = (sr_fields['c'] == 0)
+    fields.jump_taken = ((fields.sr & arith.sr_c) == 0)
     return
 
 def execute_jc(fields):
-    sr_fields = arith.unpack_sr(fields['sr'])
-    fields['jump_taken'] = (sr_fields['c'] == 1)
+    fields.jump_taken = ((fields.sr & arith.sr_c) != 0)
     return
 
 def execute_jn(fields):
-    sr_fields = arith.unpack_sr(fields['sr'])
-    fields['jump_taken'] = (sr_fields['n'] == 1)
+    fields.jump_taken = ((fields.sr & arith.sr_n) != 0)
     return
 
 def execute_jge(fields):
-    sr_fields = arith.unpack_sr(fields['sr'])
-    fields['jump_taken'] = (sr_fields['n'] ^ sr_fields['v'] == 0)
+    fields.jump_taken = ((((fields.sr >> 2) ^ (fields.sr >> 8)) & 1) == 0)
     return
 
 def execute_jl(fields):
-    sr_fields = arith.unpack_sr(fields['sr'])
-    fields['jump_taken'] = (sr_fields['n'] ^ sr_fields['v'] == 1)
+    fields.jump_taken = ((((fields.sr >> 2) ^ (fields.sr >> 8)) & 1) == 1)
     return
 
 def execute_jmp(fields):
-    fields['jump_taken'] = True
+    fields.jump_taken = True
     return
+
+# Specialized handlers (see the comment in msp_fmt1): the offset is known, so
+# the writer adds it directly.
+
+def mk_spec_write(ins, f, state):
+    writereg = state.writereg
+    jump_offset = (f['offset'] << 1) | (-f['s'] << 10)
+    def write(fields):
+        if fields.jump_taken:
+            writereg(0, instr.pcadd(fields.pc, jump_offset))
+        else:
+            writereg(0, fields.pc)
+    return write
@@ -97,6 +97,13 @@ def emit_timer_compute_store(r1, r2, addr):
         ('MOV', 'Rn', '&ADDR', {'rsrc':r2, 'idst':addr, 'bw':1}),
     ]
 
+# MOV R3 (the constant 0) to a register or an address
+def emit_clear_rn(rn):
+    return [('MOV', 'Rn', 'Rn', {'rsrc':3, 'rdst':rn, 'bw':0})]
+
+def emit_clear_addr(addr):
+    return [('MOV', 'Rn', '&ADDR', {'rsrc':3, 'idst':addr, 'bw':0})]
+
 # Brute force iteration over all 'interesting' instruction combinations.
 # The machine basically has 5 registers (R0/PC, R1/SP, R2/SR, R3, R4-R15),
 # 4 source addressing modes (as is 2 bits), 2 destination addressing modes
@@ -886,9 +893,9 @@ def emit_micro(addr, codes, measure=True):
     # reset all registers that might have unknown state
     for rn in info.clobbers:
         if 0 <= rn and rn < model.reg_size:
-            teardown.append(('MOV', 'Rn', 'Rn', {'rsrc':3, 'rdst':rn, 'bw':0}))
+            teardown += emit_clear_rn(rn)
         else:
-            teardown.append(('MOV', 'Rn', '&ADDR', {'rsrc':3, 'idst':rn, 'bw':0}))
+            teardown += emit_clear_addr(rn)
 
     return setup + measure_pre + bench + measure_post + teardown
 
@@ -902,6 +909,12 @@ def iter_states(codes_iterator, measure = True, verbosity = 0, metrics = None):
     header_region = emit_init(start_timer = measure)
     header_size = assem.region_size(header_region)
 
+    # everything the images have in common is written once, into a template
+    # that each image is cloned from
+    template = model.Model()
+    for i in range(256):
+        template.write16(model.ram_start + (i*2), 0x3fff)
+
     current_addr = start_addr
     current_region = []
     current_size = 0
@@ -946,8 +959,8 @@ def iter_states(codes_iterator, measure = True, verbosity = 0, metrics = None):
             words = assem.assemble_symregion(header_region + current_region, start_pc)
             assert len(words) * 2 == header_size + current_size
 
-            state = model.Model()
-            write16 = model.mk_write16(state.write8)
+            state = template.clone()
+            write16 = state.write16
             for i in range(start_pc - start_addr):
                 state.write8(start_addr + i, 0)
             for i in range(len(words)):
@@ -956,9 +969,6 @@ def iter_states(codes_iterator, measure = True, verbosity = 0, metrics = None):
             for i in range(haltpad-1):
                 write16(start_pc + header_size + current_size + (i*2), 0x3fff)
             write16(start_pc + header_size + current_size + ((haltpad-1)*2), 0x3ff8)
-            # ram
-            for i in range(256):
-                write16(model.ram_start + (i*2), 0x3fff)
             # resetvec
             write16(model.resetvec, start_pc)
             yield state
@@ -988,8 +998,8 @@ def iter_states(codes_iterator, measure = True, verbosity = 0, metrics = None):
         words = assem.assemble_symregion(header_region + current_region, start_pc)
         assert len(words) * 2 == header_size + current_size
 
-        state = model.Model()
-        write16 = model.mk_write16(state.write8)
+        state = template.clone()
+        write16 = state.write16
         for i in range(start_pc - start_addr):
             state.write8(start_addr + i, 0)
         for i in range(len(words)):
@@ -998,9 +1008,6 @@ def iter_states(codes_iterator, measure = True, verbosity = 0, metrics = None):
         for i in range(haltpad-1):
             write16(start_pc + header_size + current_size + (i*2), 0x3fff)
         write16(start_pc + header_size + current_size + ((haltpad-1)*2), 0x3ff8)
-        # ram
-        for i in range(256):
-            write16(model.ram_start + (i*2), 0x3fff)
         # resetvec
         write16(model.resetvec, start_pc)
         yield state
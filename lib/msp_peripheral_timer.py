@@ -1,35 +1,98 @@
 # msp430 Timer_A emulator
 
 import msp_base as base
-import msp_fr5969_model as model
+import msp_events as events
 
 timer_A_base = 0x340
 timer_mem_size = 48
 
+# register offsets
+TAxCTL = 0x0
+TAxCCTL0 = 0x2
+TAxR = 0x10
+TAxCCR0 = 0x12
+TAxIV = 0x2e
+
+# TAxCTL bits
+TAIFG = 0x1
+TAIE = 0x2
+# TAxCCTLn bits
+CCIFG = 0x1
+CCIE = 0x10
+
+# interrupt vector numbers (see msp_events), for Timer0_A at 0xffea and 0xffe8
+timer_A0_vector = 45
+timer_A1_vector = 44
+# what TAxIV reads as when TAIFG is the interrupt it's reporting
+TAxIV_TAIFG = 0x0e
+
+# The counter isn't stepped along with every instruction. The number of cycles
+# that have gone by is the event queue's now (see msp_events); TAxR in mem is
+# the count as of cycle synced, and is only brought up to date when something
+# looks at the timer. Whenever the timer's registers change, the cycle of the
+# next thing that will happen to the count is worked out up front and
+# scheduled, so all elapse has to check is whether now has got there.
+#
+# Unless an interrupt can actually be taken, nothing of the counter running
+# over is modelled: an elapse that would take the count to TAxCCR0 (up mode) or
+# 0xffff (continuous mode) raises instead. That takes CCIE in TAxCCTL0 or TAIE
+# in TAxCTL, and GIE in SR as the count gets there; with the enable bit set,
+# the count wraps to 0 after TAxCCR0 (up mode) or 0xffff (continuous mode),
+# setting TAIFG, and CCIFG is set in TAxCCTL0 whenever the count reaches
+# TAxCCR0, for the interrupt controller to see. SR can change without the timer
+# knowing, so GIE is only looked at when the count is about to reach its limit.
+# Only CCR0 is modelled; up/down mode doesn't count at all, and neither does up
+# mode with TAxCCR0 at 0.
+
 class Peripheral_Timer(object):
-    def __init__(self):
+    def __init__(self, queue):
         self.mem = [0 for _ in range(timer_mem_size)]
-        self.__read16 = model.mk_read16(self._read8)
-        self.__write16 = model.mk_write16(self._write8)
-        
-    def _mk_read_handler(self, offset):
-        def read_handler(v):
-            return self.mem[offset]
-        return read_handler
-
-    def _mk_write_handler(self, offset):
-        def write_handler(v):
-            self.mem[offset] = v
-            return
-        return write_handler
+        self.queue = queue
+        self.synced = queue.now
 
     def attach_timer(self, state, base_addr):
-        for i in range(len(self.mem)):
-            read_handler = self._mk_read_handler(i)
-            write_handler = self._mk_write_handler(i)
-            addr = base_addr + i
-            state.set_mmio_read_handler(addr, read_handler)
-            state.set_mmio_write_handler(addr, write_handler)
+        self.base_addr = base_addr
+        state.map_mmio(base_addr, len(self.mem), self)
+        if self.queue.interrupts is not None:
+            self.queue.interrupts.attach(self)
+
+    # MMIO device interface, see msp_fr5969_model
+    def read8(self, addr):
+        self._sync()
+        idx = addr - self.base_addr
+        if idx == TAxIV:
+            return self._read_iv()
+        elif idx == TAxIV + 1:
+            return 0
+        return self.mem[idx]
+
+    def write8(self, addr, v):
+        self._sync()
+        idx = addr - self.base_addr
+        if idx not in {TAxIV, TAxIV + 1}:
+            self.mem[idx] = v
+        self._schedule()
+        return
+
+    # TAxR counts on its own, and reading TAxIV clears a flag; the flags only
+    # change at scheduled events, which idle loops never skip past
+    def stable(self, addr):
+        return addr - self.base_addr not in {TAxR, TAxR + 1, TAxIV, TAxIV + 1}
+
+    def snapshot(self):
+        self._sync()
+        return tuple(self.mem)
+
+    def restore(self, snap):
+        self.mem[:] = snap
+        self.synced = self.queue.now
+        self._schedule()
+
+    # after a PUC
+    def reset(self):
+        self.mem[:] = [0 for _ in range(timer_mem_size)]
+        self.synced = self.queue.now
+        self._schedule()
 
     def _read8(self, idx):
         return self.mem[idx]
@@ -38,43 +101,223 @@ class Peripheral_Timer(object):
         self.mem[idx] = v
         return
 
+    def _read16(self, idx):
+        return self.mem[idx] | (self.mem[idx+1] << 8)
+
+    def _write16(self, idx, v):
+        self.mem[idx] = v & 0xff
+        self.mem[idx+1] = (v >> 8) & 0xff
+        return
+
     @property
     def TAxCTL(self):
-        return self.__read16(0x0)
+        return self._read16(TAxCTL)
     @TAxCTL.setter
     def TAxCTL(self, v):
-        self.__write16(0x0, v)
+        self._sync()
+        self._write16(TAxCTL, v)
+        self._schedule()
         return
 
     @property
     def TAxR(self):
-        return self.__read16(0x10)
+        self._sync()
+        return self._read16(TAxR)
     @TAxR.setter
     def TAxR(self, v):
-        self.__write16(0x10, v)
+        self._sync()
+        self._write16(TAxR, v)
+        self._schedule()
         return
 
     @property
     def TAxCCR0(self):
-        return self.__read16(0x12)
+        return self._read16(TAxCCR0)
     @TAxCCR0.setter
     def TAxCCR0(self, v):
-        self.__write16(0x12, v)
+        self._sync()
+        self._write16(TAxCCR0, v)
+        self._schedule()
         return
 
-    def elapse(self, cycles):
-        MC = (self.TAxCTL & 0x30) >> 4
-        if MC == 1 or MC == 2:
-            r = self.TAxR
-            r += cycles
-            if MC == 1:
-                ccr0 = self.TAxCCR0
-                if r >= ccr0:
-                    raise base.UnknownBehavior('{:s}: TAxR {:04x} >= TAxCCR0 {:04x}'
-                                               .format(repr(self), r, ccr0))
-            elif MC == 2:
-                if r >= 0xffff:
-                    raise base.UnknownBehavior('{:s}: TAxR {:04x} >= ffff'
-                                               .format(repr(self), r))
-            self.TAxR = r
-        return
+    def _mode(self):
+        return (self._read16(TAxCTL) & 0x30) >> 4
+
+    def _enabled(self):
+        return (self.mem[TAxCCTL0] & CCIE) or (self.mem[TAxCTL] & TAIE)
+
+    # whether the count running over would really end in an interrupt
+    def _deliverable(self):
+        interrupts = self.queue.interrupts
+        return (self._enabled() and interrupts is not None
+                and interrupts.state.readreg(2) & events.GIE)
+
+    # the value TAxR counts up to before something happens, or None if it
+    # isn't counting
+    def _limit(self):
+        MC = self._mode()
+        if MC == 1:
+            ccr0 = self._read16(TAxCCR0)
+            if ccr0 == 0 and self._enabled():
+                return None
+            return ccr0
+        elif MC == 2:
+            return 0xffff
+        return None
+
+    # The count after dt more cycles, starting from r, when it wraps after
+    # limit. A count already past the limit (TAxCCR0 was lowered under it)
+    # goes straight to 0.
+    def _count(self, r, dt, limit):
+        if r > limit:
+            if dt == 0:
+                return r
+            r, dt = 0, dt - 1
+        return (r + dt) % (limit + 1)
+
+    # the cycles from a count of r until it next wraps to 0, and until it next
+    # reaches TAxCCR0
+    def _distances(self, r, limit):
+        ccr0 = self._read16(TAxCCR0)
+        if r > limit:
+            wrap = 1
+        else:
+            wrap = limit - r + 1
+        if r < ccr0 and r <= limit:
+            match = ccr0 - r
+        else:
+            match = wrap + ccr0
+        return wrap, match
+
+    # bring TAxR in mem up to date with the cycle now
+    def _sync(self, now = None):
+        if now is None:
+            now = self.queue.now
+        if self.synced != now:
+            limit = self._limit()
+            if limit is not None:
+                r = self._read16(TAxR)
+                if self._enabled():
+                    self._write16(TAxR, self._count(r, now - self.synced, limit))
+                else:
+                    self._write16(TAxR, r + now - self.synced)
+            self.synced = now
+
+    # schedule the next event, for a TAxR that's up to date
+    def _schedule(self):
+        limit = self._limit()
+        queue = self.queue
+        if limit is None:
+            queue.schedule(self, None)
+        elif self._enabled():
+            r = self._read16(TAxR)
+            cycles = min(self._distances(r, limit))
+            # look at GIE again before the count gets to its limit
+            if r < limit:
+                cycles = min(cycles, limit - r)
+            queue.schedule(self, self.synced + cycles)
+            if self.requests():
+                queue.poll()
+        else:
+            queue.schedule(self, self.synced + limit - self._read16(TAxR))
+
+    def event(self, now):
+        dt = now - self.synced
+        r = self._read16(TAxR)
+        limit = self._limit()
+        if not self._deliverable() and (not self._enabled() or (r < limit and dt >= limit - r)):
+            self._overflow(now - self.queue.now)
+        wrap, match = self._distances(r, limit)
+        if dt >= match:
+            self.mem[TAxCCTL0] |= CCIFG
+        if dt >= wrap:
+            self.mem[TAxCTL] |= TAIFG
+        self._sync(now)
+        self._schedule()
+
+    # Without an interrupt to take, the count would reach its limit during the
+    # cycles being elapsed. The count stays where it was before them.
+    def _overflow(self, cycles):
+        self._sync()
+        r = self._read16(TAxR) + cycles
+        if self._mode() == 1:
+            raise base.UnknownBehavior('{:s}: TAxR {:04x} >= TAxCCR0 {:04x}'
+                                       .format(repr(self), r, self._read16(TAxCCR0)))
+        else:
+            raise base.UnknownBehavior('{:s}: TAxR {:04x} >= ffff'
+                                       .format(repr(self), r))
+
+    # interrupt source interface, see msp_events
+    def requests(self):
+        vectors = []
+        if self.mem[TAxCCTL0] & CCIE and self.mem[TAxCCTL0] & CCIFG:
+            vectors.append(timer_A0_vector)
+        if self.mem[TAxCTL] & TAIE and self.mem[TAxCTL] & TAIFG:
+            vectors.append(timer_A1_vector)
+        return vectors
+
+    # CCIFG is cleared as its interrupt is taken; TAIFG only by software, or
+    # by reading TAxIV
+    def acknowledge(self, n):
+        if n == timer_A0_vector:
+            self.mem[TAxCCTL0] &= ~CCIFG & 0xff
+
+    def _read_iv(self):
+        if self.mem[TAxCTL] & TAIE and self.mem[TAxCTL] & TAIFG:
+            self.mem[TAxCTL] &= ~TAIFG & 0xff
+            return TAxIV_TAIFG
+        return 0
+
+if __name__ == '__main__':
+    import msp_assem as assem
+    import msp_emulator as emulator
+    import msp_fr5969_model as model
+
+    # An image that sets CCIE and then counts down long enough for TAxR to run
+    # past TAxCCR0 in up mode. Without GIE the interrupt can never be taken,
+    # so the run has to stop on the overflow; with GIE it goes to a handler
+    # that just returns, and the run reaches the halt.
+    def overrun_image(gie):
+        code = [
+            ('MOV', '#N', '&ADDR', {'isrc':0x5a80, 'idst':0x015c, 'bw':0}),
+            ('MOV', '#N', '&ADDR', {'isrc':CCIE, 'idst':timer_A_base + TAxCCTL0, 'bw':0}),
+            ('MOV', '#N', '&ADDR', {'isrc':50, 'idst':timer_A_base + TAxCCR0, 'bw':0}),
+            ('MOV', '#N', '&ADDR', {'isrc':0x210, 'idst':timer_A_base + TAxCTL, 'bw':0}),
+            ('MOV', '#N', 'Rn', {'isrc':100, 'rdst':15, 'bw':0}),
+            ('MOV', '#N', 'Rn', {'isrc':0x2400, 'rdst':1, 'bw':0}),
+        ]
+        if gie:
+            code.append(('BIS', '#N', 'Rn', {'isrc':events.GIE, 'rdst':2, 'bw':0}))
+        code += [
+            'LOOP',
+            ('SUB', '#1', 'Rn', {'rdst':15, 'bw':0}),
+            ('JNZ', 'none', 'none', {'s':('JSIGN', 'LOOP'), 'offset':('JLABEL', 'LOOP')}),
+            ('JMP', 'none', 'none', {'s':1, 'offset':0x3ff}),
+            'HANDLER',
+            ('RETI', 'Rn', 'none', {'rsrc':0, 'bw':0}),
+        ]
+        labels = {}
+        words = assem.assemble_symregion(code, model.fram_start, labels)
+        image = []
+        for word in words:
+            image += [word & 0xff, (word >> 8) & 0xff]
+        handler = labels['HANDLER']
+        return image, handler
+
+    failures = 0
+    for gie in [False, True]:
+        image, handler = overrun_image(gie)
+        for tracing in [False, True]:
+            for translate in [False, True]:
+                mulator = emulator.Emulator(tracing=tracing, tinfo='reference', translate=translate, verbosity=-1)
+                mulator.fill(model.fram_start, model.fram_size, [0xff])
+                mulator.mw(model.fram_start, image)
+                mulator.mw(model.ivec_start + 2 * timer_A0_vector, [handler & 0xff, (handler >> 8) & 0xff])
+                mulator.mw(model.resetvec, [model.fram_start & 0xff, (model.fram_start >> 8) & 0xff])
+                mulator.reset()
+                success, steps = mulator.run(max_steps = 10000)
+                if success != gie:
+                    print('GIE {}, tracing {}, translate {}: expected success {}, got {} after {:d} steps'
+                          .format(gie, tracing, translate, gie, success, steps))
+                    failures += 1
+    print('{:d} failures'.format(failures))
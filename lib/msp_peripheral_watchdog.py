@@ -0,0 +1,165 @@
+# msp430 WDT_A emulator
+
+import msp_base as base
+
+WDTCTL = 0x15c
+# the special function registers hold the watchdog's interrupt enable and
+# flag (along with bits for other modules, which are just kept as written)
+SFRIE1 = 0x100
+SFRIFG1 = 0x102
+sfr_size = 4
+# their low bytes, as indices into the ones the watchdog keeps
+IE1 = 0
+IFG1 = SFRIFG1 - SFRIE1
+
+# the high byte of a write to WDTCTL has to be the password, and always reads
+# back as something else
+WDTPW = 0x5a
+WDTPW_READ = 0x69
+
+# WDTCTL bits (low byte)
+WDTHOLD = 0x80
+WDTSSEL = 0x60
+WDTTMSEL = 0x10
+WDTCNTCL = 0x08
+WDTIS = 0x07
+# SFRIE1 / SFRIFG1 bits
+WDTIE = 0x01
+WDTIFG = 0x01
+
+# interrupt vector number (see msp_events) for the interval timer at 0xfff2
+watchdog_vector = 49
+
+# WDTCTL low byte after a PUC: counting 2**15 SMCLK ticks in watchdog mode
+ctl_puc = 0x04
+
+# ticks the counter runs for, for each WDTIS
+intervals = [2**31, 2**27, 2**23, 2**19, 2**15, 2**13, 2**9, 2**6]
+# CPU cycles per tick for each WDTSSEL. SMCLK runs with the CPU; ACLK, VLOCLK
+# and X_CLK all come from VLOCLK (about 9.4 kHz) at reset, against a 1 MHz
+# MCLK. The clock system itself isn't modelled.
+tick_cycles = [1, 106, 106, 106]
+
+# Like the timer, the counter is never stepped. It's kept as the cycles counted
+# as of cycle synced (see msp_events), and whenever WDTCTL changes, the cycle it
+# will run out at is scheduled in the event queue, so keeping the watchdog
+# happy costs nothing per instruction. Running out in interval mode sets
+# WDTIFG; in watchdog mode, or after a write without the password, it causes
+# a PUC, which the emulator carries out through puc.
+#
+# The emulator starts with the watchdog held, as every image it runs holds it
+# first thing; only a PUC sets it going on its own.
+#
+# The model sees a word write to WDTCTL as two byte writes, low byte first,
+# so the low byte is kept until the high byte (with the password) arrives.
+# Byte writes to WDTCTL, which would cause a PUC, aren't told apart from that.
+
+class Peripheral_Watchdog(object):
+    def __init__(self, queue, puc = None):
+        self.queue = queue
+        self.puc = puc
+        self.ctl = WDTHOLD | ctl_puc
+        self.low = self.ctl
+        self.sfr = [0 for _ in range(sfr_size)]
+        self.count = 0
+        self.synced = queue.now
+        self.violation = False
+
+    def attach_watchdog(self, state):
+        state.map_mmio(WDTCTL, 2, self)
+        state.map_mmio(SFRIE1, sfr_size, self)
+        if self.queue.interrupts is not None:
+            self.queue.interrupts.attach(self)
+
+    # MMIO device interface, see msp_fr5969_model
+    def read8(self, addr):
+        if addr == WDTCTL:
+            return self.ctl
+        elif addr == WDTCTL + 1:
+            return WDTPW_READ
+        return self.sfr[addr - SFRIE1]
+
+    def write8(self, addr, v):
+        if addr == WDTCTL:
+            self.low = v
+        elif addr == WDTCTL + 1:
+            self._sync()
+            if v != WDTPW:
+                self.violation = True
+            else:
+                if self.low & WDTCNTCL:
+                    self.count = 0
+                self.ctl = self.low & ~WDTCNTCL & 0xff
+            self._schedule()
+        else:
+            self.sfr[addr - SFRIE1] = v
+            if self.requests():
+                self.queue.poll()
+        return
+
+    # the counter can't be seen, and the flag only changes at events
+    def stable(self, addr):
+        return True
+
+    def snapshot(self):
+        self._sync()
+        return (self.ctl, self.low, tuple(self.sfr), self.count)
+
+    def restore(self, snap):
+        ctl, low, sfr, count = snap
+        self.ctl = ctl
+        self.low = low
+        self.sfr[:] = sfr
+        self.count = count
+        self.synced = self.queue.now
+        self.violation = False
+        self._schedule()
+
+    # cycles from a cleared counter until it runs out
+    def _period(self):
+        return intervals[self.ctl & WDTIS] * tick_cycles[(self.ctl & WDTSSEL) >> 5]
+
+    def _sync(self, now = None):
+        if now is None:
+            now = self.queue.now
+        if not self.ctl & WDTHOLD:
+            self.count += now - self.synced
+        self.synced = now
+
+    def _schedule(self):
+        if self.violation:
+            self.queue.schedule(self, self.synced)
+        elif self.ctl & WDTHOLD:
+            self.queue.schedule(self, None)
+        else:
+            self.queue.schedule(self, self.synced + self._period() - self.count)
+
+    # Returns True after a PUC, which moves the pc.
+    def event(self, now):
+        if self.violation or not self.ctl & WDTTMSEL:
+            if self.puc is None:
+                raise base.UnknownBehavior('watchdog PUC')
+            self.synced = now
+            self.violation = False
+            self.ctl = ctl_puc
+            self.low = ctl_puc
+            self.count = 0
+            self.sfr[IFG1] |= WDTIFG
+            self._schedule()
+            self.puc()
+            return True
+        self._sync(now)
+        self.count %= self._period()
+        self.sfr[IFG1] |= WDTIFG
+        self._schedule()
+        return False
+
+    # interrupt source interface, see msp_events
+    def requests(self):
+        if self.sfr[IE1] & WDTIE and self.sfr[IFG1] & WDTIFG and self.ctl & WDTTMSEL:
+            return [watchdog_vector]
+        return []
+
+    # WDTIFG is cleared as the interval timer's interrupt is taken
+    def acknowledge(self, n):
+        self.sfr[IFG1] &= ~WDTIFG & 0xff
@@ -0,0 +1,392 @@
+# msp430 timing model tables
+
+# A learned timing model (see getmodel.py) is a pair of dicts, ttab and stab,
+# keyed by (state, smt instruction name, source register class, destination
+# register class) as strings, giving the cycles an instruction takes and the
+# state it leaves the model in. Looking those up means building the strings
+# and hashing the tuple on every step, so the emulator compiles them once into
+# flat lists instead, indexed by
+#
+#     ((state * len(isa.ids_ins) + isa.ins_ids[ins]) * rclass_count + rs) * rclass_count + rd
+#
+# where rs and rd are indices into rclass_names. Entries the model doesn't
+# have are no_entry.
+
+import sys
+import os
+import struct
+import array
+import mmap
+import hashlib
+import pickle
+
+import msp_base as base
+import msp_reference_timing as reference_timing
+import smt
+from msp_isa import isa
+
+# register classes, in index order
+rclass_names = [smt.smt_rnames[r] for r in [0, 1, 2, 3, 4, -1]]
+rclass_count = len(rclass_names)
+rclass_none = rclass_names.index(smt.smt_rnames[-1])
+# register number -> class
+rclasses = [0, 1, 2, 3] + [4] * 12
+
+no_entry = -1
+
+# the class of the register in fields[name], if the instruction has one
+def reg_class(fields, name):
+    if name in fields:
+        r = fields[name]
+        if r is not None:
+            return rclasses[r]
+    return rclass_none
+
+# BIC / BIS @SR or @R3 into SR (setting and clearing status bits with the
+# constant generator) aren't covered by the learned models; they take one
+# cycle and go back to state 0.
+def is_cg_status(ins, rs, rd):
+    return (ins.name in {'BIC', 'BIS'} and
+            ins.smode in {'@Rn', '@Rn+'} and
+            ins.dmode in {'Rn'} and
+            rs in {2, 3} and
+            rd == 2)
+
+# The tables are either compiled from a model's dicts by build_tables, or
+# mapped straight out of a file written by save_tables (see below), in which
+# case cycles and next_states are memoryviews of the mapping rather than lists.
+class Timing_Tables(object):
+    def __init__(self, state_default, n_states, cycles, next_states, fname = None):
+        self.state_default = state_default
+        self.n_states = n_states
+        self.stride = len(isa.ids_ins) * rclass_count * rclass_count
+        self.cycles = cycles
+        self.next_states = next_states
+        # the file they were mapped from, if any
+        self.fname = fname
+
+    # offset of an instruction's entries within a state's
+    def row(self, ins, rs, rd):
+        return (isa.ins_ids[ins] * rclass_count + rs) * rclass_count + rd
+
+    def index(self, state, ins, fields):
+        return state * self.stride + self.row(ins, reg_class(fields, 'rsrc'), reg_class(fields, 'rdst'))
+
+    # raise for a missing entry, the way a lookup in the dicts would have
+    def missing(self, state, ins, fields):
+        i = self.index(state, ins, fields)
+        rsname = rclass_names[reg_class(fields, 'rsrc')]
+        rdname = rclass_names[reg_class(fields, 'rdst')]
+        if self.cycles[i] == no_entry:
+            raise base.UnknownBehavior('missing timer entry for {:d} {:s} {:s} {:s}'
+                                       .format(state, smt.smt_iname(ins), rsname, rdname))
+        raise base.UnknownBehavior('missing timer state transition for {:d} {:s} {:s} {:s}'
+                                   .format(state, smt.smt_iname(ins), rsname, rdname))
+
+    # Tables sent to another process (a multiprocessing worker, say) that
+    # were mapped from a file are sent as the file's name, and mapped again
+    # on the other side, so every process shares the one copy.
+    def __getstate__(self):
+        if self.fname is not None:
+            return {'fname' : self.fname}
+        return self.__dict__
+
+    def __setstate__(self, d):
+        if list(d) == ['fname']:
+            d = load_tables(d['fname']).__dict__
+        self.__dict__.update(d)
+
+# compile the dicts of a learned model into tables
+def build_tables(tinfo):
+    ttab = tinfo['ttab']
+    stab = tinfo['stab']
+    state_default = tinfo['state_default']
+    states = set(k[0] for k in ttab) | set(k[0] for k in stab)
+    states.update(s for s in stab.values() if s is not None)
+    states.add(state_default)
+    n_states = max(states) + 1
+    stride = len(isa.ids_ins) * rclass_count * rclass_count
+
+    size = n_states * stride
+    cycles_table = [no_entry] * size
+    next_states = [no_entry] * size
+    tables = Timing_Tables(state_default, n_states, cycles_table, next_states)
+    for state in range(n_states):
+        for ins in isa.ids_ins:
+            iname = smt.smt_iname(ins)
+            for rs, rsname in enumerate(rclass_names):
+                for rd, rdname in enumerate(rclass_names):
+                    key = (state, iname, rsname, rdname)
+                    cycles = ttab.get(key)
+                    new_state = stab.get(key)
+                    if is_cg_status(ins, rs, rd):
+                        if cycles is None:
+                            cycles = 1
+                        if new_state is None:
+                            new_state = 0
+                    i = state * stride + tables.row(ins, rs, rd)
+                    if cycles is not None:
+                        cycles_table[i] = cycles
+                    if new_state is not None:
+                        next_states[i] = new_state
+    return tables
+
+# Compiling takes a while, and every emulator made from the same model gets
+# the same tables, so they're kept for as long as the model's dicts are around
+# (the cache holds on to them, so their ids can't be reused). Tables that were
+# loaded already are what they are.
+compiled = {}
+
+def compile_tables(tinfo):
+    if isinstance(tinfo, Timing_Tables):
+        return tinfo
+    key = (id(tinfo['ttab']), id(tinfo['stab']), tinfo['state_default'])
+    entry = compiled.get(key)
+    if entry is None:
+        entry = (tinfo['ttab'], tinfo['stab'], build_tables(tinfo))
+        compiled[key] = entry
+    return entry[2]
+
+# Timing model files. Pickled dicts take a while to load and then still have
+# to be compiled, and a model learned against a different version of the isa
+# only shows up as a missing entry halfway through a run. Instead, the compiled
+# tables can be written out as they are:
+#
+#     header       struct tables_header, little endian:
+#                  magic, format version, offset of the tables,
+#                  isa fingerprint (see isa_fingerprint),
+#                  number of states, default state,
+#                  number of instructions, number of register classes
+#     rclasses     one byte per register number, its class
+#     rclass_names their smt names, space separated, with a 16 bit length
+#     (padding to a multiple of 8 bytes)
+#     cycles       n_states * stride signed 16 bit integers
+#     next_states  n_states * stride signed 8 bit integers
+#
+# and loaded by mapping the file and viewing the tables in place, so loading
+# is instant, and processes that load the same file share its pages.
+
+# the suffix getmodel.py writes tables for, rather than a pickle
+tables_suffix = '.tables'
+tables_magic = b'MSPT'
+tables_version = 1
+tables_header = struct.Struct('<4sHH20sIIII')
+tables_align = 8
+
+# what a file's tables are indexed by: every instruction's smt name, in
+# isa.ids_ins order, and the register classes
+def isa_fingerprint():
+    h = hashlib.sha1()
+    for ins in isa.ids_ins:
+        h.update(smt.smt_iname(ins).encode('ascii'))
+        h.update(b'\n')
+    h.update(' '.join(rclass_names).encode('ascii'))
+    h.update(bytes(rclasses))
+    return h.digest()
+
+# write tinfo (the dicts of a learned model, or tables) to fname
+def save_tables(tinfo, fname):
+    tables = compile_tables(tinfo)
+    for x in tables.next_states:
+        if not (-128 <= x < 128):
+            raise base.ExecuteError('timing state {:d} too large to save'.format(x))
+    names = ' '.join(rclass_names).encode('ascii')
+    size = tables_header.size + len(rclasses) + 2 + len(names)
+    offset = size + (-size % tables_align)
+
+    header = tables_header.pack(tables_magic, tables_version, offset, isa_fingerprint(),
+                                tables.n_states, tables.state_default,
+                                len(isa.ids_ins), rclass_count)
+    cycles = array.array('h', tables.cycles)
+    next_states = array.array('b', tables.next_states)
+    if sys.byteorder != 'little':
+        cycles.byteswap()
+
+    with open(fname, 'wb') as f:
+        f.write(header)
+        f.write(bytes(rclasses))
+        f.write(struct.pack('<H', len(names)))
+        f.write(names)
+        f.write(bytes(offset - size))
+        f.write(cycles.tobytes())
+        f.write(next_states.tobytes())
+
+def is_tables_file(fname):
+    with open(fname, 'rb') as f:
+        return f.read(len(tables_magic)) == tables_magic
+
+# Map a file written by save_tables. Raises ExecuteError if it isn't one, or
+# if it was written for a different isa.
+def load_tables(fname):
+    fname = os.path.abspath(fname)
+    with open(fname, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < tables_header.size:
+            raise base.ExecuteError('{:s}: not a timing model'.format(fname))
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    (magic, version, offset, fingerprint,
+     n_states, state_default, n_ins, n_rclasses) = tables_header.unpack_from(data, 0)
+    if magic != tables_magic:
+        raise base.ExecuteError('{:s}: not a timing model'.format(fname))
+    if version != tables_version:
+        raise base.ExecuteError('{:s}: timing model format version {:d}, expected {:d}'
+                                .format(fname, version, tables_version))
+    if fingerprint != isa_fingerprint():
+        raise base.ExecuteError('{:s}: stale timing model: written for an isa with {:d} instructions and {:d} register classes, fingerprint {:s}, not {:s}'
+                                .format(fname, n_ins, n_rclasses,
+                                        fingerprint.hex(), isa_fingerprint().hex()))
+
+    stride = n_ins * n_rclasses * n_rclasses
+    size = n_states * stride
+    if len(data) != offset + size * 3:
+        raise base.ExecuteError('{:s}: truncated timing model'.format(fname))
+    view = memoryview(data)
+    cycles = view[offset:offset + size * 2].cast('h')
+    next_states = view[offset + size * 2:offset + size * 3].cast('b')
+    if sys.byteorder != 'little':
+        swapped = array.array('h')
+        swapped.frombytes(cycles.tobytes())
+        swapped.byteswap()
+        cycles = swapped
+        fname = None
+    return Timing_Tables(state_default, n_states, cycles, next_states, fname=fname)
+
+# Load a timing model for the emulator from fname: tables if it's a tables
+# file, otherwise the pickled dicts, as written by getmodel.py.
+def load_model(fname):
+    if is_tables_file(fname):
+        return load_tables(fname)
+    with open(fname, 'rb') as f:
+        return pickle.load(f)
+
+# Block summaries. Since the model is a state machine over instructions, the
+# cycles a straight-line run of instructions takes and the state it ends in
+# only depend on the state it starts in. A summary maps each starting state to
+# (cycles, end state), or to None if the model is missing an entry somewhere
+# along the way. The reference timing has no states; its summaries have the
+# one key None.
+
+# the summary of instrs, a list of (ins, fields), under the timing model tinfo
+def summarize(tinfo, instrs):
+    if tinfo == 'reference':
+        total = 0
+        for ins, fields in instrs:
+            cycles = reference_timing.reference_time(ins, fields)
+            if cycles is None:
+                return {None : None}
+            total += cycles
+        return {None : (total, None)}
+    tables = compile_tables(tinfo)
+    rows = [tables.row(ins, reg_class(fields, 'rsrc'), reg_class(fields, 'rdst'))
+            for ins, fields in instrs]
+    summary = {}
+    for start in range(tables.n_states):
+        state = start
+        total = 0
+        for row in rows:
+            i = state * tables.stride + row
+            cycles = tables.cycles[i]
+            state = tables.next_states[i]
+            if cycles < 0 or state < 0:
+                total = None
+                break
+            total += cycles
+        if total is None:
+            summary[start] = None
+        else:
+            summary[start] = (total, state)
+    return summary
+
+# the summary of running the instructions summarized by first, then the ones
+# summarized by second
+def compose(first, second):
+    summary = {}
+    for start, entry in first.items():
+        if entry is None or second.get(entry[1]) is None:
+            summary[start] = None
+        else:
+            cycles, state = second[entry[1]]
+            summary[start] = (entry[0] + cycles, state)
+    return summary
+
+# Minimization. A timing model is a Mealy machine: from each state, each
+# instruction (an entry in a state's row of the tables) outputs some cycles
+# and moves to a next state. Learned models often have more states than they
+# need, since the solver was asked for a fixed number of them, and most
+# instructions behave the same as plenty of others. Two states are equivalent
+# if every sequence of instructions takes the same cycles from either one, and
+# two entries of a row are equivalent (the same input class) if, from every
+# state, they take the same cycles to equivalent states. A missing entry is
+# an output of its own.
+
+# the (instruction, source register class, destination register class) of an
+# offset within a state's row
+def unrow(row):
+    ins = isa.ids_ins[row // (rclass_count * rclass_count)]
+    return ins, (row // rclass_count) % rclass_count, row % rclass_count
+
+# The states reachable from the default state, and the equivalence class of
+# each as a dict. Classes are numbered in order of their lowest state.
+def state_classes(tables):
+    stride = tables.stride
+    cycles = tables.cycles
+    next_states = tables.next_states
+
+    reachable = {tables.state_default}
+    frontier = [tables.state_default]
+    while frontier:
+        state = frontier.pop()
+        for new_state in set(next_states[state * stride:(state + 1) * stride]):
+            if 0 <= new_state < tables.n_states and new_state not in reachable:
+                reachable.add(new_state)
+                frontier.append(new_state)
+    states = sorted(reachable)
+
+    # start from the cycles each state outputs, then split classes whose
+    # states go to different classes until nothing changes
+    outputs = {state : tuple(cycles[state * stride:(state + 1) * stride]) for state in states}
+    classes = number_classes(states, outputs)
+    while True:
+        sigs = {}
+        for state in states:
+            row = next_states[state * stride:(state + 1) * stride]
+            sigs[state] = (classes[state], tuple(classes.get(s, no_entry) for s in row))
+        refined = number_classes(states, sigs)
+        if len(set(refined.values())) == len(set(classes.values())):
+            return refined
+        classes = refined
+
+# number the distinct values of sigs, in order of the first key with each
+def number_classes(keys, sigs):
+    ids = {}
+    classes = {}
+    for k in keys:
+        classes[k] = ids.setdefault(sigs[k], len(ids))
+    return classes
+
+# The minimized tables of a model, along with the class of each of its
+# states (see state_classes), and its input classes: a list of the offsets
+# within a row that behave the same, ordered by their first.
+def minimize(tinfo):
+    tables = compile_tables(tinfo)
+    stride = tables.stride
+    classes = state_classes(tables)
+    n_states = len(set(classes.values()))
+
+    reps = {}
+    for state in sorted(classes):
+        reps.setdefault(classes[state], state)
+    cycles = []
+    next_states = []
+    for c in range(n_states):
+        base_i = reps[c] * stride
+        cycles.extend(tables.cycles[base_i:base_i + stride])
+        next_states.extend(classes.get(s, no_entry) for s in tables.next_states[base_i:base_i + stride])
+    minimized = Timing_Tables(classes[tables.state_default], n_states, cycles, next_states)
+
+    columns = {}
+    for row in range(stride):
+        column = tuple((cycles[c * stride + row], next_states[c * stride + row])
+                       for c in range(n_states))
+        columns.setdefault(column, []).append(row)
+    inputs = sorted(columns.values())
+    return minimized, classes, inputs
@@ -0,0 +1,741 @@
+# msp430 basic block translator
+
+# Interpreting an instruction costs three closure calls (readfields, execute,
+# writefields) passing a freshly built fields dict between them. For code that
+# runs more than once it's much cheaper to find a straight-line run of
+# instructions, and compile the whole run into one python function that makes
+# the same register and memory accesses, in the same order, with locals.
+#
+# Blocks are only built from code in RAM or FRAM, and only used when tracing is
+# off: the generated code bakes in the instruction words instead of re-reading
+# them, so it doesn't produce the io events the trace expects. Every byte a
+# block was built from is registered in the model's code_watch, and writing it
+# throws the block away; a block that overwrites its own code returns right
+# after the write that did it.
+#
+# Cold code that matches one of the common sequences in msp_fuse is run by
+# its fused handlers instead of being stepped, and blocks that turn out to be
+# idle loops (see msp_idle) are skipped over instead of run over and over.
+#
+# Anything unusual (instructions that raise UnknownBehavior based on their
+# encoding, DADD, RETI, ...) is still included, but runs through its
+# readfields / execute / writefields as normal, so behavior only has to be
+# reproduced for the common cases.
+
+import msp_base as base
+import msp_fr5969_model as model
+import msp_fuse as fuse
+import msp_idle as idle
+import msp_instr as instr
+from msp_isa import isa
+
+max_block_length = 64
+# Compiling a block costs about as much as interpreting its instructions a
+# dozen times, so code is only translated once it has been reached this often;
+# straight-line code that runs once (like most micro images) is never compiled.
+hot_threshold = 16
+
+# addressing modes that go through msp_addr.mk_readfields_cg
+cg_smodes = {'Rn', 'X(Rn)', '#1', '@Rn', '@Rn+'}
+# addressing modes that have an extension word
+ext_modes = {'X(Rn)', 'ADDR', '&ADDR', '#N', '#@N'}
+
+def is_code_addr(addr):
+    return ((model.ram_start <= addr and addr < model.ram_start + model.ram_size) or
+            (model.fram_start <= addr and addr < model.fram_start + model.fram_size))
+
+# flag computations for the packed SR: c is bit 0, z bit 1, n bit 2, v bit 8
+sr_flag_mask = (~0x107) & model.reg_bitmask
+
+def mask_bw(bw):
+    if bw == 0:
+        return instr.pc_bitmask
+    else:
+        return model.reg_bitmask
+
+def emit_read(name, a, bw):
+    if bw == 0:
+        return ['{:s} = read16({:s})'.format(name, a)]
+    else:
+        return ['{:s} = read8({:s})'.format(name, a)]
+
+def emit_write(a, x, bw):
+    if bw == 0:
+        return ['write16({:s}, {:s})'.format(a, x)]
+    else:
+        return ['write8({:s}, {:s})'.format(a, x)]
+
+def emit_flags(bits, c, v, flags = True):
+    # expects the truncated result in rt
+    if not flags:
+        return []
+    return ['sr = ((sr & {:#x}) | ({:s}) | ((rt == 0) << 1) | ((rt >> {:d}) << 2) | (({:s}) << 8))'
+            .format(sr_flag_mask, c, bits - 1, v)]
+
+# Everything we know about one instruction at translation time.
+
+class Slot(object):
+    def __init__(self, ins, pc, word, static, ext):
+        self.ins = ins
+        self.pc = pc
+        self.word = word
+        self.static = static
+        self.decoded = instr.predecode(ins, word)
+        self.ext = ext
+        self.bw = static.get('bw', 0)
+        if ins.smode in cg_smodes:
+            self.cgsrc = instr.cg_value(static['as'], static['rsrc'], self.bw)
+        else:
+            self.cgsrc = None
+
+        # replay the sequence of read_another_word calls
+        next_pc = instr.pcadd(pc, 2)
+        ext_i = 0
+        self.isrc = None
+        self.src_pc = None
+        if ins.smode in ext_modes and self.cgsrc is None:
+            self.isrc = ext[ext_i]
+            ext_i += 1
+            next_pc = instr.pcadd(next_pc, 2)
+            self.src_pc = next_pc
+        self.idst = None
+        self.dst_pc = None
+        if ins.dmode in ext_modes:
+            self.idst = ext[ext_i]
+            ext_i += 1
+            next_pc = instr.pcadd(next_pc, 2)
+            self.dst_pc = next_pc
+        self.next_pc = next_pc
+        self.readpc = instr.pcadd(pc, ins.length)
+
+    def push_call(self):
+        return self.ins.name in {'PUSH', 'CALL'} and self.ins.smode in {'X(Rn)', '@Rn+'}
+
+    # Does this instruction put something other than the next pc in the pc?
+    def ends_block(self):
+        ins = self.ins
+        if ins.fmt == 'jump' or ins.name in {'CALL', 'RETI'}:
+            return True
+        elif ins.fmt == 'fmt1':
+            return ins.dmode == 'Rn' and self.static['rdst'] == 0
+        elif ins.fmt == 'fmt2':
+            return ins.smode == 'Rn' and self.static['rsrc'] == 0
+        return True
+
+    # Can we write out code for this instruction, or does it have to be
+    # interpreted? Mostly mirrors the checks that raise UnknownBehavior in the
+    # fmt1 / fmt2 writefields functions.
+    def inline(self):
+        ins = self.ins
+        f = self.static
+        if ins.fmt == 'jump':
+            return True
+        elif ins.fmt == 'fmt1':
+            if ins.name == 'DADD':
+                return False
+            if ins.smode == '#1' and self.cgsrc is None:
+                return False
+            if ins.dmode == 'Rn' and f['rdst'] == 0:
+                if f['bw'] == 1 and ins.name not in {'CMP', 'BIT'}:
+                    return False
+                elif ins.name not in {'CMP', 'BIT', 'MOV'}:
+                    return False
+            if ins.dmode == 'X(Rn)' and f['rdst'] == 3:
+                return False
+            return True
+        elif ins.fmt == 'fmt2':
+            if ins.name == 'RETI':
+                return False
+            elif ins.name == 'PUSH':
+                return not (ins.smode not in {'Rn'} and f['rsrc'] in {1})
+            elif ins.name == 'CALL':
+                return not ((ins.smode in {'Rn'} and f['rsrc'] in {0,1,2,3}) or
+                            self.cgsrc is not None or f['rsrc'] in {1})
+            elif ins.name in {'SWPB', 'SXT'} and f['bw'] != 0:
+                return False
+            elif ins.smode in {'#N', '#@N', '#1'}:
+                return False
+            elif ins.smode == 'Rn':
+                return f['rsrc'] not in {0,2}
+            else:
+                return self.cgsrc is None
+        return False
+
+    # Flags are only computed where something can see them (see
+    # Translator.dead_flags). Every instruction that sets flags sets all four.
+    def sets_flags(self):
+        ins = self.ins
+        if ins.fmt == 'fmt1':
+            return ins.name in {'ADD', 'ADDC', 'SUB', 'SUBC', 'CMP', 'BIT', 'AND', 'XOR'}
+        elif ins.fmt == 'fmt2':
+            return ins.name in {'RRC', 'RRA', 'SXT'}
+        return False
+
+    # Could anything see the flags as they are before this instruction? That's
+    # the case if it reads them (or R2 as a whole), or if it can raise or end the
+    # block early, which leaves SR as it is for whoever looks next.
+    def observes_flags(self, timing):
+        ins = self.ins
+        f = self.static
+        if timing or not self.inline() or ins.fmt == 'jump':
+            return True
+        if ins.name in {'ADDC', 'SUBC', 'RRC', 'PUSH', 'CALL'}:
+            return True
+        if self.cgsrc is None:
+            if ins.smode == 'Rn':
+                if f['rsrc'] == 2:
+                    return True
+            elif ins.smode not in {'#N', '#@N'}:
+                return True
+        if ins.fmt == 'fmt1':
+            return ins.dmode != 'Rn' or f['rdst'] == 2
+        return False
+
+    def writes_memory(self):
+        ins = self.ins
+        if ins.fmt == 'fmt1':
+            return ins.dmode != 'Rn'
+        elif ins.fmt == 'fmt2':
+            return ins.smode != 'Rn' or ins.name in {'PUSH', 'CALL'}
+        return False
+
+    # readfields
+
+    def emit_src(self):
+        ins = self.ins
+        f = self.static
+        bw = self.bw
+        smode = ins.smode
+        if self.cgsrc is not None:
+            return ['src = {:#x}'.format(self.cgsrc)]
+        rsrc = f['rsrc']
+        if smode == 'Rn':
+            if rsrc == 0:
+                return ['src = {:#x}'.format(self.readpc)]
+            else:
+                return ['src = regs[{:d}]'.format(rsrc)]
+        elif smode == 'X(Rn)':
+            if self.push_call() and rsrc == 1:
+                offset = '((regs[1] - 2) & {:#x})'.format(model.reg_bitmask)
+            else:
+                offset = 'regs[{:d}]'.format(rsrc)
+            return (['asrc = ({:#x} + {:s}) & {:#x}'.format(self.isrc, offset, 0xffff & mask_bw(bw))] +
+                    emit_read('src', 'asrc', bw))
+        elif smode == 'ADDR':
+            a = ((self.isrc - 2 + self.src_pc) & 0xffff) & mask_bw(bw)
+            return ['asrc = {:#x}'.format(a)] + emit_read('src', 'asrc', bw)
+        elif smode == '&ADDR':
+            a = (self.isrc & 0xffff) & mask_bw(bw)
+            return ['asrc = {:#x}'.format(a)] + emit_read('src', 'asrc', bw)
+        elif smode == '@Rn':
+            if bw == 0:
+                lines = ['asrc = regs[{:d}] & {:#x}'.format(rsrc, instr.pc_bitmask)]
+            else:
+                lines = ['asrc = regs[{:d}]'.format(rsrc)]
+            return lines + emit_read('src', 'asrc', bw)
+        elif smode == '@Rn+':
+            lines = ['asrc = regs[{:d}]'.format(rsrc)]
+            if bw == 0:
+                lines += emit_read('src', '(asrc & {:#x})'.format(instr.pc_bitmask), bw)
+            else:
+                lines += emit_read('src', 'asrc', bw)
+            if self.push_call():
+                if rsrc == 1:
+                    offset = None
+                elif bw == 0:
+                    offset = 2
+                else:
+                    offset = 1
+            elif bw == 0 or rsrc == 1:
+                offset = 2
+            else:
+                offset = 1
+            if offset is not None and rsrc != 3:
+                lines += ['regs[{:d}] = (asrc + {:d}) & {:#x}'.format(rsrc, offset, model.reg_bitmask)]
+            return lines
+        elif smode in {'#N', '#@N'}:
+            return ['src = {:#x}'.format(self.isrc)]
+        raise base.ExecuteError('cannot translate source mode {:s}'.format(smode))
+
+    def emit_dst(self):
+        ins = self.ins
+        f = self.static
+        bw = self.bw
+        dmode = ins.dmode
+        rdst = f['rdst']
+        if dmode == 'Rn':
+            if rdst == 0:
+                return ['dst = {:#x}'.format(self.readpc)]
+            else:
+                return ['dst = regs[{:d}]'.format(rdst)]
+        elif dmode == 'X(Rn)':
+            return (['adst = ({:#x} + regs[{:d}]) & {:#x}'.format(self.idst, rdst, 0xffff & mask_bw(bw))] +
+                    emit_read('dst', 'adst', bw))
+        elif dmode == 'ADDR':
+            a = ((self.idst - 2 + self.dst_pc) & 0xffff) & mask_bw(bw)
+            return ['adst = {:#x}'.format(a)] + emit_read('dst', 'adst', bw)
+        elif dmode == '&ADDR':
+            a = (self.idst & 0xffff) & mask_bw(bw)
+            return ['adst = {:#x}'.format(a)] + emit_read('dst', 'adst', bw)
+        raise base.ExecuteError('cannot translate destination mode {:s}'.format(dmode))
+
+    # execute
+
+    def emit_fmt1_exec(self, flags = True):
+        name = self.ins.name
+        if self.bw == 0:
+            bits = 16
+        else:
+            bits = 8
+        mask = (1 << bits) - 1
+        msb = 1 << (bits - 1)
+        s = 'src & {:#x}'.format(mask)
+        d = 'dst & {:#x}'.format(mask)
+        carry = '(r >> {:d}) & 1'.format(bits)
+        if name == 'MOV':
+            return ['dst = {:s}'.format(s)]
+        elif name == 'BIC':
+            return ['dst = (~src & dst) & {:#x}'.format(mask)]
+        elif name == 'BIS':
+            return ['dst = (src | dst) & {:#x}'.format(mask)]
+        elif name in {'ADD', 'ADDC'}:
+            if name == 'ADD':
+                r = 'd + s'
+            else:
+                r = 'd + s + (sr & 1)'
+            return (['s = {:s}'.format(s), 'd = {:s}'.format(d),
+                     'r = {:s}'.format(r), 'rt = r & {:#x}'.format(mask)] +
+                    emit_flags(bits, carry, '((s ^ rt) & (d ^ rt) & {:#x}) != 0'.format(msb), flags) +
+                    ['dst = rt'])
+        elif name in {'SUB', 'SUBC', 'CMP'}:
+            if name == 'SUBC':
+                r = '(~s & {:#x}) + (sr & 1) + d'.format(mask)
+            else:
+                r = '(~s & {:#x}) + 1 + d'.format(mask)
+            lines = (['s = {:s}'.format(s), 'd = {:s}'.format(d),
+                      'r = {:s}'.format(r), 'rt = r & {:#x}'.format(mask)] +
+                     emit_flags(bits, carry, '((s ^ d) & (d ^ rt) & {:#x}) != 0'.format(msb), flags))
+            if name != 'CMP':
+                lines += ['dst = rt']
+            return lines
+        elif name in {'BIT', 'AND'}:
+            lines = ['rt = ({:s}) & ({:s})'.format(d, s)] + emit_flags(bits, 'rt != 0', '0', flags)
+            if name == 'AND':
+                lines += ['dst = rt']
+            return lines
+        elif name == 'XOR':
+            return (['s = {:s}'.format(s), 'd = {:s}'.format(d), 'rt = d ^ s'] +
+                    emit_flags(bits, 'rt != 0', '(s & d & {:#x}) != 0'.format(msb), flags) +
+                    ['dst = rt'])
+        raise base.ExecuteError('cannot translate {:s}'.format(name))
+
+    def emit_fmt2_exec(self, flags = True):
+        name = self.ins.name
+        if self.bw == 0:
+            bits = 16
+        else:
+            bits = 8
+        mask = (1 << bits) - 1
+        msb = 1 << (bits - 1)
+        if name == 'RRC':
+            return (['s = src & {:#x}'.format(mask),
+                     'rt = (s >> 1) | ((sr & 1) << {:d})'.format(bits - 1)] +
+                    emit_flags(bits, 's & 1', '0', flags) +
+                    ['src = rt'])
+        elif name == 'RRA':
+            return (['s = src & {:#x}'.format(mask),
+                     'rt = (s >> 1) | (s & {:#x})'.format(msb)] +
+                    emit_flags(bits, 's & 1', '0', flags) +
+                    ['src = rt'])
+        elif name == 'SWPB':
+            return ['src = ((src & 0xff) << 8) | ((src >> 8) & 0xff)']
+        elif name == 'SXT':
+            return (['if src & 0x80:',
+                     '    rt = (src | -256) & 0xffff',
+                     'else:',
+                     '    rt = src & 0xff'] +
+                    emit_flags(16, 'rt != 0', '0', flags) +
+                    ['src = rt'])
+        elif name in {'PUSH', 'CALL'}:
+            return []
+        raise base.ExecuteError('cannot translate {:s}'.format(name))
+
+    # writefields
+
+    def emit_fmt1_write(self, flags = True):
+        ins = self.ins
+        f = self.static
+        if ins.dmode == 'Rn':
+            rdst = f['rdst']
+            lines = []
+            if rdst == 2:
+                lines += ['if dst & {:#x} != 0:'.format((~271) & 0xfffff),
+                          "    raise base.UnknownBehavior('fmt1 invalid SR write: {:05x}'.format(dst))"]
+            lines += ['regs[0] = {:#x}'.format(self.next_pc)]
+            if rdst != 3:
+                lines += ['regs[{:d}] = dst'.format(rdst)]
+            if flags and not instr.is_sr_safe(ins):
+                lines += ['regs[2] = sr']
+            return lines
+        else:
+            return (['regs[0] = {:#x}'.format(self.next_pc), 'regs[2] = sr'] +
+                    emit_write('adst', 'dst', self.bw))
+
+    def emit_fmt2_write(self, flags = True):
+        ins = self.ins
+        f = self.static
+        rsrc = f['rsrc']
+        if ins.name == 'PUSH':
+            if self.bw == 0:
+                mask = 0xffff
+            else:
+                mask = 0xff
+            return (['regs[0] = {:#x}'.format(self.next_pc), 'regs[2] = sr',
+                     'sp = (regs[1] - 2) & {:#x}'.format(model.reg_bitmask),
+                     'regs[1] = sp',
+                     'src = src & {:#x}'.format(mask)] +
+                    emit_write('sp', 'src', self.bw))
+        elif ins.name == 'CALL':
+            return (['sp = (regs[1] - 2) & {:#x}'.format(model.reg_bitmask),
+                     'regs[1] = sp'] +
+                    emit_write('sp', '{:#x}'.format(self.next_pc), 0) +
+                    ['regs[0] = src'])
+        elif ins.smode == 'Rn':
+            lines = ['regs[0] = {:#x}'.format(self.next_pc)]
+            if rsrc != 3:
+                lines += ['regs[{:d}] = src'.format(rsrc)]
+            if flags and not instr.is_sr_safe(ins):
+                lines += ['regs[2] = sr']
+            return lines
+        else:
+            return (['regs[0] = {:#x}'.format(self.next_pc), 'regs[2] = sr'] +
+                    emit_write('asrc', 'src', self.bw))
+
+    def jump_target(self):
+        jump_offset = (self.static['offset'] << 1) | (-self.static['s'] << 10)
+        return instr.pcadd(self.next_pc, jump_offset)
+
+    def emit_jump(self):
+        name = self.ins.name
+        cond = {
+            'JNZ' : 'not (sr & 2)',
+            'JZ'  : 'sr & 2',
+            'JNC' : 'not (sr & 1)',
+            'JC'  : 'sr & 1',
+            'JN'  : 'sr & 4',
+            'JGE' : 'not (((sr >> 2) ^ (sr >> 8)) & 1)',
+            'JL'  : '((sr >> 2) ^ (sr >> 8)) & 1',
+        }
+        taken_pc = self.jump_target()
+        if name == 'JMP':
+            return ['regs[0] = {:#x}'.format(taken_pc)]
+        return ['if {:s}:'.format(cond[name]),
+                '    regs[0] = {:#x}'.format(taken_pc),
+                'else:',
+                '    regs[0] = {:#x}'.format(self.next_pc)]
+
+    # the whole instruction, assuming self.inline() is true
+
+    # if flags is False, the flags this instruction sets are dead, so it
+    # leaves SR alone
+
+    def emit(self, flags = True):
+        ins = self.ins
+        if flags:
+            load_sr = ['sr = regs[2]']
+        else:
+            load_sr = []
+        if ins.fmt == 'jump':
+            return load_sr + self.emit_jump()
+        elif ins.fmt == 'fmt1':
+            return (load_sr + self.emit_src() + self.emit_dst() +
+                    self.emit_fmt1_exec(flags) + self.emit_fmt1_write(flags))
+        else:
+            return (load_sr + self.emit_src() +
+                    self.emit_fmt2_exec(flags) + self.emit_fmt2_write(flags))
+
+# A compiled block. fn(steps) runs it and adds the number of instructions that
+# completed to steps[0], even if one of them raises.
+
+class Block(object):
+    def __init__(self, translator, pc, slots, addrs):
+        self.translator = translator
+        self.pc = pc
+        self.slots = slots
+        self.addrs = addrs
+        self.length = len(slots)
+        # pcs inside the block, which a run can't stop at
+        self.inner = frozenset(slot.pc for slot in slots[1:])
+        # the reads it makes, if it could be an idle loop
+        self.idle = idle.loop_reads(pc, slots)
+        self.live = [True]
+        self.fn = None
+        self.source = None
+
+    def invalidate(self):
+        self.live[0] = False
+        code_watch = self.translator.state.code_watch
+        for addr in self.addrs:
+            watchers = code_watch.get(addr)
+            if watchers is not None:
+                watchers.discard(self)
+                if not watchers:
+                    del code_watch[addr]
+        if self.translator.blocks.get(self.pc) is self:
+            del self.translator.blocks[self.pc]
+            self.translator.backoff(self.pc)
+
+class Translator(object):
+    def __init__(self, emulator, verbosity = 0):
+        self.emulator = emulator
+        self.state = emulator.state
+        self.blocks = {}
+        self.counts = {}
+        self.rewrites = {}
+        self.timing = emulator.timing
+        self.verbosity = verbosity
+
+    # Blocks are compiled with or without the timer updates, so running under a
+    # profile that times differently throws all of them away.
+    def set_timing(self, timing):
+        if timing == self.timing:
+            return
+        blocks = self.blocks
+        self.blocks = {}
+        self.counts = {}
+        for block in blocks.values():
+            block.invalidate()
+        self.timing = timing
+
+    # Code that keeps getting overwritten would be recompiled over and over,
+    # so each time a block is thrown away its pc has to get twice as hot
+    # before it's translated again.
+    def backoff(self, pc):
+        rewrites = self.rewrites.get(pc, 0) + 1
+        self.rewrites[pc] = rewrites
+        self.counts[pc] = hot_threshold - (hot_threshold << rewrites)
+
+    # Decode a run of instructions starting at pc. Stops before anything
+    # we can't decode from RAM / FRAM (including the halt pad, which is
+    # left to Emulator.step) and after anything that writes the pc.
+    def scan(self, pc):
+        read16 = self.state.read16
+        slots = []
+        addrs = []
+        while len(slots) < max_block_length:
+            if not (is_code_addr(pc) and is_code_addr(pc + 1)):
+                break
+            word = read16(pc)
+            ins = isa.decode(word)
+            if word == 0x3fff or ins is None or ins.fmt not in {'fmt1', 'fmt2', 'jump'}:
+                break
+            if not all(is_code_addr(a) for a in range(pc, pc + ins.length)):
+                break
+            ext = [read16(a) for a in range(pc + 2, pc + ins.length, 2)]
+            slot = Slot(ins, pc, word, instr.static_fields(ins, word), ext)
+            slots.append(slot)
+            addrs.extend(range(pc, pc + ins.length))
+            if slot.ends_block():
+                break
+            pc = slot.next_pc
+        return slots, addrs
+
+    # Which instructions' flags are overwritten by a later one in the block
+    # before anything could see them. This is lazy flag evaluation done at
+    # translation time: SR is only brought up to date where it can be observed.
+    def dead_flags(self, block):
+        dead = [False for _ in block.slots]
+        # everything is visible after the block
+        observed = True
+        for i in reversed(range(block.length)):
+            slot = block.slots[i]
+            if slot.observes_flags(self.timing):
+                # this also covers anything that can raise after setting its
+                # own flags, so only quiet instructions are ever skipped
+                observed = True
+            elif slot.sets_flags():
+                dead[i] = not observed
+                observed = False
+        return dead
+
+    # The generated source and the part of the namespace that only depends on
+    # the instructions; the rest of the namespace is bound by instantiate.
+    def generate(self, block):
+        timing = self.timing
+        consts = {'base' : base}
+        dead = self.dead_flags(block)
+
+        body = []
+        for i, slot in enumerate(block.slots):
+            ins = slot.ins
+            consts['ins_{:d}'.format(i)] = ins
+            body += ['# {:05x}: {:s} {:s} {:s}'.format(slot.pc, ins.name, ins.smode, ins.dmode),
+                     'n = {:d}'.format(i)]
+            if slot.inline():
+                body += slot.emit(not dead[i])
+            else:
+                consts['decoded_{:d}'.format(i)] = slot.decoded
+                body += ['fields = ins_{:d}.readfields(state, decoded_{:d})'.format(i, i),
+                         'ins_{:d}.execute(fields)'.format(i),
+                         'ins_{:d}.writefields(state, fields)'.format(i)]
+            if timing:
+                consts['static_{:d}'.format(i)] = slot.static
+                # an interrupt taken here leaves the rest of the block for later
+                if i < block.length - 1:
+                    body += ['if elapse(timer_cached(costs_{:d}, ins_{:d}, static_{:d})):'.format(i, i, i),
+                             '    steps[0] += {:d}'.format(i + 1),
+                             '    return']
+                else:
+                    body += ['elapse(timer_cached(costs_{:d}, ins_{:d}, static_{:d}))'.format(i, i, i)]
+            if slot.writes_memory() and i < block.length - 1:
+                body += ['if not live[0]:',
+                         '    steps[0] += {:d}'.format(i + 1),
+                         '    return']
+
+        lines = ['def block(steps):',
+                 '    n = 0',
+                 '    try:']
+        lines += ['        ' + line for line in body]
+        lines += ['    except:',
+                  '        steps[0] += n',
+                  '        raise',
+                  '    steps[0] += {:d}'.format(block.length)]
+        source = '\n'.join(lines) + '\n'
+
+        if self.verbosity >= 3:
+            print('translated block at {:05x}:'.format(block.pc))
+            print(source)
+
+        return source, consts
+
+    def instantiate(self, block, code, consts):
+        namespace = dict(consts)
+        namespace['state'] = self.state
+        namespace['regs'] = self.state.regs
+        namespace['read8'] = self.state.read8
+        namespace['write8'] = self.state.write8
+        namespace['read16'] = self.state.read16
+        namespace['write16'] = self.state.write16
+        namespace['live'] = block.live
+        if self.timing:
+            namespace['timer_cached'] = self.emulator._timer_cached
+            namespace['elapse'] = self.emulator.events.elapse
+            # one timing memo per slot, thrown away along with the block
+            for i in range(block.length):
+                namespace['costs_{:d}'.format(i)] = {}
+        exec(code, namespace)
+        block.fn = namespace['block']
+
+    def compile(self, block):
+        source, consts = self.generate(block)
+        code = compile(source, '<block {:05x}>'.format(block.pc), 'exec')
+        self.instantiate(block, code, consts)
+        block.source = source
+        return code, consts
+
+    def translate(self, pc):
+        slots, addrs = self.scan(pc)
+        # even an empty block watches its first word, so that the pc
+        # is looked at again if something is written there
+        if not slots:
+            addrs = [a for a in [pc, pc + 1] if is_code_addr(a)]
+        block = Block(self, pc, slots, addrs)
+        if slots:
+            self.compile(block)
+        code_watch = self.state.code_watch
+        for addr in addrs:
+            if addr in code_watch:
+                code_watch[addr].add(block)
+            else:
+                code_watch[addr] = {block}
+        self.blocks[pc] = block
+        return block
+
+    # Run the sequence of fused instructions at pc (see msp_fuse), if there is
+    # one that fits in max_steps (if positive) without running past a pc in
+    # stop. Returns False if there isn't.
+    def fuse(self, pc, max_steps, steps, stop):
+        max_length = max_block_length
+        if max_steps > 0:
+            max_length = min(max_length, max_steps - steps[0])
+        groups = fuse.match(self.state.mem, pc, max_length, stop)
+        if groups is None:
+            return False
+        if self.verbosity >= 3:
+            print('fused at {:05x}: {:s}'.format(pc, ', '.join('{:s} x{:d}'.format(handler.__name__, len(slots))
+                                                               for handler, slots in groups)))
+        for handler, slots in groups:
+            if handler(self, slots, steps):
+                break
+        return True
+
+    # Run an idle loop block once, and if that shows it will keep going round
+    # the same way (see msp_idle), count as many more runs through it as fit
+    # before max_steps (if positive) or the next scheduled event without running
+    # them. Nothing is skipped if the loop's pc is in stop.
+    def spin(self, block, max_steps, steps, stop):
+        regs = self.state.regs
+        emulator = self.emulator
+        before = list(regs)
+        if self.timing:
+            timer_state = emulator.timer_state
+            timer_cycles = emulator.timer_cycles
+        block.fn(steps)
+        if regs != before or block.pc in stop or not idle.stable(self.state, block.idle):
+            return
+        runs = None
+        if max_steps > 0:
+            runs = (max_steps - steps[0]) // block.length
+        if self.timing:
+            if emulator.timer_state != timer_state:
+                return
+            cycles = emulator.timer_cycles - timer_cycles
+            headroom = emulator.events.headroom()
+            if headroom is not None and cycles > 0:
+                timer_runs = max(headroom, 0) // cycles
+                if runs is None or timer_runs < runs:
+                    runs = timer_runs
+        # with no step limit and no event coming, it really does spin forever
+        if not runs:
+            return
+        if self.verbosity >= 3:
+            print('skipped {:d} runs through the idle loop at {:05x}'.format(runs, block.pc))
+        steps[0] += runs * block.length
+        if self.timing:
+            emulator.timer_cycles += runs * cycles
+            emulator.events.elapse(runs * cycles)
+
+    # Run until halt (returning True), or max_steps (if positive) or a pc in
+    # the set stop (returning False), falling back to fused handlers or the
+    # emulator's step for anything that isn't (yet) in a block, or for a block
+    # that would run past max_steps or a pc in stop. Counts executed
+    # instructions in steps[0].
+    def run(self, max_steps, steps, stop = frozenset()):
+        regs = self.state.regs
+        blocks = self.blocks
+        counts = self.counts
+        step = self.emulator.step
+        fuse_at = self.fuse
+        while True:
+            pc = regs[0]
+            block = blocks.get(pc)
+            if block is None:
+                count = counts.get(pc, 0) + 1
+                if count >= hot_threshold:
+                    block = self.translate(pc)
+                else:
+                    counts[pc] = count
+            if (block is not None and block.fn is not None and (max_steps <= 0 or steps[0] + block.length <= max_steps)
+                and (not stop or stop.isdisjoint(block.inner))):
+                if block.idle is None:
+                    block.fn(steps)
+                else:
+                    self.spin(block, max_steps, steps, stop)
+            elif not fuse_at(pc, max_steps, steps, stop):
+                if not step():
+                    return True
+                steps[0] += 1
+            if max_steps > 0 and steps[0] >= max_steps:
+                return False
+            if regs[0] in stop:
+                return False
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# minimize a timing model's state machine, and draw it
+
+import sys
+import os
+
+libdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'lib')
+sys.path.append(libdir)
+
+import smt
+import msp_timing as timing
+
+def input_name(row):
+    ins, rs, rd = timing.unrow(row)
+    return '{:s} {:s} {:s}'.format(smt.smt_iname(ins), timing.rclass_names[rs], timing.rclass_names[rd])
+
+# one line per input class: what it does from each state, and what's in it
+def describe_inputs(tables, inputs, verbosity = 0):
+    for k, rows in enumerate(inputs):
+        outs = []
+        for state in range(tables.n_states):
+            i = state * tables.stride + rows[0]
+            cycles = tables.cycles[i]
+            new_state = tables.next_states[i]
+            if cycles < 0:
+                outs.append('{:d}: -'.format(state))
+            elif new_state < 0:
+                outs.append('{:d}: {:d} -> -'.format(state, cycles))
+            else:
+                outs.append('{:d}: {:d} -> {:d}'.format(state, cycles, new_state))
+        print('I{:d} ({:s}): {:d} inputs'.format(k, ', '.join(outs), len(rows)))
+        if verbosity >= 2:
+            for row in rows:
+                print('  {:s}'.format(input_name(row)))
+        else:
+            print('  {:s}'.format(input_name(rows[0])))
+
+# The graph of the minimized tables, with an edge for each pair of states some
+# input class goes between, labelled with the cycles it takes and how many
+# input classes take them (or which, with verbosity).
+def dot_graph(tables, inputs, verbosity = 0):
+    edges = {}
+    for k, rows in enumerate(inputs):
+        for state in range(tables.n_states):
+            i = state * tables.stride + rows[0]
+            cycles = tables.cycles[i]
+            new_state = tables.next_states[i]
+            if cycles >= 0 and new_state >= 0:
+                edges.setdefault((state, new_state), {}).setdefault(cycles, []).append(k)
+
+    lines = ['digraph timing {', '    rankdir=LR;']
+    for state in range(tables.n_states):
+        if state == tables.state_default:
+            shape = 'doublecircle'
+        else:
+            shape = 'circle'
+        lines.append('    s{:d} [label="{:d}", shape={:s}];'.format(state, state, shape))
+    for (state, new_state), by_cycles in sorted(edges.items()):
+        label = []
+        for cycles, ks in sorted(by_cycles.items()):
+            if verbosity >= 1:
+                label.append('{:d}: {:s}'.format(cycles, ' '.join('I{:d}'.format(k) for k in ks)))
+            else:
+                label.append('{:d}: {:d} classes'.format(cycles, len(ks)))
+        lines.append('    s{:d} -> s{:d} [label="{:s}"];'.format(state, new_state, '\\n'.join(label)))
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('model',
+                        help='timing model to minimize (tables or pickle)')
+    parser.add_argument('-o', '--out',
+                        help='write the minimized tables to this file')
+    parser.add_argument('-dot',
+                        help='write a DOT graph of the minimized state machine to this file')
+    parser.add_argument('-v', '--verbose', type=int, default=0,
+                        help='verbosity level')
+
+    args = parser.parse_args()
+
+    tables = timing.compile_tables(timing.load_model(args.model))
+    minimized, classes, inputs = timing.minimize(tables)
+
+    print('{:d} states, {:d} reachable from {:d}, {:d} after minimization'
+          .format(tables.n_states, len(classes), tables.state_default, minimized.n_states))
+    for c in range(minimized.n_states):
+        members = [state for state in sorted(classes) if classes[state] == c]
+        print('  {:d} <- {:s}'.format(c, ' '.join(str(state) for state in members)))
+    print('{:d} inputs in {:d} classes'.format(tables.stride, len(inputs)))
+    if args.verbose >= 1:
+        describe_inputs(minimized, inputs, verbosity=args.verbose)
+
+    if args.out:
+        print('writing tables to {:s}'.format(args.out))
+        timing.save_tables(minimized, args.out)
+    if args.dot:
+        print('writing graph to {:s}'.format(args.dot))
+        with open(args.dot, 'wt') as f:
+            f.write(dot_graph(minimized, inputs, verbosity=args.verbose))
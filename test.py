@@ -218,7 +218,7 @@ def gen(n):
 
     # create the model
     state = model.Model()
-    write16 = model.mk_write16(state.write8)
+    write16 = state.write16
     for i in range(len(scratch_words)):
         write16(scratch_start + (i*2), scratch_words[i])
     for i in range(len(storage_words)):
@@ -10,7 +10,6 @@ import json
 import codecs
 import traceback
 import multiprocessing
-import pickle
 
 libdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'lib')
 sys.path.append(libdir)
@@ -23,6 +22,7 @@ from msp_cosim import Cosim
 from msp_isa import isa
 import cosim as cosim_repl
 import smt
+import msp_timing as timing
 
 def is_timer_read(fields, rdst):
     return fields['words'] == [0x4210 | rdst, 0x0350]
@@ -100,7 +100,7 @@ def trace_elf(elfname, jname, tty = None, logname = None, verbosity = 0):
             cosim.run(max_steps=run_max_steps, interval=run_interval, passes=run_passes)
 
             diff = cosim.diff()
-            trace = mulator.trace
+            trace = mulator.trace_dicts()
             iotrace = mulator.iotrace2
     else:
         with open(logname, 'at') as f:
@@ -114,7 +114,7 @@ def trace_elf(elfname, jname, tty = None, logname = None, verbosity = 0):
                 cosim.run(max_steps=run_max_steps, interval=run_interval, passes=run_passes)
 
                 diff = cosim.diff()
-                trace = mulator.trace
+                trace = mulator.trace_dicts()
                 iotrace = mulator.iotrace2
 
     with utils.Write7z(jname) as f:
@@ -129,7 +129,9 @@ def retrace_elf(elfname, jname, tinfo, interesting_blocks, verbosity = 0):
         print('skipping {:s}, no trace {:s}'.format(elfname, jname))
         return True
 
-    timulator = Emulator(verbosity=verbosity, tracing=True, tinfo=tinfo)
+    # only the untimed emulator's trace is kept, so the timed one can run
+    # untraced, on the translator (and its fused handlers)
+    timulator = Emulator(verbosity=verbosity, tinfo=tinfo)
     mulator = Emulator(verbosity=verbosity, tracing=True)
     mmap = [(model.ram_start, model.ram_size), (model.fram_start, model.fram_size)]
     cosim = Cosim([timulator, mulator], [False, False], mmap)
@@ -138,7 +140,7 @@ def retrace_elf(elfname, jname, tinfo, interesting_blocks, verbosity = 0):
     cosim_repl.prog_and_sync(cosim, master_idx, elfname)
     cosim.run(max_steps=run_max_steps, interval=run_interval, passes=run_passes)
 
-    tmp_jstr = json.dumps({'diff':cosim.diff(), 'trace':mulator.trace, 'iotrace':mulator.iotrace2})
+    tmp_jstr = json.dumps({'diff':cosim.diff(), 'trace':mulator.trace_dicts(), 'iotrace':mulator.iotrace2})
     tmp_jobj = json.loads(tmp_jstr)
 
     diff = tmp_jobj['diff']
@@ -529,8 +531,7 @@ def main(args):
         if tinfo_name == 'reference':
             tinfo = 'reference'
         else:
-            with open(tinfo_name, 'rb') as f:
-                tinfo = pickle.load(f)
+            tinfo = timing.load_model(tinfo_name)
     else:
         tinfo = None
         
@@ -650,7 +651,7 @@ if __name__ == '__main__':
     parser.add_argument('-s', '--smt', type=int, default=0,
                         help='run analysis round with smt solver')
     parser.add_argument('-t', '--timing',
-                        help='use this pickled timing model to emulate Timer_A')
+                        help='use this timing model (tables or pickle) to emulate Timer_A')
     parser.add_argument('-v', '--verbose', type=int, default=0,
                         help='verbosity level')
     parser.add_argument('-noabort', action='store_true',